@@ -0,0 +1,264 @@
+"""
+EOG/ECG independent components, found in one pass per subject.
+
+``ica.find_bads_eog(raw)`` / ``ica.find_bads_ecg(raw)`` recompute the ICA
+sources and re-filter them for every EOG/ECG channel, and the scripts build
+the same EOG/ECG epochs again for plotting. Here, per subject,
+
+- the EOG/ECG epochs (and their averages) are created once,
+- ``ica.get_sources(raw)`` runs once; the sources are band-passed once per
+  band (1-10 Hz EOG, 8-16 Hz ECG) together with all targets, and every
+  component is scored against every EOG/ECG channel with one matmul,
+- the ECG 'ctps' method slices the heartbeat epochs out of the same sources,
+
+and the result is what find_bads_eog/find_bads_ecg give (same scores, same
+``ica.labels_``). ``exclude`` is set from the labels and the scores printed:
+
+    found = eeg_artifacts.classify(raw, ica, verbose=True)
+    ica.plot_sources(found['eog_evoked'])
+
+``classify_cohort`` does a whole cohort (a thread per subject) and can add
+``corrmap`` template matching across the subjects' ICAs.
+"""
+
+import csv
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import mne
+from mne.preprocessing import create_eog_epochs, create_ecg_epochs, corrmap
+from mne.preprocessing.bads import _find_outliers
+from mne.preprocessing.ctps_ import ctps
+from mne.preprocessing.ecg import _make_ecg
+
+import eeg_float32
+
+# band-pass of sources and targets, as in mne's ICA scoring
+filter_kw = dict(phase='zero-double', filter_length='10s', fir_window='hann',
+                 l_trans_bandwidth=0.5, h_trans_bandwidth=0.5,
+                 fir_design='firwin2')
+
+
+def _float64(raw):
+    # mne's EOG/ECG detection and band-passes only filter float64 data
+    if eeg_float32.dtype_of(raw) == np.float64:
+        return raw
+    return eeg_float32.astype(raw.copy(), np.float64)
+
+
+def artifact_epochs(raw, eog=True, ecg=True, baseline=(None, -0.2)):
+    """EOG/ECG epochs and their baseline-corrected averages, built once.
+
+    Keys 'eog_epochs', 'eog_evoked', 'ecg_epochs', 'ecg_evoked' (missing when
+    there is no EOG channel, or neither an ECG channel nor MEG to make one).
+    """
+    raw = _float64(raw)
+    out = dict()
+    if eog and len(mne.pick_types(raw.info, meg=False, eog=True)):
+        out['eog_epochs'] = create_eog_epochs(raw, verbose=False)
+        out['eog_evoked'] = out['eog_epochs'].average().apply_baseline(baseline)
+    if ecg and len(mne.pick_types(raw.info, meg=True, ecg=True)):
+        out['ecg_epochs'] = create_ecg_epochs(raw, verbose=False)
+        out['ecg_evoked'] = out['ecg_epochs'].average().apply_baseline(baseline)
+    return out
+
+
+# #### scoring ####
+
+def correlate(sources, targets, sfreq, l_freq=None, h_freq=None):
+    """Pearson r of every target with every source, (n_targets, n_sources)."""
+    data = np.concatenate([sources, targets])
+    if l_freq is not None and h_freq is not None:
+        data = mne.filter.filter_data(data, sfreq, l_freq, h_freq,
+                                      verbose=False, **filter_kw)
+    data = data - data.mean(axis=-1, keepdims=True)
+    data /= np.linalg.norm(data, axis=-1, keepdims=True)
+    return np.dot(data[len(sources):], data[:len(sources)].T)
+
+
+def _label(ica, scores, names, prefix, threshold, measure):
+    # ica._find_bads_ch: per-target outliers, merged by |score|
+    idx = []
+    for ii, (name, these) in enumerate(zip(names, scores)):
+        if measure == 'zscore':
+            this_idx = _find_outliers(these, threshold=threshold)
+        else:
+            this_idx = np.where(np.abs(these) > threshold)[0]
+        ica.labels_['{}/{}/{}'.format(prefix, ii, name)] = list(this_idx)
+        idx.append(np.asarray(this_idx, int))
+    order = np.concatenate([s[i] for s, i in zip(scores, idx)])
+    labels = []
+    for i in np.concatenate(idx)[np.abs(order).argsort()[::-1]]:
+        if i not in labels:
+            labels.append(i)
+    ica.labels_[prefix] = labels
+    return labels, scores[0] if len(scores) == 1 else list(scores)
+
+
+class _Sources(object):
+    """ICA sources of a raw, computed once and shared by every check."""
+
+    def __init__(self, ica, raw, reject_by_annotation=True):
+        src = ica.get_sources(raw)
+        self.full = src.get_data()
+        if reject_by_annotation:
+            self.good = ~np.isnan(src.get_data(
+                picks=[0], reject_by_annotation='NaN')[0])
+        else:
+            self.good = np.ones(self.full.shape[1], bool)
+        self.kept = self.full if self.good.all() else self.full[:, self.good]
+
+    def epochs(self, epochs, first_samp):
+        """(n_epochs, n_sources, n_times) of the windows of ``epochs``."""
+        start = int(round(epochs.tmin * epochs.info['sfreq']))
+        onsets = epochs.events[:, 0] - first_samp + start
+        idx = onsets[:, None] + np.arange(len(epochs.times))
+        return self.full[:, idx].transpose(1, 0, 2)
+
+
+def classify(raw, ica, eog=True, ecg=True, ecg_method='correlation',
+             eog_threshold=3.0, ecg_threshold='auto', measure='zscore',
+             epochs=None, reject_by_annotation=True, exclude=True,
+             verbose=False):
+    """find_bads_eog + find_bads_ecg of one subject, from one set of sources.
+
+    ``epochs`` is the output of ``artifact_epochs`` (built here if None).
+    Returns a dict with 'eog', 'eog_scores', 'ecg', 'ecg_scores' (like the
+    return values of the mne methods), '<kind>_targets' (the channels scored
+    against) and the artifact epochs/evokeds. With ``exclude``, the labels
+    are added to ``ica.exclude``. A float32 raw is scored from a float64 copy.
+    """
+    raw = _float64(raw)
+    if epochs is None:
+        epochs = artifact_epochs(raw, eog=eog, ecg=ecg)
+    sources = _Sources(ica, raw, reject_by_annotation)
+    omit = 'omit' if reject_by_annotation else None
+    sfreq = raw.info['sfreq']
+    found = dict(epochs)
+
+    if eog:
+        names = [raw.ch_names[p] for p in mne.pick_types(raw.info, meg=False,
+                                                         eog=True)]
+        if not names:
+            raise RuntimeError('No EOG channel(s) found')
+        threshold = eog_threshold
+        if threshold == 'auto':
+            threshold = 3.0 if measure == 'zscore' else 0.9
+        targets = raw.get_data(picks=names, reject_by_annotation=omit)
+        scores = correlate(sources.kept, targets, sfreq, 1, 10)
+        found['eog'], found['eog_scores'] = _label(ica, scores, names, 'eog',
+                                                   threshold, measure)
+        found['eog_targets'] = names
+    if ecg:
+        ecg_picks = mne.pick_types(raw.info, meg=False, ecg=True)
+        name = raw.ch_names[ecg_picks[0]] if len(ecg_picks) else 'ECG-MAG'
+        found['ecg_targets'] = [name]
+        if ecg_method == 'ctps':
+            threshold = 0.3 if ecg_threshold == 'auto' else ecg_threshold
+            _, p_vals, _ = ctps(sources.epochs(epochs['ecg_epochs'],
+                                               raw.first_samp))
+            scores = p_vals.max(-1)
+            idx = np.where(scores >= threshold)[0]
+            idx = list(idx[np.abs(scores[idx]).argsort()[::-1]])
+            # mne names this label after its ch_name argument, None here
+            ica.labels_['ecg'] = ica.labels_['ecg/ECG-MAG'] = idx
+            found['ecg'], found['ecg_scores'] = idx, scores
+        else:
+            threshold = ecg_threshold
+            if threshold == 'auto':
+                threshold = 3.0 if measure == 'zscore' else 0.9
+            if len(ecg_picks):
+                target = raw.get_data(picks=ecg_picks[:1],
+                                      reject_by_annotation=omit)
+            else:  # synthetic ECG from the magnetometers, like mne
+                target = _make_ecg(raw, None, None,
+                                   reject_by_annotation=reject_by_annotation)[0]
+            scores = correlate(sources.kept, np.atleast_2d(target), sfreq, 8, 16)
+            found['ecg'], found['ecg_scores'] = _label(ica, scores, [name],
+                                                       'ecg', threshold, measure)
+
+    if exclude:
+        for kind in ('eog', 'ecg'):
+            ica.exclude = list(ica.exclude) + [int(i) for i in found.get(kind, [])
+                                               if i not in ica.exclude]
+    if verbose:
+        print(summary(found))
+    return found
+
+
+def summary(found, name=None):
+    """One line with the labelled components and their scores."""
+    parts = [] if name is None else [str(name) + ':']
+    for kind in ('eog', 'ecg'):
+        if kind not in found:
+            continue
+        best = np.abs(np.atleast_2d(found[kind + '_scores'])).max(axis=0)
+        scores = ', '.join('{}: {:.2f}'.format(i, best[i]) for i in found[kind])
+        parts.append('{} [{}] (max |score| {:.2f})'.format(
+            kind.upper(), scores, best.max()))
+    return ' '.join(parts)
+
+
+# #### cohort ####
+
+def match_template(icas, template, label, threshold='auto', ch_type='eeg',
+                   exclude=True):
+    """mne's corrmap over ``icas`` (component maps only, no data).
+
+    ``template`` is (index into icas, component). The matches end up in
+    ``ica.labels_[label]`` and, with ``exclude``, in ``ica.exclude``.
+    """
+    with mne.utils.use_log_level('error'):
+        corrmap(icas, template=template, threshold=threshold, label=label,
+                ch_type=ch_type, plot=False, show=False)
+    matches = [list(ica.labels_.get(label, [])) for ica in icas]
+    if exclude:
+        for ica, these in zip(icas, matches):
+            ica.exclude = list(ica.exclude) + [int(i) for i in these
+                                               if i not in ica.exclude]
+    return matches
+
+
+def classify_cohort(subjects, n_jobs=None, template=None, template_label='blink',
+                    template_ch_type='eeg', log=None, verbose=True, **kwargs):
+    """``classify`` for every subject, a thread each.
+
+    ``subjects`` maps a name to (raw, ica). ``template`` = (name, component)
+    adds corrmap matching of that component across all ICAs. ``log`` is a
+    TSV file name for every score (subject, kind, target, component, score,
+    excluded). Returns {name: classify output}.
+    """
+    names = list(subjects)
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        results = dict(zip(names, pool.map(
+            lambda name: classify(*subjects[name], **kwargs), names)))
+    icas = [subjects[name][1] for name in names]
+    if template is not None:
+        matches = match_template(icas, (names.index(template[0]), template[1]),
+                                 template_label, ch_type=template_ch_type)
+        for name, these in zip(names, matches):
+            results[name][template_label] = these
+    if verbose:
+        for name in names:
+            print(summary(results[name], name))
+    if log is not None:
+        write_log(log, results, {name: subjects[name][1] for name in names})
+    return results
+
+
+def write_log(fname, results, icas):
+    """TSV with one row per (subject, target channel, component)."""
+    with open(fname, 'w', newline='') as f:
+        writer = csv.writer(f, delimiter='\t')
+        writer.writerow(['subject', 'kind', 'target', 'component', 'score',
+                         'excluded'])
+        for name, found in results.items():
+            for kind in ('eog', 'ecg'):
+                if kind not in found:
+                    continue
+                scores = np.atleast_2d(found[kind + '_scores'])
+                for target, these in zip(found[kind + '_targets'], scores):
+                    for comp, score in enumerate(these):
+                        writer.writerow([name, kind, target, comp,
+                                         '{:.4f}'.format(score),
+                                         int(comp in icas[name].exclude)])
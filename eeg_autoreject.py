@@ -0,0 +1,227 @@
+"""
+autoreject (local) fit with the cross-validation spread over a process pool.
+
+``fit_autoreject(epochs, ...)`` returns a fitted ``autoreject.AutoReject``
+(same thresholds, consensus and n_interpolate as ``AutoReject.fit``), so
+``ar.transform(epochs, return_log=True)`` works as usual. The expensive parts
+run in worker processes:
+
+- the augmented (leave-one-channel-out interpolated) epochs, per channel,
+- the candidate-threshold search with its 10 CV splits, per channel,
+- the n_interpolate x consensus x fold grid, one job per n_interpolate.
+
+The epochs array (and the augmented copy) live in shared memory; workers
+attach to it instead of getting the data pickled with every job. Channel
+repair goes through the cached matrices of ``eeg_interp``.
+"""
+
+import os
+from functools import partial
+from multiprocessing.shared_memory import SharedMemory
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import mne
+from sklearn.model_selection import KFold, StratifiedShuffleSplit
+from autoreject import AutoReject
+# autoreject's own building blocks, so the result matches AutoReject.fit
+from autoreject.autoreject import (_AutoReject, _compute_thresh, _compute_dots,
+                                   _check_data, _handle_picks,
+                                   _get_picks_by_type, _get_interp_chs,
+                                   _slicemean)
+
+import eeg_interp
+
+
+# #### shared memory ####
+
+def _to_shared(arr):
+    shm = SharedMemory(create=True, size=max(arr.nbytes, 1))
+    view = np.ndarray(arr.shape, arr.dtype, buffer=shm.buf)
+    view[:] = arr
+    return shm, view, (shm.name, arr.shape, arr.dtype.str)
+
+
+def _attach(spec):
+    name, shape, dtype = spec
+    shm = SharedMemory(name=name)
+    return shm, np.ndarray(shape, np.dtype(dtype), buffer=shm.buf)
+
+
+_worker = dict()
+
+
+def _init_worker(data_spec, aug_spec, info):
+    _worker['shm'], _worker['data'] = _attach(data_spec)
+    _worker['aug_shm'], _worker['aug'] = _attach(aug_spec)
+    _worker['info'] = info
+
+
+# #### jobs ####
+
+def _given_threshes(threshes, *args, **kwargs):
+    # thresh_func for _AutoReject when the thresholds are already known
+    return threshes
+
+
+def _augment_job(picks, type_picks, method):
+    """Leave-one-out interpolation of ``picks`` into the shared aug array."""
+    data, aug, info = _worker['data'], _worker['aug'], _worker['info']
+    for pick in picks:
+        goods, _, M = eeg_interp.interpolation_matrix(
+            info, type_picks, [info['ch_names'][pick]], method=method,
+            mode='fast')
+        aug[:, pick] = np.matmul(M, data[:, goods])[:, 0]
+
+
+def _thresh_job(picks, method, random_state):
+    """Candidate-threshold CV for each channel in ``picks``."""
+    data, aug = _worker['data'], _worker['aug']
+    n_epochs = len(data)
+    y = np.r_[np.zeros(n_epochs), np.ones(n_epochs)]
+    threshes = []
+    for pick in picks:
+        this_data = np.concatenate([data[:, pick], aug[:, pick]], axis=0)
+        cv = StratifiedShuffleSplit(n_splits=10, test_size=0.2,
+                                    random_state=random_state)
+        threshes.append(_compute_thresh(this_data, cv=cv, method=method, y=y,
+                                        random_state=random_state))
+    return threshes
+
+
+def _cv_job(n_interp, labels, counts, ch_type, type_picks, threshes,
+            consensus, splits):
+    """Loss over (consensus, fold) for one n_interpolate value."""
+    info = _worker['info']
+    local_reject = _AutoReject(picks=type_picks, verbose=False)
+    local_reject.threshes_ = threshes
+    local_reject.picks_ = type_picks
+    local_reject.n_interpolate_ = {ch_type: n_interp}
+    local_reject.consensus_ = {ch_type: consensus[0]}
+
+    interp_channels = _get_interp_chs(labels, info['ch_names'], type_picks)
+    X_interp = eeg_interp.interpolate_epochs(
+        np.array(_worker['data']), info, interp_channels, type_picks)
+    X_interp = X_interp[:, type_picks]
+    X = _worker['data'][:, type_picks]
+
+    n_channels = len(type_picks)
+    loss = np.zeros((len(consensus), len(splits)))
+    for fold, (train, test) in enumerate(splits):
+        median = np.median(X[test], axis=0)
+        X_interp_train = X_interp[train]
+        counts_train = counts[train]
+        for idx, this_consensus in enumerate(consensus):
+            if this_consensus * n_channels <= n_interp:  # kappa must be > rho
+                loss[idx, fold] = np.inf
+                continue
+            local_reject.consensus_[ch_type] = this_consensus
+            bad_epochs = local_reject._get_bad_epochs(
+                counts_train, picks=type_picks, ch_type=ch_type)
+            mean_ = _slicemean(X_interp_train, np.nonzero(~bad_epochs)[0],
+                               axis=0)
+            loss[idx, fold] = np.inf if np.any(np.isnan(mean_)) else \
+                np.sqrt(np.mean((median - mean_) ** 2))
+    return loss
+
+
+# #### fit ####
+
+def fit_autoreject(epochs, n_interpolate=None, consensus=None, cv=10,
+                   picks=None, thresh_method='bayesian_optimization',
+                   random_state=None, n_jobs=None, verbose=False):
+    """``AutoReject(...).fit(epochs)`` with the CV running in ``n_jobs`` processes.
+
+    ``n_interpolate`` None is AutoReject's default grid, [1, 4, min(n - 1, 32)]
+    for n picked channels.
+    """
+    n_jobs = os.cpu_count() if n_jobs in (None, -1) else n_jobs
+    epochs.load_data()
+    ar = AutoReject(n_interpolate=None if n_interpolate is None
+                    else np.array(n_interpolate), consensus=consensus,
+                    cv=cv, picks=picks, thresh_method=thresh_method, n_jobs=1,
+                    random_state=random_state, verbose=verbose)
+    ar.picks_ = _handle_picks(info=epochs.info, picks=ar.picks)
+    ar.picks_.sort()
+    _check_data(epochs, picks=ar.picks_, verbose=verbose)
+    if ar.n_interpolate is None:  # as in AutoReject.fit
+        if len(ar.picks_) < 4:
+            raise ValueError('Too few channels. autoreject is unlikely'
+                             ' to be effective')
+        ar.n_interpolate = np.array([1, 4, min(len(ar.picks_) - 1, 32)])
+    ar.cv_ = KFold(n_splits=cv) if isinstance(cv, int) else cv
+    picks_by_type = _get_picks_by_type(info=epochs.info, picks=ar.picks_)
+    ar.dots = None
+    if any(ch_type in ('mag', 'grad') for ch_type, _ in picks_by_type):
+        meg_picks = mne.pick_types(epochs.info, meg=True, eeg=False, exclude=[])
+        ar.dots = _compute_dots(mne.pick_info(epochs.info, meg_picks, copy=True),
+                                templates=None)
+    ar.n_interpolate_, ar.consensus_, ar.threshes_ = dict(), dict(), dict()
+    ar.loss_, ar.local_reject_ = dict(), dict()
+
+    data = epochs.get_data()
+    shm, _, data_spec = _to_shared(data)
+    aug_shm, aug, aug_spec = _to_shared(np.zeros_like(data))
+    del data
+    try:
+        with ProcessPoolExecutor(
+                max_workers=n_jobs, initializer=_init_worker,
+                initargs=(data_spec, aug_spec, epochs.info)) as pool:
+            for ch_type, type_picks in picks_by_type:
+                if verbose:
+                    print('Running autoreject on ch_type=%s' % ch_type)
+                _fit_ch_type(ar, epochs, pool, n_jobs, ch_type, type_picks)
+    finally:
+        for s in (shm, aug_shm):
+            s.close()
+            s.unlink()
+    return ar
+
+
+def _fit_ch_type(ar, epochs, pool, n_jobs, ch_type, type_picks):
+    chunks = [c for c in np.array_split(np.asarray(type_picks), n_jobs) if len(c)]
+
+    # 1) augmented epochs, then 2) per-channel thresholds
+    method = 'spline' if ch_type == 'eeg' else 'MNE'
+    list(pool.map(_augment_job, chunks, [type_picks] * len(chunks),
+                  [method] * len(chunks)))
+    threshes = pool.map(_thresh_job, chunks, [ar.thresh_method] * len(chunks),
+                        [ar.random_state] * len(chunks))
+    threshes = {epochs.ch_names[p]: t
+                for chunk, chunk_threshes in zip(chunks, threshes)
+                for p, t in zip(chunk, chunk_threshes)}
+
+    # local reject with these thresholds (what _run_local_reject_cv fits)
+    local_reject = _AutoReject(thresh_func=partial(_given_threshes, threshes),
+                               picks=type_picks, dots=ar.dots, verbose=False)
+    local_reject.fit(epochs)
+    labels, counts = local_reject._vote_bad_epochs(epochs, picks=type_picks)
+
+    # the interpolation labels are chained over n_interpolate in autoreject,
+    # they are cheap, so compute them here in order and farm out the rest
+    all_labels = []
+    for n_interp in ar.n_interpolate:
+        labels = local_reject._get_epochs_interpolation(
+            epochs, labels=labels, picks=type_picks, n_interpolate=n_interp)
+        all_labels.append(labels)
+
+    # 3) consensus x fold grid, one job per n_interpolate
+    splits = list(ar.cv_.split(np.zeros(len(epochs))))
+    n = len(ar.n_interpolate)
+    losses = pool.map(_cv_job, ar.n_interpolate, all_labels, [counts] * n,
+                      [ch_type] * n, [type_picks] * n, [threshes] * n,
+                      [ar.consensus] * n, [splits] * n)
+    loss = np.stack(list(losses), axis=1)  # (consensus, n_interp, folds)
+
+    best_idx, best_jdx = np.unravel_index(loss.mean(axis=-1).argmin(),
+                                          loss.shape[:2])
+    ar.threshes_.update(threshes)
+    ar.consensus_[ch_type] = ar.consensus[best_idx]
+    ar.n_interpolate_[ch_type] = ar.n_interpolate[best_jdx]
+    ar.loss_[ch_type] = loss
+    local_reject.consensus_[ch_type] = ar.consensus_[ch_type]
+    local_reject.n_interpolate_[ch_type] = ar.n_interpolate_[ch_type]
+    ar.local_reject_[ch_type] = local_reject
+    if ar.verbose:
+        print('Estimated consensus=%0.2f and n_interpolate=%d'
+              % (ar.consensus_[ch_type], ar.n_interpolate_[ch_type]))
@@ -0,0 +1,691 @@
+"""
+Benchmarks of every preprocessing stage used in the study scripts.
+
+Each stage (file reads, filter/notch/resample, ICA fits, EOG/ECG scoring,
+event detection, epoching with rejection, autoreject, bad-channel
+interpolation, PSD) is timed with the mne call the scripts started from and,
+where there is one, with the replacement in this repo (eeg_filter, eeg_ica,
+...), at several recording lengths, channel counts and subject counts. Every
+result (best/median time over ``repeat`` runs, peak traced memory) goes to a
+JSON file that ``compare`` diffs against an earlier run:
+
+    python eeg_bench.py bench.json                    # synthetic data, offline
+    python eeg_bench.py bench.json --quick --stages 'read_*' filter
+    python eeg_bench.py bench.json --sample           # mne sample recording
+    python eeg_bench.py bench.json --bciciv C:/.../BCICIV_2a_gdf --subjects 1 9
+    python eeg_bench.py new.json --compare bench.json
+
+Synthetic recordings (``synthetic_raw``) have EEG with a 10-20 montage, EOG
+with blinks, ECG with heartbeats, line noise and a stim channel with evoked
+responses, so every stage runs without the sample dataset download. The
+repo's caches are emptied and disabled before every timed run.
+"""
+
+import os
+import gc
+import json
+import time
+import shutil
+import fnmatch
+import platform
+import argparse
+import tempfile
+import warnings
+import tracemalloc
+
+import numpy as np
+import scipy
+import mne
+
+import eeg_artifacts
+import eeg_cache
+import eeg_epochs
+import eeg_events
+import eeg_filter
+import eeg_ica
+import eeg_interp
+import eeg_linenoise
+import eeg_psd
+import eeg_runner
+
+# sizes varied one at a time around the first value of each
+default_sizes = dict(durations=(60., 300.), n_channels=(32, 64), n_subjects=(1, 4))
+quick_sizes = dict(durations=(20.,), n_channels=(16,), n_subjects=(1, 2))
+
+reject = dict(eeg=150e-6, eog=250e-6)  # as in the study2 scripts
+event_id = {'auditory/left': 1, 'auditory/right': 2, 'visual/left': 3,
+            'visual/right': 4}
+autoreject_kw = dict(n_interpolate=(1, 4), cv=5, random_state=42)
+n_components = (15, 20, 30)  # ICA fits
+study1 = eeg_runner.study1_spec
+
+
+class Skip(Exception):
+    """A stage that does not apply to this data (reported, not an error)."""
+
+
+# #### synthetic data ####
+
+def _pink(rng, shape, sfreq, fmin=0.5):
+    # 1/f noise with unit std per row
+    spec = rng.standard_normal(shape[:-1] + (shape[-1] // 2 + 1,)) + \
+        1j * rng.standard_normal(shape[:-1] + (shape[-1] // 2 + 1,))
+    freqs = np.fft.rfftfreq(shape[-1], 1. / sfreq)
+    spec /= np.sqrt(np.maximum(freqs, fmin))
+    x = np.fft.irfft(spec, n=shape[-1])
+    return x / x.std(axis=-1, keepdims=True)
+
+
+def synthetic_raw(duration=60., sfreq=1000., n_eeg=32, line_freq=60.,
+                  seed=0):
+    """RawArray like a study recording: EEG (10-20 positions), EOG, ECG, stim.
+
+    EEG is 1/f noise + alpha + line noise at ``line_freq`` and harmonics,
+    with blinks (frontal) and a small cardiac leak; one event (codes 1-4,
+    each with its own evoked topography) about every second.
+    """
+    rng = np.random.default_rng(seed)
+    montage = mne.channels.make_standard_montage('standard_1005')
+    pos = montage.get_positions()['ch_pos']
+    names = [ch for ch in mne.channels.make_standard_montage(
+        'standard_1020').ch_names if ch in pos]
+    names += [ch for ch in montage.ch_names if ch not in names]
+    if n_eeg > len(names):
+        raise ValueError('at most {} EEG channels'.format(len(names)))
+    names = names[:n_eeg]
+    xyz = np.array([pos[ch] for ch in names])
+    n_times = int(round(duration * sfreq))
+    t = np.arange(n_times) / sfreq
+
+    eeg = 10e-6 * _pink(rng, (n_eeg, n_times), sfreq)
+    alpha = np.sin(2 * np.pi * 10. * t + rng.uniform(0, 2 * np.pi))
+    eeg += 5e-6 * np.outer(rng.uniform(0.2, 1., n_eeg), alpha)
+    for k in range(1, 5):
+        if k * line_freq < sfreq / 2.:
+            eeg += 2e-6 / k * np.sin(2 * np.pi * k * line_freq * t)
+
+    # blinks every 2-6 s, strongest in front
+    eog = 20e-6 * _pink(rng, (1, n_times), sfreq)[0]
+    blink = np.hanning(int(0.3 * sfreq))
+    onsets = np.cumsum(rng.uniform(2., 6., int(duration / 2.) + 1))
+    for onset in (onsets[onsets < duration - 0.5] * sfreq).astype(int):
+        eog[onset:onset + len(blink)] += 200e-6 * blink
+    front = np.exp((xyz[:, 1] - xyz[:, 1].max()) / 0.03)
+    eeg += np.outer(0.5 * front, eog)
+
+    # heartbeats at ~1.1 Hz
+    ecg = 20e-6 * rng.standard_normal(n_times)
+    qrs = np.diff(np.hanning(int(0.04 * sfreq))) * 1e-3 * sfreq / 10.
+    beats = np.cumsum(rng.normal(0.9, 0.05, int(duration / 0.8) + 2))
+    for onset in (beats[beats < duration - 0.1] * sfreq).astype(int):
+        ecg[onset:onset + len(qrs)] += qrs
+    eeg += np.outer(rng.uniform(0., 0.003, n_eeg), ecg)
+
+    # events + evoked responses
+    stim = np.zeros(n_times)
+    onsets = (np.arange(1., duration - 1., 1.) +
+              rng.uniform(-0.1, 0.1, max(int(duration - 2.), 0)))
+    codes = rng.integers(1, 5, len(onsets))
+    times = np.arange(int(0.5 * sfreq)) / sfreq
+    response = np.exp(-times / 0.1) * np.sin(2 * np.pi * 6. * times)
+    topos = rng.standard_normal((5, n_eeg)) * 5e-6
+    for onset, code in zip((onsets * sfreq).astype(int), codes):
+        stim[onset:onset + int(0.01 * sfreq)] = code
+        eeg[:, onset:onset + len(response)] += np.outer(
+            topos[code], response[:n_times - onset])
+
+    info = mne.create_info(names + ['EOG 061', 'ECG 063', 'STI 014'], sfreq,
+                           ['eeg'] * n_eeg + ['eog', 'ecg', 'stim'])
+    raw = mne.io.RawArray(np.vstack([eeg, eog, ecg, stim]), info,
+                          verbose=False)
+    raw.set_montage(montage, verbose=False)
+    return raw
+
+
+# #### writers for the read benchmarks ####
+
+def _field(value, width):
+    return str(value).ljust(width)[:width].encode('ascii')
+
+
+def write_edf(raw, fname, bdf=False):
+    """Minimal EDF (16 bit) / BDF (24 bit) file of ``raw``, 1 s records."""
+    sfreq = raw.info['sfreq']
+    per_record = int(round(sfreq))
+    if per_record != sfreq:
+        raise ValueError('EDF/BDF records need an integer sfreq')
+    types = raw.get_channel_types()
+    scale = np.array([1. if kind == 'stim' else 1e6 for kind in types])
+    data = raw.get_data() * scale[:, None]
+    n_chan, n_times = data.shape
+    n_records = -(-n_times // per_record)
+    data = np.pad(data, ((0, 0), (0, n_records * per_record - n_times)))
+    pmin, pmax = np.floor(data.min(axis=1)), np.ceil(data.max(axis=1))
+    pmax = np.where(pmax > pmin, pmax, pmin + 1)
+    dmin, dmax = (-2 ** 23, 2 ** 23 - 1) if bdf else (-2 ** 15, 2 ** 15 - 1)
+    digital = np.round((data - pmin[:, None]) / (pmax - pmin)[:, None] *
+                       (dmax - dmin) + dmin).astype('<i4')
+    records = digital.reshape(n_chan, n_records, per_record).transpose(1, 0, 2)
+    if bdf:
+        body = records.copy().view(np.uint8).reshape(records.shape + (4,))[..., :3]
+    else:
+        body = records.astype('<i2')
+
+    header = [b'\xffBIOSEMI' if bdf else _field('0', 8), _field('X', 80),
+              _field('bench', 80), _field('01.01.20', 8), _field('00.00.00', 8),
+              _field(256 * (n_chan + 1), 8), _field('24BIT' if bdf else '', 44),
+              _field(n_records, 8), _field(1, 8), _field(n_chan, 4)]
+    columns = [([ch for ch in raw.ch_names], 16),
+               ([''] * n_chan, 80),
+               (['' if kind == 'stim' else 'uV' for kind in types], 8),
+               ([int(v) for v in pmin], 8), ([int(v) for v in pmax], 8),
+               ([dmin] * n_chan, 8), ([dmax] * n_chan, 8),
+               ([''] * n_chan, 80), ([per_record] * n_chan, 8),
+               ([''] * n_chan, 32)]
+    for values, width in columns:
+        header += [_field(v, width) for v in values]
+    with open(fname, 'wb') as f:
+        f.write(b''.join(header))
+        f.write(np.ascontiguousarray(body).tobytes())
+    return fname
+
+
+def write_eeglab(raw, fname):
+    """Minimal EEGLAB .set (data inside the file) of the EEG/EOG/ECG channels."""
+    from scipy.io import savemat
+
+    picks = mne.pick_types(raw.info, eeg=True, eog=True, ecg=True)
+    data = raw.get_data(picks=picks) * 1e6  # EEGLAB stores µV
+    chanlocs = np.zeros(len(picks), dtype=[('labels', object)])
+    chanlocs['labels'] = [raw.ch_names[p] for p in picks]
+    eeg = dict(setname='bench', filename='', nbchan=len(picks), trials=1,
+               pnts=data.shape[1], srate=raw.info['sfreq'], xmin=0.,
+               xmax=(data.shape[1] - 1) / raw.info['sfreq'],
+               data=data.astype(np.float32), chanlocs=chanlocs,
+               event=np.zeros(0), icawinv=np.zeros(0), icasphere=np.zeros(0),
+               icaweights=np.zeros(0), ref='common')
+    savemat(fname, dict(EEG=eeg), appendmat=False)
+    return fname
+
+
+# #### data ####
+
+def _crop_pick(raw, duration, n_channels):
+    raw.crop(0, min(duration, raw.times[-1]))
+    eeg = mne.pick_types(raw.info, meg=False, eeg=True, exclude=[])
+    if n_channels > len(eeg):
+        raise Skip('only {} EEG channels'.format(len(eeg)))
+    keep = [raw.ch_names[p] for p in eeg[:n_channels]]
+    keep += [ch for ch, kind in zip(raw.ch_names, raw.get_channel_types())
+             if kind in ('eog', 'ecg', 'stim')]
+    return raw.pick_channels(keep, ordered=True).load_data()
+
+
+def load_raws(source, duration, n_channels, n_subjects, sfreq=1000.):
+    """(raws, source file names) of one case; ``source`` is 'synthetic',
+    'sample' or the directory of the BCICIV 2a GDF files."""
+    if source == 'synthetic':
+        return [synthetic_raw(duration, sfreq, n_channels, seed=i)
+                for i in range(n_subjects)], [None] * n_subjects
+    if source == 'sample':
+        fname = os.path.join(mne.datasets.sample.data_path(), 'MEG', 'sample',
+                             'sample_audvis_raw.fif')
+        raw = _crop_pick(mne.io.read_raw_fif(fname, verbose=False), duration,
+                         n_channels)
+        return [raw.copy() for _ in range(n_subjects)], [fname] * n_subjects
+    fnames = sorted(f for f in os.listdir(source) if f.endswith('T.gdf'))
+    if not fnames:
+        raise ValueError('no A0xT.gdf files in {}'.format(source))
+    fnames = [os.path.join(source, fnames[i % len(fnames)])
+              for i in range(n_subjects)]
+    raws = []
+    for fname in fnames:
+        raw = eeg_cache.fix_channels(mne.io.read_raw_gdf(fname, verbose=False))
+        raw.set_montage('standard_1020', on_missing='ignore', verbose=False)
+        raws.append(_crop_pick(raw, duration, n_channels))
+    return raws, fnames
+
+
+class Case(object):
+    """The recordings of one (duration, channels, subjects) size."""
+
+    def __init__(self, source, duration, n_channels, n_subjects, sfreq=1000.,
+                 tmp_dir=None):
+        self.source = source
+        self.size = dict(duration=duration, n_channels=n_channels,
+                         n_subjects=n_subjects)
+        self.raws, self.files = load_raws(source, duration, n_channels,
+                                          n_subjects, sfreq)
+        self.size['sfreq'] = self.raws[0].info['sfreq']
+        self.tmp_dir = tmp_dir or tempfile.mkdtemp(prefix='eeg_bench-')
+        self._prepared = dict()
+
+    def prepared(self, what, i, make):
+        """``make(raw i)``, once per case (setup that is not timed)."""
+        if (what, i) not in self._prepared:
+            self._prepared[what, i] = make(self.raws[i])
+        return self._prepared[what, i]
+
+    def close(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+
+# #### stages ####
+
+def _has(raw, kind):
+    if not len(mne.pick_types(raw.info, meg=False, exclude=[], **{kind: True})):
+        raise Skip('no {} channel'.format(kind.upper()))
+
+
+def _raw(case, i):
+    return (case.raws[i],)  # measure() copies it before every run
+
+
+def _written(fmt):
+    def setup(case, i):
+        if fmt == 'gdf':
+            if not (case.files[i] or '').endswith('.gdf'):
+                raise Skip('GDF is read from the BCICIV files only (--bciciv)')
+            return (case.files[i],)
+        fname = os.path.join(case.tmp_dir, '{}{}.{}'.format(
+            i, '_raw' if fmt == 'fif' else '', fmt))
+        if not os.path.exists(fname):
+            raw = case.raws[i]
+            if fmt == 'fif':
+                raw.save(fname, verbose=False)
+            elif fmt == 'set':
+                write_eeglab(raw, fname)
+            else:
+                write_edf(raw, fname, bdf=fmt == 'bdf')
+        return (fname,)
+    return setup
+
+
+def _highpassed(raw):
+    return raw.copy().filter(1., None, verbose=False)
+
+
+def _fitted_ica(raw):
+    n = min(n_components[0], len(mne.pick_types(raw.info, eeg=True)) - 1)
+    return eeg_ica.fit_ica(_highpassed(raw), n_components=n, random_state=97)
+
+
+def _events(raw):
+    if len(mne.pick_types(raw.info, meg=False, stim=True)):
+        return eeg_events.find_events(raw).events
+    return eeg_events.from_annotations(raw).events
+
+
+def _event_id(events):
+    present = {k: v for k, v in event_id.items() if v in events[:, 2]}
+    return present or {str(c): int(c) for c in np.unique(events[:, 2])}
+
+
+def _epochs(raw):
+    events = _events(raw)
+    return mne.Epochs(raw, events, _event_id(events), tmin=-0.2, tmax=0.5,
+                      preload=True, verbose=False)
+
+
+def _notch_freqs(raw):
+    return [f for f in study1['notch_freqs'] if f < raw.info['sfreq'] / 2.]
+
+
+def _decim(raw):
+    decim = int(round(raw.info['sfreq'] / study1['sfreq']))
+    if decim < 2:
+        raise Skip('sfreq is already {}'.format(raw.info['sfreq']))
+    return decim
+
+
+def _ica_setup(n):
+    def setup(case, i):
+        raw = case.raws[i]
+        if n >= len(mne.pick_types(raw.info, eeg=True)):
+            raise Skip('{} components > channels'.format(n))
+        return case.prepared('highpassed', i, _highpassed), n
+    return setup
+
+
+def _bads_setup(kind):
+    def setup(case, i):
+        raw = case.raws[i]
+        for k in kind:
+            if k == 'ecg' and len(mne.pick_types(raw.info, meg='mag')):
+                continue  # mne makes one from the magnetometers
+            _has(raw, k)
+        return raw, case.prepared('ica', i, _fitted_ica)
+    return setup
+
+
+def _epochs_setup(case, i):
+    raw = case.raws[i]
+    events = case.prepared('events', i, _events)
+    kinds = set(raw.get_channel_types())
+    return raw, events, _event_id(events), {k: v for k, v in reject.items()
+                                            if k in kinds}
+
+
+def _autoreject_setup(case, i):
+    try:
+        import autoreject  # noqa
+    except ImportError:
+        raise Skip('autoreject is not installed')
+    return (case.prepared('epochs', i, _epochs),)
+
+
+def _bads(raw):
+    # every 10th EEG channel
+    raw = raw.copy()
+    eeg = mne.pick_types(raw.info, eeg=True)
+    raw.info['bads'] = [raw.ch_names[p] for p in eeg[::10]]
+    return raw
+
+
+def _interp_setup(case, i):
+    return (case.prepared('bads', i, _bads),)
+
+
+def _mne_psd(raw):
+    if hasattr(raw, 'compute_psd'):
+        return raw.compute_psd(method='welch', n_fft=2048, verbose=False)
+    return mne.time_frequency.psd_welch(raw, n_fft=2048, verbose=False)
+
+
+def _mne_chain(raw):
+    raw = raw.copy().filter(study1['l_freq'], None, verbose=False)
+    raw.notch_filter(_notch_freqs(raw), verbose=False)
+    return raw.resample(study1['sfreq'], verbose=False)
+
+
+def _mne_classify(raw, ica):
+    ica.find_bads_eog(raw, verbose=False)
+    ica.find_bads_ecg(raw, verbose=False)
+
+
+def _mne_autoreject(epochs):
+    from autoreject import AutoReject
+
+    return AutoReject(n_jobs=1, verbose=False, **autoreject_kw).fit(epochs)
+
+
+def _eeg_autoreject(epochs):
+    import eeg_autoreject
+
+    return eeg_autoreject.fit_autoreject(epochs, **autoreject_kw)
+
+
+def _stage_list():
+    """(stage, impl, params, setup(case, i) -> args, run(*args))."""
+    out = []
+    for fmt, read in (('fif', mne.io.read_raw_fif), ('edf', mne.io.read_raw_edf),
+                      ('bdf', mne.io.read_raw_bdf),
+                      ('set', mne.io.read_raw_eeglab),
+                      ('gdf', mne.io.read_raw_gdf)):
+        out.append(('read_' + fmt, 'mne', {}, _written(fmt),
+                    lambda fname, read=read: read(fname, preload=True,
+                                                  verbose=False)))
+    out += [
+        ('filter', 'mne', dict(l_freq=study1['l_freq']), _raw,
+         lambda raw: raw.filter(study1['l_freq'], None, verbose=False)),
+        ('filter', 'eeg_filter', dict(l_freq=study1['l_freq']), _raw,
+         lambda raw: eeg_filter.filter_raw(raw, l_freq=study1['l_freq'],
+                                           copy=False)),
+        ('notch_fir', 'mne', {}, _raw,
+         lambda raw: raw.notch_filter(_notch_freqs(raw), verbose=False)),
+        ('notch_fir', 'eeg_filter', {}, _raw,
+         lambda raw: eeg_filter.filter_raw(raw, notch_freqs=_notch_freqs(raw),
+                                           copy=False)),
+        ('notch_spectrum_fit', 'mne', dict(filter_length='10s'), _raw,
+         lambda raw: raw.notch_filter(_notch_freqs(raw), method='spectrum_fit',
+                                      filter_length='10s', verbose=False)),
+        ('notch_spectrum_fit', 'eeg_linenoise', dict(filter_length='10s'), _raw,
+         lambda raw: eeg_linenoise.remove_line_noise_raw(raw, _notch_freqs(raw),
+                                                         window=10.)),
+        ('resample', 'mne', dict(sfreq=study1['sfreq']), _raw,
+         lambda raw: raw.resample(study1['sfreq'], verbose=False)),
+        ('resample', 'eeg_filter', dict(sfreq=study1['sfreq']),
+         lambda case, i: (case.raws[i], _decim(case.raws[i])),
+         lambda raw, decim: eeg_filter.filter_raw(raw, decim=decim)),
+        ('study1_chain', 'mne', {}, _raw, _mne_chain),
+        ('study1_chain', 'eeg_runner', {}, _raw,
+         lambda raw: eeg_runner.preprocess(raw, study1)),
+    ]
+    for n in n_components:
+        out += [
+            ('ica_fit', 'mne', dict(n_components=n), _ica_setup(n),
+             lambda raw, n: mne.preprocessing.ICA(
+                 n_components=n, random_state=97, max_iter=800).fit(
+                     raw, verbose=False)),
+            ('ica_fit', 'eeg_ica', dict(n_components=n), _ica_setup(n),
+             lambda raw, n: eeg_ica.fit_ica(raw, n_components=n,
+                                            random_state=97, max_iter=800)),
+        ]
+    out += [
+        ('find_bads_eog', 'mne', {}, _bads_setup(['eog']),
+         lambda raw, ica: ica.find_bads_eog(raw, verbose=False)),
+        ('find_bads_ecg', 'mne', {}, _bads_setup(['ecg']),
+         lambda raw, ica: ica.find_bads_ecg(raw, verbose=False)),
+        ('find_bads_eog_ecg', 'mne', {}, _bads_setup(['eog', 'ecg']),
+         _mne_classify),
+        ('find_bads_eog_ecg', 'eeg_artifacts', {}, _bads_setup(['eog', 'ecg']),
+         lambda raw, ica: eeg_artifacts.classify(raw, ica, exclude=False)),
+        ('find_events', 'mne', {}, _raw,
+         lambda raw: mne.find_events(raw, verbose=False)
+         if len(mne.pick_types(raw.info, meg=False, stim=True))
+         else mne.events_from_annotations(raw, verbose=False)),
+        ('find_events', 'eeg_events', {}, _raw, _events),
+        ('epochs_reject', 'mne', dict(tmin=-0.2, tmax=0.5), _epochs_setup,
+         lambda raw, events, ids, rej: mne.Epochs(
+             raw, events, ids, tmin=-0.2, tmax=0.5, reject=rej, preload=True,
+             verbose=False)),
+        ('epochs_reject', 'eeg_epochs', dict(tmin=-0.2, tmax=0.5), _epochs_setup,
+         lambda raw, events, ids, rej: eeg_epochs.make_epochs(
+             raw, events, ids, tmin=-0.2, tmax=0.5, reject=rej)),
+        ('autoreject_fit', 'autoreject', dict(autoreject_kw), _autoreject_setup,
+         _mne_autoreject),
+        ('autoreject_fit', 'eeg_autoreject', dict(autoreject_kw),
+         _autoreject_setup, _eeg_autoreject),
+        ('interpolate_bads', 'mne', {},
+         _interp_setup,
+         lambda raw: raw.interpolate_bads(verbose=False)),
+        ('interpolate_bads', 'eeg_interp', {},
+         _interp_setup,
+         eeg_interp.interpolate_bads),
+        ('psd', 'mne', dict(n_fft=2048), _raw,
+         _mne_psd),
+        ('psd', 'eeg_psd', dict(n_fft=2048), _raw,
+         eeg_psd.compute_psd),
+    ]
+    return out
+
+
+# #### measuring ####
+
+def _cold():
+    # every timed run starts without the repo's caches
+    for module in (eeg_filter, eeg_events, eeg_psd, eeg_ica):
+        module.cache_dir = None
+    for module in (eeg_filter, eeg_events, eeg_psd, eeg_interp):
+        module.clear_cache()
+    eeg_ica._pca_cache.clear()
+    gc.collect()
+
+
+def measure(run, args, repeat=3):
+    """Times of ``repeat`` runs over all subjects + the peak traced memory."""
+    times = []
+    for _ in range(repeat):
+        # in-place stages get fresh copies every run (not timed)
+        these = [tuple(a.copy() if isinstance(a, mne.io.BaseRaw) else a
+                       for a in subject) for subject in args]
+        _cold()
+        t0 = time.perf_counter()
+        for subject in these:
+            run(*subject)
+        times.append(time.perf_counter() - t0)
+    these = [tuple(a.copy() if isinstance(a, mne.io.BaseRaw) else a
+                   for a in subject) for subject in args]
+    _cold()
+    tracemalloc.start()
+    for subject in these:
+        run(*subject)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return dict(times=times, best=min(times), median=float(np.median(times)),
+                peak_mb=peak / 2. ** 20)
+
+
+def run_case(case, stages, repeat=3, verbose=True):
+    results = []
+    for name, impl, params, setup, run in stages:
+        res = dict(case.size, source=case.source, stage=name, impl=impl,
+                   params=params)
+        try:
+            args = [setup(case, i) for i in range(case.size['n_subjects'])]
+            res.update(measure(run, args, repeat))
+        except Skip as exc:
+            res['skipped'] = str(exc)
+        except Exception as exc:
+            res['error'] = repr(exc)
+        results.append(res)
+        if verbose:
+            print(_format(res))
+    return results
+
+
+def _format(res):
+    what = '{stage:<20} {impl:<15} {duration:>6.0f} s {n_channels:>3} ch ' \
+           '{n_subjects:>2} sub'.format(**res)
+    if res['params'] and res['stage'] == 'ica_fit':
+        what += ' n={}'.format(res['params']['n_components'])
+    if 'best' in res:
+        return '{}  {:9.3f} s  {:8.1f} MB'.format(what, res['best'],
+                                                  res['peak_mb'])
+    return '{}  {}'.format(what, res.get('skipped') or 'ERROR ' + res['error'])
+
+
+def cases(durations, n_channels, n_subjects):
+    """Sizes to run: the first of each, then one axis varied at a time."""
+    base = (durations[0], n_channels[0], n_subjects[0])
+    out = [base]
+    for axis, values in enumerate((durations, n_channels, n_subjects)):
+        for value in values[1:]:
+            size = list(base)
+            size[axis] = value
+            out.append(tuple(size))
+    return out
+
+
+def environment():
+    return dict(python=platform.python_version(), numpy=np.__version__,
+                scipy=scipy.__version__, mne=mne.__version__,
+                machine=platform.machine(), system=platform.system(),
+                node=platform.node(), cpu_count=os.cpu_count(),
+                date=time.strftime('%Y-%m-%dT%H:%M:%S'))
+
+
+def run(out=None, source='synthetic', durations=default_sizes['durations'],
+        n_channels=default_sizes['n_channels'],
+        n_subjects=default_sizes['n_subjects'], stages=None, repeat=3,
+        sfreq=1000., verbose=True):
+    """Every selected stage at every size; written to ``out`` (JSON).
+
+    ``stages`` are glob patterns over stage names (or 'stage:impl').
+    """
+    selected = [s for s in _stage_list()
+                if stages is None or any(fnmatch.fnmatch(s[0], p) or
+                                         fnmatch.fnmatch(s[0] + ':' + s[1], p)
+                                         for p in stages)]
+    report = dict(environment=environment(), repeat=repeat, source=source,
+                  results=[])
+    with mne.utils.use_log_level('error'), warnings.catch_warnings():
+        warnings.simplefilter('ignore')  # convergence etc., not the point here
+        for duration, n_chan, n_sub in cases(durations, n_channels, n_subjects):
+            try:
+                case = Case(source, duration, n_chan, n_sub, sfreq)
+            except Skip as exc:
+                print('{} s, {} channels: {}'.format(duration, n_chan, exc))
+                continue
+            try:
+                report['results'] += run_case(case, selected, repeat, verbose)
+            finally:
+                case.close()
+            if out:  # written after every case, a crash keeps what is done
+                write_results(out, report)
+    return report
+
+
+def write_results(fname, report):
+    tmp = '{}.{}.tmp'.format(fname, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(report, f, indent=1)
+    os.replace(tmp, fname)
+
+
+def _result_key(res):
+    return (res['source'], res['stage'], res['impl'],
+            json.dumps(res['params'], sort_keys=True), res['duration'],
+            res['n_channels'], res['n_subjects'])
+
+
+def compare(old, new, threshold=1.1):
+    """Rows of (key, old best, new best, ratio) for results in both files;
+    prints the ones slower or faster by more than ``threshold``."""
+    if isinstance(old, str):
+        with open(old) as f:
+            old = json.load(f)
+    if isinstance(new, str):
+        with open(new) as f:
+            new = json.load(f)
+    before = {_result_key(r): r for r in old['results'] if 'best' in r}
+    rows = []
+    for res in new['results']:
+        key = _result_key(res)
+        if 'best' not in res or key not in before:
+            continue
+        ratio = res['best'] / before[key]['best']
+        rows.append((key, before[key]['best'], res['best'], ratio))
+        if ratio > threshold or ratio < 1. / threshold:
+            what = '{} {} {:.0f} s {} ch {} sub'.format(*key[1:3] + key[4:])
+            if res['params']:
+                what += ' ' + key[3]
+            print('{:<60} {:9.3f} -> {:9.3f} s  x{:.2f}  {}'.format(
+                what, before[key]['best'], res['best'], ratio,
+                'slower' if ratio > 1 else 'faster'))
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('out', help='results JSON')
+    parser.add_argument('--stages', nargs='*', default=None,
+                        help="glob patterns, e.g. 'read_*' 'ica_fit:eeg_ica'")
+    data = parser.add_mutually_exclusive_group()
+    data.add_argument('--sample', action='store_true',
+                      help='mne sample recording instead of synthetic data')
+    data.add_argument('--bciciv', default=None,
+                      help='directory of the BCICIV 2a GDF files')
+    parser.add_argument('--durations', type=float, nargs='+', default=None)
+    parser.add_argument('--channels', type=int, nargs='+', default=None)
+    parser.add_argument('--subjects', type=int, nargs='+', default=None)
+    parser.add_argument('--sfreq', type=float, default=1000.,
+                        help='of the synthetic recordings')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--quick', action='store_true',
+                        help='one small size, one run per stage')
+    parser.add_argument('--compare', default=None,
+                        help='earlier results JSON to compare against')
+    args = parser.parse_args()
+    sizes = dict(quick_sizes if args.quick else default_sizes)
+    for key, value in (('durations', args.durations),
+                       ('n_channels', args.channels),
+                       ('n_subjects', args.subjects)):
+        if value:
+            sizes[key] = value
+    source = 'sample' if args.sample else args.bciciv or 'synthetic'
+    report = run(args.out, source, stages=args.stages,
+                 repeat=1 if args.quick else args.repeat, sfreq=args.sfreq,
+                 **sizes)
+    if args.compare:
+        compare(args.compare, report)
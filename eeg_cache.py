@@ -0,0 +1,259 @@
+"""
+Memory-mapped raw cache for the BCICIV-2a GDF files.
+
+Every GDF is converted once into ``<name>.dat`` (float32, channels x times,
+C order) with three sidecars: ``<name>-info.fif``, ``<name>-annot.fif`` and
+``<name>.json`` (shape, sfreq, source mtime/hash). Opening a cached subject
+only maps the file, so slicing channels or time ranges is zero-copy.
+
+    python eeg_cache.py C:/Users/lykoi/Desktop/BCICIV_2a_gdf ./cache
+"""
+
+import os
+import sys
+import json
+import glob
+import hashlib
+
+import numpy as np
+import mne
+
+import eeg_float32
+
+# channel types & names for BCICIV-2a, applied once at import time
+eog_channels = {'EOG-left': 'eog', 'EOG-central': 'eog', 'EOG-right': 'eog'}
+channel_renaming_dict = {'EEG-0': 'EEG-FC3', 'EEG-1': 'EEG-FC1', 'EEG-2': 'EEG-FCz', 'EEG-3': 'EEG-FC2', 'EEG-4': 'EEG-FC4',
+                         'EEG-5': 'EEG-C5', 'EEG-6': 'EEG-C1', 'EEG-7': 'EEG-C2', 'EEG-8': 'EEG-C6',
+                         'EEG-9': 'EEG-CP3', 'EEG-10': 'EEG-CP1', 'EEG-11': 'EEG-CPz', 'EEG-12': 'EEG-CP2', 'EEG-13': 'EEG-CP4',
+                         'EEG-14': 'EEG-P1', 'EEG-15': 'EEG-P2', 'EEG-16': 'EEG-POz'}
+
+dtype = np.float32
+block_size = 100000  # samples converted at a time, keeps the import itself small
+
+
+def file_hash(fname, block=1 << 20):
+    """sha1 of a file, read in blocks."""
+    h = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(block), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def cache_paths(cache_dir, name):
+    base = os.path.join(cache_dir, name)
+    return dict(data=base + '.dat', info=base + '-info.fif',
+                annot=base + '-annot.fif', meta=base + '.json')
+
+
+def read_meta(cache_dir, name):
+    paths = cache_paths(cache_dir, name)
+    if not all(os.path.exists(p) for p in paths.values()):
+        return None
+    with open(paths['meta']) as f:
+        return json.load(f)
+
+
+def _write_meta(fname, meta):
+    # write then rename, so a crashed import never leaves a valid-looking entry
+    with open(fname + '.tmp', 'w') as f:
+        json.dump(meta, f, indent=1)
+    os.replace(fname + '.tmp', fname)
+
+
+def is_fresh(src_fname, cache_dir, name=None):
+    """True if the cache entry for ``src_fname`` is up to date.
+
+    Same mtime -> fresh without reading the source. A changed mtime with an
+    unchanged hash (copied/touched file) is fresh too; the new mtime is stored.
+    """
+    name = name or os.path.splitext(os.path.basename(src_fname))[0]
+    meta = read_meta(cache_dir, name)
+    if meta is None:
+        return False
+    mtime = os.path.getmtime(src_fname)
+    if meta['src_mtime'] == mtime:
+        return True
+    if meta['src_sha1'] != file_hash(src_fname):
+        return False
+    meta['src_mtime'] = mtime
+    _write_meta(cache_paths(cache_dir, name)['meta'], meta)
+    return True
+
+
+def fix_channels(raw):
+    """EOG typing and 10-20 renaming for BCICIV-2a, in place."""
+    raw.set_channel_types({ch: kind for ch, kind in eog_channels.items()
+                           if ch in raw.ch_names})
+    raw.rename_channels({old: new for old, new in channel_renaming_dict.items()
+                         if old in raw.ch_names})
+    return raw
+
+
+def create_data(cache_dir, name, shape):
+    """New (writable) data memmap for a cache entry."""
+    os.makedirs(cache_dir, exist_ok=True)
+    return np.memmap(cache_paths(cache_dir, name)['data'], dtype=dtype,
+                     mode='w+', shape=tuple(int(n) for n in shape))
+
+
+def write_sidecars(cache_dir, name, info, annotations, shape, first_samp=0,
+                   src_fname=None):
+    """info/annotations/json next to an already written ``<name>.dat``."""
+    paths = cache_paths(cache_dir, name)
+    if os.path.exists(paths['info']):
+        os.remove(paths['info'])
+    mne.io.write_info(paths['info'], info)
+    annotations.save(paths['annot'], overwrite=True)
+
+    meta = dict(shape=[int(n) for n in shape], dtype=np.dtype(dtype).str,
+                sfreq=float(info['sfreq']), first_samp=int(first_samp),
+                ch_names=info['ch_names'])
+    if src_fname is not None:
+        meta.update(src=os.path.abspath(src_fname),
+                    src_mtime=os.path.getmtime(src_fname),
+                    src_sha1=file_hash(src_fname))
+    _write_meta(paths['meta'], meta)
+
+
+def write_cache(raw, cache_dir, name, src_fname=None):
+    """Write any (not necessarily preloaded) Raw into the cache."""
+    n_chan, n_times = len(raw.ch_names), int(raw.n_times)
+    data = create_data(cache_dir, name, (n_chan, n_times))
+    for start in range(0, n_times, block_size):
+        stop = min(start + block_size, n_times)
+        data[:, start:stop] = raw.get_data(start=start, stop=stop)
+    data.flush()
+    del data
+    write_sidecars(cache_dir, name, raw.info, raw.annotations,
+                   (n_chan, n_times), raw.first_samp, src_fname=src_fname)
+    import eeg_pyramid  # min/max levels for browsing, see eeg_pyramid.py
+    eeg_pyramid.build_pyramid(CachedRaw(cache_dir, name), force=True)
+    return cache_paths(cache_dir, name)['data']
+
+
+def import_gdf(src_fname, cache_dir, force=False):
+    """Convert one GDF into the cache; returns (name, converted)."""
+    name = os.path.splitext(os.path.basename(src_fname))[0]
+    if not force and is_fresh(src_fname, cache_dir, name):
+        return name, False
+    raw = mne.io.read_raw_gdf(src_fname, preload=False, verbose=False)
+    fix_channels(raw)
+    write_cache(raw, cache_dir, name, src_fname=src_fname)
+    return name, True
+
+
+def cache_raw(src_fname, cache_dir, name=None, force=False):
+    """Any file mne can read, cached once; returns the CachedRaw."""
+    name = name or os.path.splitext(os.path.basename(src_fname))[0]
+    if force or not is_fresh(src_fname, cache_dir, name):
+        raw = mne.io.read_raw(src_fname, preload=False, verbose=False)
+        write_cache(raw, cache_dir, name, src_fname=src_fname)
+    return CachedRaw(cache_dir, name)
+
+
+def import_dir(src_dir, cache_dir, pattern='*.gdf', force=False):
+    """Convert every GDF in ``src_dir``; unchanged files are skipped."""
+    names = []
+    for fname in sorted(glob.glob(os.path.join(src_dir, pattern))):
+        name, converted = import_gdf(fname, cache_dir, force=force)
+        print('{:<10} {}'.format(name, 'converted' if converted else 'up to date'))
+        names.append(name)
+    return names
+
+
+class CachedRaw(object):
+    """A cached recording: ``data`` is a read-only float32 memmap.
+
+    ``get_data`` returns views (no copy) for slices; use ``to_raw`` when an
+    mne.io.Raw is needed (that one copies into float64).
+    """
+
+    def __init__(self, cache_dir, name, mode='r'):
+        paths = cache_paths(cache_dir, name)
+        self.cache_dir = cache_dir
+        self.name = name
+        self.mode = mode
+        self.meta = read_meta(cache_dir, name)
+        if self.meta is None:
+            raise FileNotFoundError('{} is not in cache {}'.format(name, cache_dir))
+        self.data = np.memmap(paths['data'], dtype=np.dtype(self.meta['dtype']),
+                              mode=mode, shape=tuple(self.meta['shape']))
+        self._paths = paths
+        self._info = None
+        self._annotations = None
+
+    def __reduce__(self):
+        # worker processes re-open the map instead of getting the data pickled
+        return CachedRaw, (self.cache_dir, self.name, self.mode)
+
+    # info/annotations are read on first use, opening is just the mmap
+    @property
+    def info(self):
+        if self._info is None:
+            self._info = mne.io.read_info(self._paths['info'], verbose=False)
+        return self._info
+
+    @property
+    def annotations(self):
+        if self._annotations is None:
+            self._annotations = mne.read_annotations(self._paths['annot'])
+        return self._annotations
+
+    @property
+    def ch_names(self):
+        return self.meta['ch_names']
+
+    @property
+    def sfreq(self):
+        return self.meta['sfreq']
+
+    @property
+    def first_samp(self):
+        return self.meta['first_samp']
+
+    @property
+    def n_times(self):
+        return self.meta['shape'][1]
+
+    def time_as_index(self, t):
+        return int(round(t * self.sfreq))
+
+    def get_data(self, picks=None, start=0, stop=None):
+        """Zero-copy for ``picks`` None or a slice; a list of picks copies."""
+        if isinstance(picks, str):
+            picks = [picks]
+        if picks is None:
+            picks = slice(None)
+        elif not isinstance(picks, slice):
+            picks = [self.ch_names.index(p) if isinstance(p, str) else p
+                     for p in picks]
+        return self.data[picks, start:stop]
+
+    def to_raw(self, tmin=0., tmax=None, dtype=np.float64):
+        """Preloaded mne Raw of [tmin, tmax]; float32 keeps the cache's
+        precision without a float64 copy (see eeg_float32)."""
+        start = self.time_as_index(tmin)
+        stop = None if tmax is None else self.time_as_index(tmax) + 1
+        raw = eeg_float32.raw_array(np.array(self.data[:, start:stop], dtype=dtype),
+                                    self.info.copy(),
+                                    first_samp=self.first_samp + start)
+        annotations = self.annotations.copy()
+        if annotations.orig_time is None:  # onsets are relative to the first sample
+            annotations.onset -= start / self.sfreq
+        raw.set_annotations(annotations)
+        return raw
+
+    def __repr__(self):
+        return '<CachedRaw {} | {} ch x {} samples, {} Hz>'.format(
+            self.name, len(self.ch_names), self.n_times, self.sfreq)
+
+
+def open_cached(cache_dir, name):
+    return CachedRaw(cache_dir, name)
+
+
+if __name__ == '__main__':
+    src_dir = sys.argv[1] if len(sys.argv) > 1 else 'C:/Users/lykoi/Desktop/BCICIV_2a_gdf'
+    cache_dir = sys.argv[2] if len(sys.argv) > 2 else os.path.join(src_dir, 'cache')
+    import_dir(src_dir, cache_dir)
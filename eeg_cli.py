@@ -0,0 +1,419 @@
+"""
+One command line for the preprocessing stages, quick to start.
+
+    python eeg_cli.py import C:/Users/lykoi/Desktop/BCICIV_2a_gdf ./cache
+    python eeg_cli.py filter out sub-01_raw.fif sub-02_raw.fif --workers 4
+    python eeg_cli.py events out/sub-01_preproc_raw.fif -o sub-01-eve.fif
+    python eeg_cli.py ica out/sub-01_preproc_raw.fif -o sub-01-ica.fif --classify
+    python eeg_cli.py epoch out/sub-01_preproc_raw.fif sub-01-eve.fif \\
+        -o sub-01-epo.fif --event-id auditory=1 visual=3 --reject eeg=150e-6
+    python eeg_cli.py autoreject sub-01-epo.fif --store study2-epo.h5
+    python eeg_cli.py report qc out/*_preproc_raw.fif
+
+Only the standard library is imported until a subcommand is picked; the
+subcommand then imports the eeg_* modules it needs (``imports``) and nothing
+else, so an event dump does not load ICA, scikit-learn or matplotlib.
+Plotting is only imported by ``report`` (and ``filter --report``), and
+MPLBACKEND defaults to Agg so no batch job touches Qt. ``--timing`` prints
+when a run was ready to work, and
+
+    python eeg_cli.py startup                 # --imports-only: no dry runs
+
+starts every subcommand in a fresh interpreter, as a cluster job would, and
+exits with 1 if one takes longer than its ``budgets`` entry or loads a
+package of ``heavy`` it has no use for, on import or while running: each
+subcommand is also dry-run on a small recording (``fixtures``) to catch
+imports inside the functions it calls.
+"""
+
+import os
+import sys
+import time
+import argparse
+import importlib
+import subprocess
+
+_t0 = time.perf_counter()
+
+# eeg_* modules each subcommand imports before it runs
+imports = {
+    'import': ['eeg_cache'],
+    'filter': ['eeg_runner'],
+    'events': ['eeg_events'],
+    'ica': ['eeg_filter', 'eeg_ica'],
+    'epoch': ['eeg_epochs'],
+    'autoreject': ['eeg_autoreject'],
+    'report': ['eeg_report'],
+}
+# s from interpreter start until a subcommand is ready (warm file cache)
+budgets = {'import': 0.5, 'filter': 1., 'events': 0.5, 'ica': 2.5,
+           'epoch': 0.5, 'autoreject': 4., 'report': 1.5}
+# packages no subcommand may load unless ``allowed`` for it
+heavy = ('matplotlib', 'PyQt5', 'sklearn', 'autoreject', 'openneuro')
+allowed = {'report': ('matplotlib',), 'autoreject': ('sklearn', 'autoreject'),
+           'ica': ('sklearn',)}  # mne's FastICA when n_jobs is not given
+
+
+def load(command):
+    """Import the modules of ``command``; returns the seconds it took."""
+    t0 = time.perf_counter()
+    for name in imports[command]:
+        importlib.import_module(name)
+    return time.perf_counter() - t0
+
+
+# #### startup budget ####
+
+_probe = ('import sys, eeg_cli; eeg_cli.{}; print("heavy:", '
+          '" ".join(p for p in eeg_cli.heavy if p in sys.modules))')
+# caches the dry runs write to, redirected into their scratch folder
+_cache_vars = ('EEG_DECODING_CACHE', 'EEG_EVENTS_CACHE', 'EEG_FILTER_CACHE',
+               'EEG_ICA_CACHE', 'EEG_PIPELINE_CACHE', 'EEG_PSD_CACHE')
+
+
+def _run_probe(call, env):
+    # (s, heavy packages loaded) of ``call`` in a fresh interpreter
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, MPLBACKEND=os.environ.get('MPLBACKEND', 'Agg'),
+               **(env or {}))
+    t0 = time.perf_counter()
+    out = subprocess.run([sys.executable, '-c', _probe.format(call)], cwd=here,
+                         env=env, capture_output=True, text=True, check=True)
+    seconds = time.perf_counter() - t0
+    line = [l for l in out.stdout.splitlines() if l.startswith('heavy:')][-1]
+    return seconds, line.split()[1:]
+
+
+def measure(command, repeat=3):
+    """(s, heavy packages loaded) to start ``command`` in a fresh
+    interpreter, interpreter start included; the fastest of ``repeat``."""
+    runs = [_run_probe('load({!r})'.format(command), None)
+            for _ in range(repeat)]
+    return min(s for s, _ in runs), runs[-1][1]
+
+
+def fixtures(folder):
+    """Small inputs for ``dry_run`` in ``folder``: 60 s of 16 EEG channels
+    (biosemi16 positions), EOG and a stim channel, its events and epochs."""
+    import numpy as np
+    import mne
+
+    montage = mne.channels.make_standard_montage('biosemi16')
+    names = montage.ch_names
+    info = mne.create_info(names + ['EOG', 'STI 014'], 250.,
+                           ['eeg'] * len(names) + ['eog', 'stim'])
+    data = np.random.RandomState(0).randn(len(names) + 2, 250 * 60) * 1e-5
+    data[-1] = 0.
+    onsets = np.arange(250, data.shape[1] - 250, 250)
+    data[-1, onsets] = 1 + np.arange(len(onsets)) % 2
+    raw = mne.io.RawArray(data, info, verbose=False)
+    raw.set_montage(montage)
+    fx = dict(dir=folder, raw=os.path.join(folder, 'probe_raw.fif'),
+              events=os.path.join(folder, 'probe-eve.fif'),
+              epochs=os.path.join(folder, 'probe-epo.fif'))
+    raw.save(fx['raw'], overwrite=True, verbose=False)
+    events = mne.find_events(raw, verbose=False)
+    mne.write_events(fx['events'], events, overwrite=True, verbose=False)
+    mne.Epochs(raw, events, tmin=-0.2, tmax=0.5, preload=True,
+               verbose=False).save(fx['epochs'], overwrite=True, verbose=False)
+    return fx
+
+
+def dry_run(command, fx):
+    """Run ``command`` on the ``fixtures`` in this process, pools aside, so
+    everything it imports while working ends up in sys.modules."""
+    out = lambda name: os.path.join(fx['dir'], name)  # noqa: E731
+    if command == 'import':  # import_gdf without the GDF reader
+        import eeg_cache
+
+        eeg_cache.cache_raw(fx['raw'], out('cache'), force=True)
+    elif command == 'filter':  # one subject, as in a worker
+        import eeg_runner
+
+        eeg_runner.run_one(fx['raw'], dict(eeg_runner.study1_spec,
+                                           notch_freqs=None, sfreq=125.),
+                           fx['dir'])
+    else:
+        argv = dict(
+            events=['events', fx['raw'], '-o', out('out-eve.fif')],
+            ica=['ica', fx['raw'], '-o', out('out-ica.fif'),
+                 '--n-components', '5'],
+            epoch=['epoch', fx['raw'], fx['events'], '-o', out('out-epo.fif'),
+                   '--event-id', 'a=1', 'b=2', '--reject', 'eeg=1e-3'],
+            autoreject=['autoreject', fx['epochs'], '--n-interpolate', '1',
+                        '--n-jobs', '1', '--store', out('out-epo.h5')],
+            report=['report', out('qc'), fx['raw'], '--workers', '1'],
+        )[command]
+        main(argv)
+
+
+def startup_report(commands=None, repeat=3, run=True):
+    """dict(command, seconds, budget, extra, ok) per subcommand; ``extra``
+    are the heavy packages it has no use for, loaded on import or, with
+    ``run``, during a ``dry_run``."""
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as folder:
+        fx = fixtures(folder) if run else None
+        env = {name: os.path.join(folder, 'caches') for name in _cache_vars}
+        rows = []
+        for command in commands or list(imports):
+            seconds, loaded = measure(command, repeat)
+            if run:
+                loaded = loaded + _run_probe(
+                    'dry_run({!r}, {!r})'.format(command, fx), env)[1]
+            extra = sorted(set(p for p in loaded
+                               if p not in allowed.get(command, ())))
+            rows.append(dict(command=command, seconds=seconds,
+                             budget=budgets[command], extra=extra,
+                             ok=seconds <= budgets[command] and not extra))
+    return rows
+
+
+def format_startup(rows):
+    lines = []
+    for row in rows:
+        lines.append('{:<11} {:6.2f} s  (budget {:.2f} s){}{}'.format(
+            row['command'], row['seconds'], row['budget'],
+            '' if row['seconds'] <= row['budget'] else '  OVER BUDGET',
+            '  loads ' + ', '.join(row['extra']) if row['extra'] else ''))
+    return '\n'.join(lines)
+
+
+# #### subcommands ####
+
+def _import(args):
+    import eeg_cache
+
+    eeg_cache.import_dir(args.src_dir, args.cache_dir, args.pattern, args.force)
+
+
+def _filter(args):
+    import eeg_runner
+
+    spec = dict(l_freq=args.l_freq, notch_freqs=args.notch,
+                notch_method=args.notch_method, sfreq=args.sfreq)
+    spec = {k: v for k, v in spec.items() if v is not None}  # else study1_spec
+    spec.update(notch_track=args.notch_track, stream=args.stream)
+    profile = None
+    if args.profile:
+        profile = dict(log=args.profile, sample=args.profile_stacks)
+    report = eeg_runner.run(args.fnames, spec, args.out_dir,
+                            n_workers=args.workers, max_mem=args.max_mem,
+                            report_dir=args.report, profile=profile)
+    return 1 if report['n_failed'] else 0
+
+
+def _events(args):
+    import mne
+    import eeg_events
+
+    # not preloaded: only the stim channel is read
+    raw = mne.io.read_raw(args.fname, verbose=False)
+    table = eeg_events.find_events(raw, args.stim)
+    for code, n in table.count().items():
+        print('{:>6} {:6d}'.format(code, n))
+    if args.out:
+        mne.write_events(args.out, table.events, overwrite=True, verbose=False)
+
+
+def _ica(args):
+    import mne
+    import eeg_filter
+    import eeg_ica
+
+    raw = mne.io.read_raw(args.fname, preload=True, verbose=False)
+    if args.l_freq:
+        raw = eeg_filter.filter_raw(raw, l_freq=args.l_freq)
+    ica = eeg_ica.fit_ica(raw, n_components=args.n_components,
+                          random_state=args.random_state, max_iter=args.max_iter,
+                          n_jobs=args.n_jobs)
+    if args.classify:
+        import eeg_artifacts  # EOG/ECG scoring, like the study2 'ica' stage
+
+        found = eeg_artifacts.classify(raw, ica)
+        print(eeg_artifacts.summary(found, os.path.basename(args.fname)))
+    ica.save(args.out, overwrite=True, verbose=False)
+
+
+def _epoch(args):
+    import mne
+    import eeg_epochs
+
+    raw = mne.io.read_raw(args.fname, verbose=False)  # read epoch by epoch
+    epochs = eeg_epochs.make_epochs(
+        raw, mne.read_events(args.events),
+        dict(args.event_id) if args.event_id else None, tmin=args.tmin,
+        tmax=args.tmax, baseline=None if args.no_baseline else (None, 0),
+        reject=dict(args.reject) if args.reject else None,
+        flat=dict(args.flat) if args.flat else None)
+    print(epochs)
+    epochs.save(args.out, overwrite=True, verbose=False)
+
+
+def _autoreject(args):
+    import mne
+    import eeg_autoreject
+
+    epochs = mne.read_epochs(args.fname, preload=True, verbose=False)
+    ar = eeg_autoreject.fit_autoreject(epochs, n_interpolate=args.n_interpolate,
+                                       random_state=args.random_state,
+                                       n_jobs=args.n_jobs)
+    cleaned, reject_log = ar.transform(epochs, return_log=True)
+    print('{}: {} of {} epochs rejected'.format(
+        args.fname, int(reject_log.bad_epochs.sum()), len(epochs)))
+    if args.out:
+        cleaned.save(args.out, overwrite=True, verbose=False)
+    if args.store:
+        import eeg_store
+
+        subject = args.subject or os.path.basename(args.fname)
+        for ext in ('-epo.fif', '_epo.fif', '.fif'):
+            if subject.endswith(ext):
+                subject = subject[:-len(ext)]
+                break
+        eeg_store.EpochsStore(args.store).write(subject, cleaned, reject_log,
+                                                overwrite=True)
+
+
+def _report(args):
+    import eeg_report
+
+    report = eeg_report.Report(args.out_dir, title=args.title)
+    for fname in args.fnames:
+        eeg_report.add_raw_qc(report, os.path.basename(fname), fname,
+                              duration=args.duration)
+    return 1 if report.build(n_jobs=args.workers)['n_failed'] else 0
+
+
+def _startup(args):
+    rows = startup_report(args.commands, args.repeat, not args.imports_only)
+    print(format_startup(rows))
+    return 0 if all(row['ok'] for row in rows) else 1
+
+
+def _pair(cast):
+    # 'name=value' -> (name, cast(value)), for --event-id / --reject / --flat
+    def parse(text):
+        name, _, value = text.rpartition('=')
+        if not name:
+            raise argparse.ArgumentTypeError(
+                'expected name=value, got {!r}'.format(text))
+        return name, cast(value)
+    return parse
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--timing', action='store_true',
+                        help='print the startup time to stderr')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('import', help='convert GDF files into the raw cache')
+    p.add_argument('src_dir')
+    p.add_argument('cache_dir')
+    p.add_argument('--pattern', default='*.gdf')
+    p.add_argument('--force', action='store_true')
+    p.set_defaults(func=_import)
+
+    p = sub.add_parser('filter', help='study1 filter chain (eeg_runner.py)')
+    p.add_argument('out_dir')
+    p.add_argument('fnames', nargs='+')
+    p.add_argument('--workers', type=int, default=None)
+    p.add_argument('--max-mem', default=None, help="per worker, e.g. '4G'")
+    p.add_argument('--l-freq', type=float, default=None)
+    p.add_argument('--notch', type=float, nargs='*', default=None)
+    p.add_argument('--notch-method', default=None)
+    p.add_argument('--notch-track', action='store_true')
+    p.add_argument('--sfreq', type=float, default=None)
+    p.add_argument('--stream', action='store_true')
+    p.add_argument('--report', default=None, help='QC report directory')
+    p.add_argument('--profile', default=None, help='JSON lines of step timings')
+    p.add_argument('--profile-stacks', action='store_true')
+    p.set_defaults(func=_filter)
+
+    p = sub.add_parser('events', help='find events, print counts per code')
+    p.add_argument('fname')
+    p.add_argument('--stim', default=None, help='stim channel')
+    p.add_argument('-o', '--out', default=None, help='-eve.fif to write')
+    p.set_defaults(func=_events)
+
+    p = sub.add_parser('ica', help='fit an ICA (cached, see eeg_ica.py)')
+    p.add_argument('fname')
+    p.add_argument('-o', '--out', required=True, help='-ica.fif to write')
+    p.add_argument('--l-freq', type=float, default=1.,
+                   help='high-pass before the fit (0: none)')
+    p.add_argument('--n-components', type=int, default=20)
+    p.add_argument('--random-state', type=int, default=97)
+    p.add_argument('--max-iter', type=int, default=800)
+    p.add_argument('--n-jobs', type=int, default=None)
+    p.add_argument('--classify', action='store_true',
+                   help='exclude the EOG/ECG components')
+    p.set_defaults(func=_ica)
+
+    p = sub.add_parser('epoch', help='epochs of a raw and an events file')
+    p.add_argument('fname')
+    p.add_argument('events')
+    p.add_argument('-o', '--out', required=True, help='-epo.fif to write')
+    p.add_argument('--event-id', nargs='+', type=_pair(int), default=None,
+                   metavar='NAME=CODE')
+    p.add_argument('--tmin', type=float, default=-0.2)
+    p.add_argument('--tmax', type=float, default=0.5)
+    p.add_argument('--no-baseline', action='store_true')
+    p.add_argument('--reject', nargs='+', type=_pair(float), default=None,
+                   metavar='TYPE=PTP')
+    p.add_argument('--flat', nargs='+', type=_pair(float), default=None,
+                   metavar='TYPE=PTP')
+    p.set_defaults(func=_epoch)
+
+    p = sub.add_parser('autoreject', help='clean epochs with autoreject')
+    p.add_argument('fname')
+    p.add_argument('-o', '--out', default=None, help='-epo.fif to write')
+    p.add_argument('--store', default=None,
+                   help='eeg_store HDF5 file to add the epochs to')
+    p.add_argument('--subject', default=None,
+                   help='name in the store (default: the file name '
+                        'without -epo.fif)')
+    p.add_argument('--n-interpolate', type=int, nargs='+', default=None,
+                   help="default: autoreject's [1, 4, min(n_channels - 1, 32)]")
+    p.add_argument('--random-state', type=int, default=None)
+    p.add_argument('--n-jobs', type=int, default=None)
+    p.set_defaults(func=_autoreject)
+
+    p = sub.add_parser('report', help='headless raw QC report (PNG/HTML)')
+    p.add_argument('out_dir')
+    p.add_argument('fnames', nargs='+')
+    p.add_argument('--title', default='QC report')
+    p.add_argument('--duration', type=float, default=60.)
+    p.add_argument('--workers', type=int, default=None)
+    p.set_defaults(func=_report)
+
+    p = sub.add_parser('startup', help='check the startup time budgets')
+    p.add_argument('commands', nargs='*', metavar='command',
+                   help='subcommands to check (default: all)')
+    p.add_argument('--repeat', type=int, default=3)
+    p.add_argument('--imports-only', action='store_true',
+                   help='skip the dry runs on small fixtures')
+    p.set_defaults(func=_startup)
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.command == 'autoreject' and not (args.out or args.store):
+        parser.error('autoreject needs --out and/or --store')
+    if args.command == 'startup':
+        unknown = [c for c in args.commands if c not in imports]
+        if unknown:
+            parser.error('unknown subcommand(s) {}'.format(unknown))
+    os.environ.setdefault('MPLBACKEND', 'Agg')  # never a Qt window in a job
+    seconds = load(args.command) if args.command in imports else 0.
+    if args.timing:
+        sys.stderr.write('{}: ready after {:.2f} s (imports {:.2f} s)\n'.format(
+            args.command, time.perf_counter() - _t0, seconds))
+    return args.func(args) or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
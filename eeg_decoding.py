@@ -0,0 +1,345 @@
+"""
+Cross-validated CSP + LDA decoding from per-epoch covariances, computed once.
+
+``cross_val_score(Pipeline([('CSP', CSP()), ('LDA', LDA())]), X, y, cv=cv)``
+re-estimates the class covariances from the full epochs in every fold and
+projects every epoch again for the features. Both only depend on the
+per-epoch covariances of the band-passed data:
+
+- ``covariances`` filters the epochs once (a block of epochs at a time) and
+  keeps, per epoch, the (n_ch, n_ch) second-moment matrix and the channel
+  means; they are cached like the PSDs (see ``cache_dir``),
+- a fold fits the CSP filters on the class covariances of its training
+  epochs (sums of the per-epoch matrices) and the log-power features are
+  ``diag(W C_e W.T)``: a few (n_ch x n_ch) products instead of passes over
+  the data.
+
+The filters and features are those of mne.decoding.CSP (cov_est='concat',
+log power) for two classes. Subjects and folds run in a process pool; the
+workers read BCICIV cache entries themselves (an eeg_cache.CachedRaw pickles
+as its file name):
+
+    subjects = {name: eeg_cache.open_cached(cache_folder, name)
+                for name in ['A0{}T'.format(i) for i in range(1, 10)]}
+    results = eeg_decoding.evaluate(subjects, n_splits=10)
+
+or from the command line
+
+    python eeg_decoding.py cache_folder A01T A02T A03T --splits 10
+"""
+
+import os
+import time
+import hashlib
+import argparse
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy import linalg
+import mne
+
+import eeg_cache
+import eeg_epochs
+import eeg_events
+import eeg_ica
+
+# set to None to keep the cache in memory only
+cache_dir = os.environ.get('EEG_DECODING_CACHE', os.path.join(
+    os.path.expanduser('~'), '.cache', 'eeg_decoding'))
+max_cached = 16  # subjects' covariances kept in memory (LRU)
+chunk_epochs = 64  # epochs band-passed at a time
+
+_cache = OrderedDict()
+_stats = dict(hits=0, disk_hits=0, misses=0)
+
+# left vs right hand imagery of BCICIV-2a, 1-2 s after the cue, 7-30 Hz
+# (the window of the mne CSP example); ``pad`` s on each side are filtered
+# and then cut off, so the filter edges stay out of the covariances. None is
+# half the length of mne's default band-pass kernel (``filter_pad``: 0.83 s
+# for 7-30 Hz, the 7 Hz high-pass is the long one)
+motor_imagery = dict(event_id={'769': 1, '770': 2}, tmin=1., tmax=2.,
+                     l_freq=7., h_freq=30., pad=None)
+
+
+def cache_info():
+    return dict(_stats, size=len(_cache), max_size=max_cached)
+
+
+def clear_cache(disk=False):
+    _cache.clear()
+    for k in _stats:
+        _stats[k] = 0
+    if disk and cache_dir and os.path.isdir(cache_dir):
+        for fname in os.listdir(cache_dir):
+            if fname.endswith('-cov.npz'):
+                os.remove(os.path.join(cache_dir, fname))
+
+
+def _lookup(key):
+    if key in _cache:
+        _cache.move_to_end(key)
+        _stats['hits'] += 1
+        return _cache[key]
+    fname = cache_dir and os.path.join(cache_dir, key + '-cov.npz')
+    if fname and os.path.exists(fname):
+        with np.load(fname) as f:
+            state = {k: f[k] for k in f.files}
+        _stats['disk_hits'] += 1
+        _remember(key, state)
+        return state
+    return None
+
+
+def _remember(key, state, save=False):
+    _cache[key] = state
+    while len(_cache) > max_cached:
+        _cache.popitem(last=False)
+    if save and cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        fname = os.path.join(cache_dir, key + '-cov.npz')
+        tmp = '{}.{}.tmp.npz'.format(fname[:-4], os.getpid())
+        np.savez(tmp, **state)
+        os.replace(tmp, fname)
+
+
+# #### covariances ####
+
+def epoch_covariances(X):
+    """(cov, mean) of (n_epochs, n_ch, n_times) data: per epoch X X.T / n_times
+    and the channel means."""
+    X = np.asarray(X, dtype=np.float64)
+    return np.matmul(X, X.transpose(0, 2, 1)) / X.shape[-1], X.mean(axis=-1)
+
+
+def covariances(epochs, l_freq=None, h_freq=None, tmin=None, tmax=None,
+                data_key=None):
+    """Per-epoch covariances of band-passed ``epochs``, cached.
+
+    ``epochs`` are mne Epochs or eeg_epochs.LazyEpochs (read a block at a
+    time). They are filtered with mne's defaults (like epochs.filter) and
+    cropped to [tmin, tmax] afterwards. ``data_key`` can be passed to skip
+    hashing the data. Returns dict(cov=(n_epochs, n_ch, n_ch),
+    mean=(n_epochs, n_ch), y=event codes).
+    """
+    data_key = data_key or eeg_ica.data_hash(epochs)
+    key = hashlib.sha1((data_key + repr((l_freq, h_freq, tmin, tmax))).encode()
+                       ).hexdigest()
+    state = _lookup(key)
+    if state is not None:
+        return state
+    _stats['misses'] += 1
+    sfreq, times = epochs.info['sfreq'], epochs.times
+    start = 0 if tmin is None else int(np.searchsorted(times, tmin - 0.5 / sfreq))
+    stop = len(times) if tmax is None else \
+        int(np.searchsorted(times, tmax + 0.5 / sfreq))
+    cov, mean = [], []
+    for first in range(0, len(epochs), chunk_epochs):
+        X = epochs.get_data(item=slice(first, first + chunk_epochs))
+        if l_freq is not None or h_freq is not None:
+            X = mne.filter.filter_data(X.astype(np.float64, copy=False), sfreq,
+                                       l_freq, h_freq, verbose=False)
+        this_cov, this_mean = epoch_covariances(X[..., start:stop])
+        cov.append(this_cov)
+        mean.append(this_mean)
+    state = dict(cov=np.concatenate(cov), mean=np.concatenate(mean),
+                 y=epochs.events[:, 2].copy())
+    _remember(key, state, save=True)
+    return state
+
+
+def filter_pad(sfreq, l_freq, h_freq):
+    """Half the length (s) of mne's default FIR kernel for the band, plus a
+    sample: what has to be filtered on each side of a window so that no
+    output sample in it depends on the (padded) edges."""
+    if l_freq is None and h_freq is None:
+        return 0.
+    h = mne.filter.create_filter(None, sfreq, l_freq, h_freq, verbose=False)
+    return (len(h) // 2 + 1) / sfreq
+
+
+def subject_covariances(raw, event_id=None, tmin=1., tmax=2., l_freq=7.,
+                        h_freq=30., pad=None, picks=None):
+    """``covariances`` of the cue epochs of a BCICIV recording (an
+    eeg_cache.CachedRaw or preloaded Raw), EEG channels by default.
+
+    ``event_id`` maps annotation descriptions to codes; ``pad`` defaults to
+    ``filter_pad``. A CachedRaw is keyed by its file, so a cached result is
+    found without reading the data.
+    """
+    event_id = event_id or motor_imagery['event_id']
+    if pad is None:
+        pad = filter_pad(raw.info['sfreq'], l_freq, h_freq)
+    events = eeg_events.from_annotations(raw, event_id=event_id).events
+    if picks is None:
+        picks = mne.pick_types(raw.info, meg=False, eeg=True)
+    epochs = eeg_epochs.LazyEpochs(raw, events, tmin=tmin - pad,
+                                   tmax=tmax + pad, baseline=None, picks=picks)
+    if isinstance(raw, eeg_cache.CachedRaw):
+        fname = os.path.abspath(raw.data.filename)
+        source = (fname, os.path.getmtime(fname))
+    else:
+        source = eeg_ica.data_hash(raw)
+    data_key = hashlib.sha1(repr((source, tmin - pad, tmax + pad, list(picks))
+                                 ).encode() + events.tobytes()).hexdigest()
+    return covariances(epochs, l_freq, h_freq, tmin, tmax, data_key=data_key)
+
+
+# #### CSP ####
+
+def class_covariances(cov, mean, y, classes):
+    """Covariance of each class's epochs concatenated (mne's 'concat')."""
+    out = []
+    for c in classes:
+        these = y == c
+        mu = mean[these].mean(axis=0)
+        out.append(cov[these].mean(axis=0) - np.outer(mu, mu))
+    return out
+
+
+def csp_filters(cov, mean, y, n_components=4):
+    """(filters, patterns) of two-class CSP, strongest components first."""
+    classes = np.unique(y)
+    if len(classes) != 2:
+        raise ValueError('CSP needs 2 classes, got {}'.format(len(classes)))
+    c0, c1 = class_covariances(cov, mean, y, classes)
+    evals, evecs = linalg.eigh(c0, c0 + c1)
+    order = np.argsort(np.abs(evals - 0.5))[::-1]
+    evecs = evecs[:, order]
+    return evecs[:, :n_components].T, linalg.pinv(evecs)
+
+
+def csp_features(cov, filters):
+    """log mean power of every epoch in the CSP components."""
+    return np.log(np.einsum('kc,ecd,kd->ek', filters, cov, filters))
+
+
+def fold_score(cov, mean, y, train, test, n_components=4):
+    """Accuracy of CSP + LDA trained on ``train``, tested on ``test``."""
+    from sklearn.discriminant_analysis import LinearDiscriminantAnalysis
+
+    filters, _ = csp_filters(cov[train], mean[train], y[train], n_components)
+    features = csp_features(cov, filters)
+    lda = LinearDiscriminantAnalysis().fit(features[train], y[train])
+    return float(lda.score(features[test], y[test]))
+
+
+def cv_splits(y, n_splits=10, test_size=0.2, random_state=42):
+    """(train, test) index pairs of sklearn's ShuffleSplit."""
+    from sklearn.model_selection import ShuffleSplit
+
+    cv = ShuffleSplit(n_splits, test_size=test_size, random_state=random_state)
+    return list(cv.split(np.zeros(len(y))))
+
+
+# #### evaluation ####
+
+def _covariances(source, params, epochs_params):
+    # worker side: covariances (+ the time spent) of one subject; Epochs only
+    # get the band/window asked for explicitly, not motor_imagery's
+    t0 = time.perf_counter()
+    if isinstance(source, dict):
+        state = source
+    elif isinstance(source, mne.BaseEpochs):
+        state = covariances(source, **epochs_params)
+    else:
+        state = subject_covariances(source, **params)
+    return state, time.perf_counter() - t0
+
+
+def _folds(state, splits, n_components):
+    t0 = time.perf_counter()
+    scores = [fold_score(state['cov'], state['mean'], state['y'], train, test,
+                         n_components) for train, test in splits]
+    return scores, time.perf_counter() - t0
+
+
+def evaluate(subjects, n_splits=10, test_size=0.2, n_components=4,
+             random_state=42, n_jobs=None, verbose=True, **params):
+    """Cross-validated CSP + LDA accuracy of every subject.
+
+    ``subjects`` maps a name to an eeg_cache.CachedRaw / Raw (BCICIV, see
+    ``subject_covariances``), band-limited mne Epochs or the output of
+    ``covariances``; ``params`` update ``motor_imagery`` for the raws. Epochs
+    are used as they are: only an l_freq/h_freq/tmin/tmax given in
+    ``params`` filters or crops them. Covariances are
+    computed per subject and the folds per (subject, fold chunk) in a pool
+    of ``n_jobs`` processes (1: in this process). Returns {name: dict(scores,
+    accuracy, std, chance, n_epochs, cov_seconds, cv_seconds)}.
+    """
+    epochs_params = {k: v for k, v in params.items()
+                     if k in ('l_freq', 'h_freq', 'tmin', 'tmax')}
+    params = dict(motor_imagery, **params)
+    names = list(subjects)
+    n_jobs = n_jobs or os.cpu_count()
+    t0 = time.perf_counter()
+    pool = ProcessPoolExecutor(max_workers=n_jobs) if n_jobs > 1 else None
+    try:
+        if pool is None:
+            done = [_covariances(subjects[name], params, epochs_params)
+                    for name in names]
+        else:
+            done = list(pool.map(_covariances, [subjects[n] for n in names],
+                                 [params] * len(names),
+                                 [epochs_params] * len(names)))
+        states = dict(zip(names, done))
+        # folds in chunks, so that every worker gets some of each subject
+        per_chunk = max(n_splits * len(names) // max(n_jobs, 1), 1)
+        tasks = []
+        for name in names:
+            splits = cv_splits(states[name][0]['y'], n_splits, test_size,
+                               random_state)
+            for start in range(0, n_splits, per_chunk):
+                tasks.append((name, splits[start:start + per_chunk]))
+        args = ([states[name][0] for name, _ in tasks], [s for _, s in tasks],
+                [n_components] * len(tasks))
+        folds = list(map(_folds, *args)) if pool is None else \
+            list(pool.map(_folds, *args))
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    results = OrderedDict()
+    for name in names:
+        state, seconds = states[name]
+        y = state['y']
+        results[name] = dict(scores=[], n_epochs=len(y), cov_seconds=seconds,
+                             cv_seconds=0.,
+                             chance=float(np.bincount(y).max() / len(y)))
+    for (name, _), (scores, seconds) in zip(tasks, folds):
+        results[name]['scores'] += scores
+        results[name]['cv_seconds'] += seconds
+    for res in results.values():
+        res['accuracy'] = float(np.mean(res['scores']))
+        res['std'] = float(np.std(res['scores']))
+    if verbose:
+        print(summary(results, time.perf_counter() - t0))
+    return results
+
+
+def summary(results, wall=None):
+    """One line per subject: accuracy, chance level and the time spent."""
+    lines = ['{:<10} {:>9} {:>7} {:>7} {:>9} {:>7}'.format(
+        'subject', 'accuracy', 'std', 'chance', 'cov (s)', 'cv (s)')]
+    for name, res in results.items():
+        lines.append('{:<10} {:9.3f} {:7.3f} {:7.3f} {:9.2f} {:7.3f}'.format(
+            name, res['accuracy'], res['std'], res['chance'],
+            res['cov_seconds'], res['cv_seconds']))
+    if wall is not None:
+        lines.append('{} subjects x {} folds in {:.1f} s'.format(
+            len(results), len(next(iter(results.values()))['scores'])
+            if results else 0, wall))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('cache_dir', help='eeg_cache folder of the recordings')
+    parser.add_argument('names', nargs='+', help='e.g. A01T A02T')
+    parser.add_argument('--splits', type=int, default=10)
+    parser.add_argument('--components', type=int, default=4)
+    parser.add_argument('--jobs', type=int, default=None)
+    args = parser.parse_args()
+    evaluate({name: eeg_cache.open_cached(args.cache_dir, name)
+              for name in args.names}, n_splits=args.splits,
+             n_components=args.components, n_jobs=args.jobs)
@@ -0,0 +1,437 @@
+"""
+Epoching straight from a memory-mapped raw (see eeg_cache.py).
+
+``mne.Epochs(raw, events, ..., preload=True)`` reads and slices the recording
+epoch by epoch, again for every tmin/tmax or reject variant. Here all epochs
+come out of one strided gather: ``sliding_window_view`` turns the (channels,
+times) memmap into (windows, channels, times) without copying, and indexing it
+with the event onsets picks every epoch at once. The SSP projectors are one
+matmul per batch, baseline correction and peak-to-peak rejection reductions
+over the whole 3-D array. Like mne.Epochs, projectors are applied (proj=True)
+and epochs overlapping BAD annotations dropped (reject_by_annotation=True).
+
+    cached = eeg_cache.cache_raw(fname, cache_dir)
+    epochs = eeg_epochs.make_epochs(cached, events, event_id, tmin=-0.2,
+                                    tmax=0.5, reject=reject_criteria)
+
+``LazyEpochs`` is the not-preloaded variant: ``lazy[i]`` is a view into a
+copy-on-write map of the cache file, nothing is read before it is used and
+writing into it never reaches the file.
+
+``stream_average`` averages without keeping the epochs: they are gathered
+``chunk_epochs`` at a time, projected, baseline-corrected and checked for
+rejection, and folded into per-condition running means and variances. Memory is
+O(channels x times x conditions), however many trials there are:
+
+    averages = eeg_epochs.stream_average(raw_or_cached, events, event_id,
+                                         reject=reject_criteria)
+    averages.average('auditory').plot()     # tags pool, like epochs['auditory']
+    averages.standard_error('auditory')
+"""
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+import mne
+try:
+    from mne.io.proj import setup_proj
+except ImportError:  # mne >= 1.6
+    from mne._fiff.proj import setup_proj
+
+import eeg_cache
+import eeg_float32
+
+chunk_epochs = 256  # epochs gathered at a time when only a reduction is needed
+
+
+def _baseline_picks(info):
+    # data + aux channels, like mne.Epochs (stim/misc are left alone)
+    return mne.pick_types(info, meg=True, eeg=True, seeg=True, ecog=True,
+                          fnirs=True, eog=True, ecg=True, emg=True, bio=True,
+                          ref_meg=True, exclude=[])
+
+
+def epoch_window(sfreq, tmin, tmax):
+    """(first sample offset, n_times) of the window, rounded like mne."""
+    start = int(round(tmin * sfreq))
+    return start, int(round(tmax * sfreq)) + 1 - start
+
+
+def baseline_correct(X, times, baseline, picks=None):
+    """Subtract the ``baseline`` mean of every epoch and channel, in place."""
+    if baseline is None:
+        return X
+    bmin = times[0] if baseline[0] is None else baseline[0]
+    bmax = times[-1] if baseline[1] is None else baseline[1]
+    imin = np.where(times >= bmin)[0][0]
+    imax = np.where(times <= bmax)[0][-1] + 1
+    if picks is None or len(picks) == X.shape[1]:
+        X -= X[..., imin:imax].mean(axis=-1, keepdims=True)
+    else:
+        sub = X[:, picks]
+        sub -= sub[..., imin:imax].mean(axis=-1, keepdims=True)
+        X[:, picks] = sub
+    return X
+
+
+def ptp_reject(X, info, reject=None, flat=None):
+    """Peak-to-peak check of all epochs at once, like mne.Epochs(reject=...).
+
+    Returns (good, drop_reasons): a bool mask over epochs and, per epoch, the
+    channel names that exceeded ``reject`` or fell under ``flat``. Bad
+    channels are ignored.
+    """
+    reasons = [[] for _ in range(len(X))]
+    good = np.ones(len(X), bool)
+    if not reject and not flat:
+        return good, reasons
+    ptp = X.max(axis=-1) - X.min(axis=-1)  # (n_epochs, n_channels)
+    types = np.array([mne.channel_type(info, i) for i in range(len(info['ch_names']))])
+    checkable = ~np.isin(info['ch_names'], info['bads'])
+    for thresholds, compare in ((reject or {}, np.greater), (flat or {}, np.less)):
+        for ch_type, thresh in thresholds.items():
+            idx = np.where((types == ch_type) & checkable)[0]
+            if len(idx) == 0:
+                raise ValueError('No {} channel found. Cannot reject based on {}.'
+                                 .format(ch_type.upper(), ch_type.upper()))
+            hits = compare(ptp[:, idx], thresh)
+            for epoch_idx, ch_idx in zip(*np.nonzero(hits)):
+                reasons[epoch_idx].append(info['ch_names'][idx[ch_idx]])
+            good &= ~hits.any(axis=1)
+    return good, reasons
+
+
+def _select_events(events, event_id):
+    # (mask of the events with a code in event_id, event_id as a dict)
+    if event_id is None:
+        event_id = {str(e): int(e) for e in np.unique(events[:, 2])}
+    elif not isinstance(event_id, dict):
+        event_id = {str(e): int(e) for e in np.atleast_1d(event_id)}
+    return np.isin(events[:, 2], list(event_id.values())), event_id
+
+
+def bad_annotations(raw, starts, n_times):
+    """Description of the first BAD annotation each window overlaps, or None.
+
+    ``starts`` are first samples relative to the start of the data, like
+    mne's reject_by_annotation (annotations starting with 'bad', any case).
+    """
+    found = np.full(len(starts), None, object)
+    annotations = raw.annotations
+    if not len(annotations):
+        return found
+    sfreq = raw.info['sfreq']
+    onsets = annotations.onset - raw.first_samp / sfreq
+    starts = np.asarray(starts) / sfreq
+    stops = starts + n_times / sfreq
+    # backwards, so the first overlapping annotation wins
+    for onset, duration, description in list(zip(
+            onsets, annotations.duration, annotations.description))[::-1]:
+        if description.lower().startswith('bad'):
+            found[(onset < stops) & (onset + duration > starts)] = str(description)
+    return found
+
+
+# #### epochs ####
+
+class LazyEpochs(object):
+    """Epochs of a cached raw, as views until they are loaded.
+
+    ``raw`` is an ``eeg_cache.CachedRaw`` or an mne Raw; a Raw that is not
+    preloaded is read from its file epoch by epoch. Events whose window does
+    not fit in the recording or overlaps a BAD annotation are dropped and
+    events not in ``event_id`` are IGNORED, like in mne (``selection`` and
+    ``drop_log`` refer to ``events``). With ``proj`` the projectors of the
+    picked channels are applied to every gathered epoch.
+    """
+
+    def __init__(self, raw, events, event_id=None, tmin=-0.2, tmax=0.5,
+                 baseline=(None, 0), picks=None, proj=True,
+                 reject_by_annotation=True):
+        if isinstance(raw, eeg_cache.CachedRaw):
+            # copy-on-write map: views can be modified, the file never is
+            data = np.memmap(raw.data.filename, dtype=raw.data.dtype, mode='c',
+                             shape=raw.data.shape)
+        elif raw.preload:
+            data = raw._data
+        else:  # read from the file when gathered
+            data = None
+        self._raw = raw
+        self.info = raw.info
+        self.sfreq = raw.info['sfreq']
+        start, n_times = epoch_window(self.sfreq, tmin, tmax)
+        self.times = np.arange(start, start + n_times) / self.sfreq
+        self.tmin = self.times[0]
+        self.baseline = baseline
+        if picks is not None and isinstance(picks[0], str):
+            picks = mne.pick_channels(self.info['ch_names'], picks, ordered=True)
+        self.picks = None if picks is None else np.asarray(picks)
+        # projector of the picked channels, built once; the info copy gets
+        # the projectors marked active, like mne.Epochs(proj=True)
+        info = self.info.copy() if picks is None else mne.pick_info(self.info, picks)
+        projector, self._info = setup_proj(info, add_eeg_ref=False,
+                                           activate=proj, verbose=False)
+        self._projector = projector if proj else None
+
+        events = np.asarray(events)
+        matched, self.event_id = _select_events(events, event_id)
+        onsets = events[:, 0] - raw.first_samp + start
+        too_short = onsets + n_times > raw.n_times
+        inside = matched & (onsets >= 0) & ~too_short
+        bad = np.full(len(events), None, object)
+        if reject_by_annotation:
+            bad[inside] = bad_annotations(raw, onsets[inside], n_times)
+        self.drop_log = [() if i and b is None else ('IGNORED',) if not m else
+                         ('TOO_SHORT',) if t else ('NO_DATA',) if not i else (b,)
+                         for i, m, t, b in zip(inside, matched, too_short, bad)]
+        inside &= np.equal(bad, None)
+        self.events, self.onsets = events[inside], onsets[inside]
+        self.selection = np.where(inside)[0]
+        # (n_windows, n_channels, n_times), no copy; windows overlap, so a
+        # write into one epoch shows up in its neighbours too
+        self._windows = None if data is None else sliding_window_view(
+            data, n_times, axis=1, writeable=data.flags.writeable).transpose(1, 0, 2)
+
+    def __len__(self):
+        return len(self.onsets)
+
+    def __getitem__(self, idx):
+        """Epoch ``idx`` as a (n_channels, n_times) view (a copy with
+        ``picks``, projectors or a raw that is not preloaded), no baseline."""
+        if (self._windows is None or self.picks is not None or
+                self._projector is not None):
+            return self._project(self._gather(self.onsets[[idx]]))[0]
+        return self._windows[self.onsets[idx]]
+
+    def _gather(self, onsets):
+        if self._windows is None:  # not preloaded: one read per epoch
+            n_times = len(self.times)
+            X = np.empty((len(onsets), len(self._picked_info()['ch_names']),
+                          n_times))
+            for i, onset in enumerate(onsets):
+                X[i] = self._raw.get_data(self.picks, start=onset,
+                                          stop=onset + n_times)
+            return X
+        if self.picks is None:
+            return self._windows[onsets]
+        return self._windows[onsets[:, None], self.picks[None, :]]
+
+    def _project(self, X):
+        # (n_channels, n_channels) @ every epoch, in the dtype of X
+        if self._projector is None:
+            return X
+        return np.matmul(self._projector.astype(X.dtype, copy=False), X)
+
+    def get_data(self, item=None, dtype=np.float64):
+        """Projected and baseline-corrected (n_epochs, n_channels, n_times)
+        copy, one gather."""
+        onsets = self.onsets if item is None else self.onsets[item]
+        X = self._project(self._gather(onsets).astype(dtype, copy=False))
+        return baseline_correct(X, self.times, self.baseline,
+                                self._baseline_picks())
+
+    def _baseline_picks(self):
+        picks = _baseline_picks(self.info)
+        if self.picks is None:
+            return picks
+        return np.where(np.isin(self.picks, picks))[0]
+
+    def _picked_info(self):
+        # info of the picked channels, projectors active with ``proj``
+        return self._info
+
+    def drop_bad(self, reject=None, flat=None):
+        """Peak-to-peak rejection, gathered ``chunk_epochs`` epochs at a time."""
+        if not reject and not flat:
+            return self
+        info = self._picked_info()
+        keep = np.ones(len(self), bool)
+        for start in range(0, len(self), chunk_epochs):
+            item = slice(start, start + chunk_epochs)
+            # ptp does not depend on the baseline, skip it
+            X = self._project(self._gather(self.onsets[item]))
+            good, reasons = ptp_reject(X, info, reject, flat)
+            keep[item] = good
+            for i, reason in zip(self.selection[item], reasons):
+                if reason:
+                    self.drop_log[i] = tuple(reason)
+        self.events, self.onsets = self.events[keep], self.onsets[keep]
+        self.selection = self.selection[keep]
+        return self
+
+    def load(self, dtype=np.float64):
+        """mne.EpochsArray with everything that is left (one gather).
+
+        With dtype=np.float32 the epochs hold float32 data (see eeg_float32).
+        """
+        # projected already (if at all): proj=False keeps the data as it is
+        epochs = eeg_float32.epochs_array(
+            self.get_data(dtype=dtype), self._picked_info(), events=self.events,
+            tmin=self.tmin, event_id=self.event_id, selection=self.selection,
+            drop_log=tuple(self.drop_log), on_missing='ignore', proj=False)
+        # the data is corrected already, only record the interval
+        if self.baseline is not None:
+            bmin, bmax = self.baseline
+            epochs.baseline = (float(self.times[0] if bmin is None else bmin),
+                               float(self.times[-1] if bmax is None else bmax))
+        return epochs
+
+    def __repr__(self):
+        return '<LazyEpochs | {} events, {:.3f} - {:.3f} s>'.format(
+            len(self), self.times[0], self.times[-1])
+
+
+def make_epochs(raw, events, event_id=None, tmin=-0.2, tmax=0.5,
+                baseline=(None, 0), picks=None, reject=None, flat=None,
+                dtype=np.float64, proj=True, reject_by_annotation=True):
+    """Preloaded ``mne.Epochs(raw, events, ...)`` equivalent from a cached raw."""
+    return LazyEpochs(raw, events, event_id=event_id, tmin=tmin, tmax=tmax,
+                      baseline=baseline, picks=picks, proj=proj,
+                      reject_by_annotation=reject_by_annotation
+                      ).drop_bad(reject, flat).load(dtype)
+
+
+# #### streaming averages ####
+
+class Welford(object):
+    """Running count, mean and sum of squared deviations (``m2``), float64.
+
+    ``update`` folds in a batch at once (Chan et al.'s pairwise merge of
+    Welford's updates), so it stays accurate over many trials.
+    """
+
+    def __init__(self, shape):
+        self.n = 0
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+
+    def update(self, X):
+        """Add the epochs of ``X`` (n, ...)."""
+        if len(X):
+            X = np.asarray(X, dtype=np.float64)
+            mean = X.mean(axis=0)
+            self._merge(len(X), mean, ((X - mean) ** 2).sum(axis=0))
+        return self
+
+    def _merge(self, n, mean, m2):
+        total = self.n + n
+        delta = mean - self.mean
+        self.mean += delta * (n / total)
+        self.m2 += m2 + delta ** 2 * (self.n * n / total)
+        self.n = total
+
+    def merge(self, other):
+        """Pooled statistics of both (a new Welford)."""
+        out = Welford(self.mean.shape)
+        for state in (self, other):
+            if state.n:
+                out._merge(state.n, state.mean, state.m2)
+        return out
+
+    def variance(self, ddof=0):
+        return self.m2 / max(self.n - ddof, 1)
+
+    def standard_error(self):
+        """std / sqrt(n), with mne's ddof=0."""
+        return np.sqrt(self.variance() / max(self.n, 1))
+
+
+def _matches(name, condition):
+    # epochs[condition] selection: the name, or all of its '/' tags
+    return name == condition or set(condition.split('/')) <= set(name.split('/'))
+
+
+class Averages(object):
+    """Per-condition running statistics of ``stream_average``."""
+
+    def __init__(self, info, times, event_id, baseline):
+        self.info = info
+        self.times = times
+        self.event_id = event_id
+        self.baseline = baseline
+        shape = (len(info['ch_names']), len(times))
+        self.states = {code: Welford(shape) for code in set(event_id.values())}
+        self.drop_log = []
+
+    def state(self, condition):
+        """Welford of the event codes ``condition`` selects (pooled)."""
+        codes = sorted(set(code for name, code in self.event_id.items()
+                           if _matches(name, condition)))
+        if not codes:
+            raise KeyError('Event "{}" is not in {}'.format(
+                condition, sorted(self.event_id)))
+        state = self.states[codes[0]]
+        for code in codes[1:]:
+            state = state.merge(self.states[code])
+        return state
+
+    def _evoked(self, data, condition, nave, kind):
+        # data channels only, like Epochs.average()
+        picks = mne.pick_types(self.info, meg=True, eeg=True, seeg=True,
+                               ecog=True, fnirs=True, exclude=[])
+        evoked = mne.EvokedArray(data[picks], mne.pick_info(self.info, picks),
+                                 tmin=self.times[0], comment=condition,
+                                 nave=max(nave, 1), kind=kind, verbose=False)
+        # only record the interval: the epochs were corrected already (and
+        # EvokedArray(baseline=...) would also "correct" a standard error)
+        evoked.baseline = self.baseline
+        return evoked
+
+    def average(self, condition):
+        """Evoked of ``condition`` (like epochs[condition].average())."""
+        state = self.state(condition)
+        return self._evoked(state.mean, condition, state.n, 'average')
+
+    def standard_error(self, condition):
+        """Evoked of the standard error (epochs[condition].standard_error())."""
+        state = self.state(condition)
+        return self._evoked(state.standard_error(), condition, state.n,
+                            'standard_error')
+
+    def evokeds(self, conditions=None):
+        """{condition: (average, standard error)}, every event_id by default."""
+        conditions = list(self.event_id) if conditions is None else conditions
+        return {c: (self.average(c), self.standard_error(c)) for c in conditions}
+
+    def counts(self):
+        return {name: self.states[code].n for name, code in self.event_id.items()}
+
+    def __repr__(self):
+        return '<Averages | {}>'.format(', '.join(
+            '{}: {}'.format(name, n) for name, n in self.counts().items()))
+
+
+def stream_average(raw, events, event_id=None, tmin=-0.2, tmax=0.5,
+                   baseline=(None, 0), picks=None, reject=None, flat=None,
+                   proj=True, reject_by_annotation=True):
+    """Per-condition averages of the epochs of ``raw`` without keeping them.
+
+    Same epochs, projectors, baseline and rejection as ``make_epochs``
+    (``raw`` as in LazyEpochs: a CachedRaw, or an mne Raw that need not be
+    preloaded), but each chunk of ``chunk_epochs`` epochs is folded into
+    running per-code statistics and dropped. Returns an ``Averages``.
+    """
+    lazy = LazyEpochs(raw, events, event_id=event_id, tmin=tmin, tmax=tmax,
+                      baseline=baseline, picks=picks, proj=proj,
+                      reject_by_annotation=reject_by_annotation)
+    info = lazy._picked_info()  # projectors active with ``proj``
+    bl = None
+    if baseline is not None:  # the interval, as recorded by mne
+        bl = (float(lazy.times[0] if baseline[0] is None else baseline[0]),
+              float(lazy.times[-1] if baseline[1] is None else baseline[1]))
+    averages = Averages(info, lazy.times, lazy.event_id, bl)
+    bl_picks = lazy._baseline_picks()
+    codes = lazy.events[:, 2]
+    for start in range(0, len(lazy), chunk_epochs):
+        item = slice(start, start + chunk_epochs)
+        X = lazy._project(lazy._gather(lazy.onsets[item]))
+        good, reasons = ptp_reject(X, info, reject, flat)
+        for i, reason in zip(lazy.selection[item], reasons):
+            if reason:
+                lazy.drop_log[i] = tuple(reason)
+        X = baseline_correct(X[good].astype(np.float64, copy=False), lazy.times,
+                             baseline, bl_picks)
+        these = codes[item][good]
+        for code in np.unique(these):
+            averages.states[code].update(X[these == code])
+    averages.drop_log = tuple(lazy.drop_log)
+    return averages
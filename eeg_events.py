@@ -0,0 +1,323 @@
+"""
+Columnar event table, detected once per recording and queried by index.
+
+``find_events(raw, 'STI 014')`` scans the stim channel once (one np.diff over
+the whole channel, same rules as mne.find_events with its defaults) and keeps
+the result in a cache keyed on the recording, so calling it again for the same
+file is free. The returned ``EventTable`` holds sample/prev/code columns sorted
+by sample, with a sorted code index next to them:
+
+    table.select(code=[1, 2])              # pick_events(include=...)
+    table.select(tag='auditory')           # 'auditory/left' + 'auditory/right'
+    table.between(10., 20.)                # time range, a view
+    table.merge([1, 2, 3], 1)              # merge_events, shares sample/prev
+    table.events                           # (n, 3) array for mne
+
+Lookups are binary searches (O(log n)) instead of a scan over the events.
+"""
+
+import os
+import re
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+import mne
+
+import eeg_cache
+
+# set to None to keep the cache in memory only
+cache_dir = os.environ.get('EEG_EVENTS_CACHE', os.path.join(
+    os.path.expanduser('~'), '.cache', 'eeg_events'))
+max_cached = 32  # detected event arrays kept in memory (LRU)
+# descriptions from_annotations turns into events (mne's default: no BAD/EDGE)
+annotation_regexp = r'^(?![Bb][Aa][Dd]|[Ee][Dd][Gg][Ee]).*$'
+
+_cache = OrderedDict()
+_stats = dict(hits=0, disk_hits=0, misses=0)
+
+
+def cache_info():
+    return dict(_stats, size=len(_cache), max_size=max_cached)
+
+
+def clear_cache(disk=False):
+    _cache.clear()
+    for k in _stats:
+        _stats[k] = 0
+    if disk and cache_dir and os.path.isdir(cache_dir):
+        for fname in os.listdir(cache_dir):
+            if fname.endswith('-eve.npy'):
+                os.remove(os.path.join(cache_dir, fname))
+
+
+def _cached(key, make):
+    """Memory, then ``cache_dir``, else ``make()`` (like eeg_filter._cached)."""
+    if key in _cache:
+        _cache.move_to_end(key)
+        _stats['hits'] += 1
+        return _cache[key]
+    fname = None
+    if cache_dir:
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        fname = os.path.join(cache_dir, digest + '-eve.npy')
+    if fname and os.path.exists(fname):
+        value = np.load(fname)
+        _stats['disk_hits'] += 1
+    else:
+        value = make()
+        _stats['misses'] += 1
+        if fname:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp = '{}.{}.tmp.npy'.format(fname[:-4], os.getpid())
+            np.save(tmp, value)
+            os.replace(tmp, fname)
+    value.flags.writeable = False  # shared between tables
+    _cache[key] = value
+    while len(_cache) > max_cached:
+        _cache.popitem(last=False)
+    return value
+
+
+# #### detection ####
+
+def find_transitions(stim, first_samp=0, consecutive='increasing'):
+    """(n, 3) events from one stim channel, like mne.find_events' defaults.
+
+    Steps are found with one vectorized diff; onsets are up-steps for
+    ``consecutive='increasing'``, any step to a non-zero value for True and
+    steps from zero for False.
+    """
+    x = np.abs(np.asarray(stim).astype(np.int64))
+    idx = np.flatnonzero(x[1:] != x[:-1])
+    prev, code = x[idx], x[idx + 1]
+    if len(x) and x[-1] != 0:  # mne closes a trailing event at the end (pad_stop)
+        idx = np.append(idx, len(x) - 1)
+        prev, code = np.append(prev, x[-1]), np.append(code, 0)
+    if consecutive == 'increasing':
+        onsets = code > prev
+        offsets = (onsets | (code == 0)) & (prev > 0)
+    elif consecutive:
+        onsets, offsets = code > 0, prev > 0
+    else:
+        onsets, offsets = prev == 0, code == 0
+    onset_idx, offset_idx = np.flatnonzero(onsets), np.flatnonzero(offsets)
+    if len(onset_idx) == 0 or len(offset_idx) == 0:
+        return np.empty((0, 3), np.int64)
+    if onset_idx[-1] > offset_idx[-1]:  # orphaned onset
+        onset_idx = onset_idx[:-1]
+    return np.c_[idx[onset_idx] + 1 + first_samp, prev[onset_idx],
+                 code[onset_idx]]
+
+
+def _stim_pick(info, stim_channel):
+    if stim_channel is None:
+        picks = mne.pick_types(info, meg=False, stim=True, exclude=[])
+        if len(picks) == 0:
+            raise ValueError('No stim channel found')
+        return picks[0]
+    return info['ch_names'].index(stim_channel)
+
+
+def _source_key(raw):
+    # files that have not changed do not need to be read again to be looked up
+    if isinstance(raw, eeg_cache.CachedRaw):
+        fnames = [raw.data.filename]
+    elif not getattr(raw, 'preload', True) and raw.filenames:
+        fnames = [str(f) for f in raw.filenames]
+    else:
+        return None
+    return tuple((os.path.abspath(f), os.path.getmtime(f)) for f in fnames)
+
+
+def find_events(raw, stim_channel=None, consecutive='increasing'):
+    """Cached event detection on an mne Raw or eeg_cache.CachedRaw."""
+    pick = _stim_pick(raw.info, stim_channel)
+    first_samp, n_times = int(raw.first_samp), int(raw.n_times)
+
+    def stim():
+        if isinstance(raw, eeg_cache.CachedRaw):
+            return raw.data[pick]
+        return raw.get_data(picks=[pick])[0]
+
+    source = _source_key(raw)
+    if source is None:  # data in memory, key on its content
+        source = hashlib.sha1(np.ascontiguousarray(stim()).tobytes()).hexdigest()
+    key = ('events', source, first_samp, n_times, raw.info['ch_names'][pick],
+           consecutive)
+    events = _cached(key, lambda: find_transitions(stim(), first_samp,
+                                                   consecutive))
+    return EventTable(events[:, 0], events[:, 2], prev=events[:, 1],
+                      sfreq=raw.info['sfreq'], first_samp=first_samp)
+
+
+def from_annotations(raw, event_id=None, names=None,
+                     regexp=annotation_regexp):
+    """``mne.events_from_annotations`` as an EventTable.
+
+    ``event_id`` maps descriptions to codes (default: sorted descriptions
+    numbered from 1); ``names`` optionally renames descriptions to condition
+    names, e.g. '769' -> 'cue onset/left hand'. Only descriptions matching
+    ``regexp`` (None: all) become events, by default not BAD_*/EDGE*.
+    """
+    annotations = raw.annotations
+    sfreq, first_samp = raw.info['sfreq'], int(raw.first_samp)
+    desc = np.asarray(annotations.description)
+    matched = set(desc) if regexp is None else \
+        {d for d in set(desc) if re.match(regexp, d)}
+    if event_id is None:
+        event_id = {d: i + 1 for i, d in enumerate(sorted(matched))}
+    keep = np.isin(desc, [d for d in event_id if d in matched])
+    onset = np.asarray(annotations.onset)[keep]
+    # same sample numbers as raw.time_as_index(onset, origin=orig_time)
+    if annotations.orig_time is None:  # onsets already count from sample 0
+        sample = np.round(onset * sfreq).astype(np.int64)
+    else:  # relative to meas_date, i.e. to first_samp
+        sample = first_samp + np.round((onset - first_samp / sfreq) * sfreq
+                                       ).astype(np.int64)
+    code = np.array([event_id[d] for d in desc[keep]], np.int64)
+    order = np.argsort(sample, kind='stable')
+    names = names or {}
+    event_id = {names.get(d, d): c for d, c in event_id.items() if d in desc[keep]}
+    return EventTable(sample[order], code[order], sfreq=sfreq,
+                      first_samp=first_samp, event_id=event_id)
+
+
+# #### table ####
+
+class EventTable(object):
+    """sample/prev/code columns sorted by sample, plus a code index.
+
+    ``event_id`` (name -> code) names the conditions; names are '/'-separated
+    tags as in mne ('auditory/left'). Time ranges return views of the columns,
+    ``merge``/``relabel`` share the sample/prev columns and only build a new
+    code column.
+    """
+
+    def __init__(self, sample, code, prev=None, sfreq=1., first_samp=0,
+                 event_id=None):
+        self.sample = np.asarray(sample)
+        self.code = np.asarray(code)
+        self.prev = np.zeros_like(self.sample) if prev is None else np.asarray(prev)
+        self.sfreq = float(sfreq)
+        self.first_samp = int(first_samp)
+        if event_id is None:
+            event_id = {str(c): int(c) for c in np.unique(self.code)}
+        self.event_id = dict(event_id)
+        self._index = None
+
+    @classmethod
+    def from_events(cls, events, sfreq, first_samp=0, event_id=None):
+        events = np.asarray(events)
+        order = np.argsort(events[:, 0], kind='stable')
+        return cls(events[order, 0], events[order, 2], prev=events[order, 1],
+                   sfreq=sfreq, first_samp=first_samp, event_id=event_id)
+
+    def _like(self, sample, code, prev, event_id=None):
+        return EventTable(sample, code, prev=prev, sfreq=self.sfreq,
+                          first_samp=self.first_samp,
+                          event_id=self.event_id if event_id is None else event_id)
+
+    # #### columns ####
+
+    @property
+    def events(self):
+        """(n, 3) array for mne functions (a copy)."""
+        return np.column_stack([self.sample, self.prev, self.code])
+
+    @property
+    def times(self):
+        return (self.sample - self.first_samp) / self.sfreq
+
+    def __len__(self):
+        return len(self.sample)
+
+    def __getitem__(self, item):
+        return self._like(self.sample[item], self.code[item], self.prev[item])
+
+    def __repr__(self):
+        return '<EventTable | {} events, {} codes>'.format(
+            len(self), len(np.unique(self.code)))
+
+    # #### queries ####
+
+    def _code_index(self):
+        if self._index is None:
+            order = np.argsort(self.code, kind='stable')
+            self._index = (order, self.code[order])
+        return self._index
+
+    def codes(self, key):
+        """Codes of a condition name or of every name carrying all its tags."""
+        if key in self.event_id:
+            return [self.event_id[key]]
+        tags = set(key.split('/'))
+        codes = [c for name, c in self.event_id.items()
+                 if tags <= set(name.split('/'))]
+        if not codes:
+            raise KeyError('{!r} matches no condition in {}'.format(
+                key, sorted(self.event_id)))
+        return sorted(set(codes))
+
+    def where(self, code):
+        """Row positions (sorted) of one or more codes, by binary search."""
+        order, sorted_codes = self._code_index()
+        parts = [order[np.searchsorted(sorted_codes, c, 'left'):
+                       np.searchsorted(sorted_codes, c, 'right')]
+                 for c in np.atleast_1d(code)]
+        return np.sort(np.concatenate(parts)) if parts else np.array([], int)
+
+    def count(self):
+        codes, counts = np.unique(self.code, return_counts=True)
+        return dict(zip(codes.tolist(), counts.tolist()))
+
+    def between(self, tmin=None, tmax=None):
+        """Events with tmin <= time <= tmax (s, from first_samp), as a view."""
+        lo = 0 if tmin is None else np.searchsorted(
+            self.sample, self.first_samp + int(np.ceil(tmin * self.sfreq)), 'left')
+        hi = len(self) if tmax is None else np.searchsorted(
+            self.sample, self.first_samp + int(np.floor(tmax * self.sfreq)), 'right')
+        return self[lo:hi]
+
+    def select(self, code=None, tag=None, exclude=None, tmin=None, tmax=None):
+        """Subset by code(s), condition tag, excluded code(s) and time range."""
+        table = self.between(tmin, tmax) if tmin is not None or tmax is not None \
+            else self
+        if code is None and tag is None and exclude is None:
+            return table
+        if tag is not None:
+            code = table.codes(tag) if code is None else \
+                sorted(set(np.atleast_1d(code)) & set(table.codes(tag)))
+        if code is None:
+            code = np.unique(table.code)
+        if exclude is not None:
+            code = np.setdiff1d(code, exclude)
+        return table[table.where(code)]
+
+    # #### relabelling ####
+
+    def relabel(self, mapping, event_id=None):
+        """New codes ({old: new}); sample/prev are shared with this table."""
+        codes, inverse = np.unique(self.code, return_inverse=True)
+        new = np.array([mapping.get(c, c) for c in codes.tolist()], self.code.dtype)
+        return self._like(self.sample, new[inverse.ravel()], self.prev,
+                          event_id=event_id)
+
+    def merge(self, codes, new_code, name=None):
+        """``mne.merge_events(events, codes, new_code)`` on the table."""
+        codes = set(np.atleast_1d(codes).tolist())
+        event_id = {n: c for n, c in self.event_id.items() if c not in codes}
+        event_id[name or str(new_code)] = new_code
+        return self.relabel({c: new_code for c in codes}, event_id=event_id)
+
+    def to_annotations(self, event_desc=None, first_samp=0, orig_time=None):
+        """``mne.annotations_from_events`` with the table's names by default."""
+        if event_desc is None:
+            event_desc = {c: n for n, c in self.event_id.items()}
+        table = self[self.where(list(event_desc))] if isinstance(event_desc, dict) \
+            else self
+        onset = (table.sample - first_samp) / self.sfreq
+        desc = [event_desc[c] if isinstance(event_desc, dict) else str(c)
+                for c in table.code.tolist()]
+        return mne.Annotations(onset, np.zeros(len(table)), desc,
+                               orig_time=orig_time)
@@ -0,0 +1,348 @@
+"""
+Fused FIR filter chain: high-pass + notch + anti-alias/decimation in one pass.
+
+Instead of ``raw.copy().filter(...)``, ``raw.copy().notch_filter(...)`` and
+``raw.copy().resample(...)`` (one full copy per step), the three zero-phase FIR
+kernels are convolved into a single kernel and applied once per block of
+channels. The result goes into one preallocated output (or back into the
+input), so peak memory is about one copy of the data plus a block of scratch.
+
+Designed kernels and their FFTs are cached (LRU in memory + .npy files on
+disk, see ``cache_dir``), so a batch over many subjects designs each filter
+once; ``cache_info()`` has the hit/miss counters.
+"""
+
+import os
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+from scipy.fft import rfft, irfft, next_fast_len
+import mne
+
+import eeg_float32
+
+block_channels = 8  # channels filtered at a time
+
+# #### filter-design cache ####
+
+# set to None to keep the cache in memory only
+cache_dir = os.environ.get('EEG_FILTER_CACHE', os.path.join(
+    os.path.expanduser('~'), '.cache', 'eeg_filter'))
+max_cached = 64  # kernels + FFTs kept in memory (LRU)
+
+_cache = OrderedDict()
+_stats = dict(hits=0, disk_hits=0, misses=0)
+
+
+def _cached(key, make):
+    """Look ``key`` up in memory, then on disk, else call ``make()``."""
+    if key in _cache:
+        _cache.move_to_end(key)
+        _stats['hits'] += 1
+        return _cache[key]
+    fname = None
+    if cache_dir:
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        fname = os.path.join(cache_dir, digest + '.npy')
+    if fname and os.path.exists(fname):
+        value = np.load(fname)
+        _stats['disk_hits'] += 1
+    else:
+        value = make()
+        _stats['misses'] += 1
+        if fname:
+            os.makedirs(cache_dir, exist_ok=True)
+            # unique tmp name, workers may write the same kernel concurrently
+            tmp = '{}.{}.tmp.npy'.format(fname[:-4], os.getpid())
+            np.save(tmp, value)
+            os.replace(tmp, fname)
+    value.flags.writeable = False  # shared between callers
+    _cache[key] = value
+    while len(_cache) > max_cached:
+        _cache.popitem(last=False)
+    return value
+
+
+def cache_info():
+    """Hit/miss counters of this process (disk hits are counted apart)."""
+    return dict(_stats, size=len(_cache), max_size=max_cached)
+
+
+def clear_cache(disk=False):
+    _cache.clear()
+    for k in _stats:
+        _stats[k] = 0
+    if disk and cache_dir and os.path.isdir(cache_dir):
+        for fname in os.listdir(cache_dir):
+            if fname.endswith('.npy'):
+                os.remove(os.path.join(cache_dir, fname))
+
+
+def _as_key(freqs):
+    if freqs is None:
+        return None
+    return tuple(float(f) for f in np.atleast_1d(freqs))
+
+
+def design_chain(sfreq, l_freq=None, notch_freqs=None, decim=1,
+                 notch_widths=None, trans_bandwidth=1., h_freq=None,
+                 filter_length='auto', fir_window='hamming', phase='zero'):
+    """Single zero-phase FIR kernel for high-pass, notch and anti-alias.
+
+    Kernels are designed like mne.filter.filter_data / notch_filter do
+    (firwin, 'auto' lengths) and convolved together. Cached.
+    """
+    if decim > 1 and h_freq is None:
+        h_freq = sfreq / decim / 3.  # same rule of thumb as Epochs.decimate
+    key = ('chain', float(sfreq), _as_key(l_freq), _as_key(h_freq),
+           _as_key(notch_freqs) or None, _as_key(notch_widths),
+           float(trans_bandwidth), filter_length, fir_window, phase)
+    return _cached(key, lambda: _design_chain(
+        sfreq, l_freq, notch_freqs, notch_widths, trans_bandwidth, h_freq,
+        filter_length, fir_window, phase))
+
+
+def kernel_fft(h, n_fft, dtype=np.float64):
+    """rfft of ``h`` zero-padded to ``n_fft``, cached (complex64 for float32)."""
+    dtype = np.dtype(dtype)
+    key = ('fft', hashlib.sha1(np.ascontiguousarray(h).tobytes()).hexdigest(),
+           int(n_fft))
+    if dtype != np.float64:
+        key += (dtype.name,)
+    return _cached(key, lambda: rfft(h.astype(dtype), n_fft))
+
+
+def _design_chain(sfreq, l_freq, notch_freqs, notch_widths, trans_bandwidth,
+                  h_freq, filter_length, fir_window, phase):
+    kw = dict(filter_length=filter_length, fir_window=fir_window,
+              fir_design='firwin', phase=phase, verbose=False)
+    kernels = []
+    if l_freq is not None:
+        kernels.append(mne.filter.create_filter(None, sfreq, l_freq, None, **kw))
+    if notch_freqs is not None and len(notch_freqs):
+        freqs = np.atleast_1d(notch_freqs).astype(float)
+        widths = freqs / 200. if notch_widths is None else \
+            np.broadcast_to(notch_widths, freqs.shape)
+        tb_2 = trans_bandwidth / 2.
+        lows = list(freqs - widths / 2. - tb_2)
+        highs = list(freqs + widths / 2. + tb_2)
+        kernels.append(mne.filter.create_filter(
+            None, sfreq, highs, lows, l_trans_bandwidth=tb_2,
+            h_trans_bandwidth=tb_2, **kw))
+    if h_freq is not None:
+        kernels.append(mne.filter.create_filter(None, sfreq, None, h_freq, **kw))
+    if not kernels:
+        return np.ones(1)
+    h = kernels[0]
+    for k in kernels[1:]:
+        h = np.convolve(h, k)
+    return h
+
+
+def fft_convolve(x, h):
+    """'valid' convolution of the rows of ``x`` with ``h`` (overlap-add).
+
+    Same as scipy.signal.oaconvolve(x, h[None], 'valid', axes=-1), but the
+    kernel FFT comes from the cache. Computed in the precision of ``x``.
+    """
+    n_h, n_x = len(h), x.shape[-1]
+    n_fft = next_fast_len(min(4 * n_h, n_x + n_h - 1))
+    n_seg = n_fft - n_h + 1  # >= n_h - 1, so a tail only spills into the next segment
+    n_segs = -(-n_x // n_seg)
+    segs = np.zeros(x.shape[:-1] + (n_segs * n_seg,), x.dtype)
+    segs[..., :n_x] = x
+    segs = segs.reshape(x.shape[:-1] + (n_segs, n_seg))
+    y_segs = irfft(rfft(segs, n_fft, axis=-1) * kernel_fft(h, n_fft, x.dtype),
+                   n_fft, axis=-1)
+    del segs
+    y = np.zeros(x.shape[:-1] + (n_segs + 1, n_seg), x.dtype)
+    y[..., :-1, :] = y_segs[..., :n_seg]
+    y[..., 1:, :n_h - 1] += y_segs[..., n_seg:]
+    y = y.reshape(x.shape[:-1] + (-1,))
+    return y[..., n_h - 1:n_x]
+
+
+def _pad(x, n_pad):
+    # 'reflect_limited' padding, as in mne.cuda._smart_pad
+    n_pad = min(n_pad, x.shape[-1] - 1)
+    return np.concatenate([2 * x[:, :1] - x[:, n_pad:0:-1], x,
+                           2 * x[:, -1:] - x[:, -2:-n_pad - 2:-1]], axis=-1)
+
+
+def apply_kernel(x, h):
+    """Zero-phase filtering of a (n, n_times) block with symmetric ``h``."""
+    if len(h) == 1:
+        return x * x.dtype.type(h[0])
+    n_pad = len(h) // 2
+    xp = _pad(x, n_pad)
+    if xp.shape[-1] < x.shape[-1] + 2 * n_pad:  # shorter than the kernel
+        extra = x.shape[-1] + 2 * n_pad - xp.shape[-1]
+        xp = np.pad(xp, ((0, 0), (extra // 2, extra - extra // 2)))
+    return fft_convolve(xp, h)
+
+
+def filter_chain(data, sfreq, l_freq=None, notch_freqs=None, decim=1,
+                 picks=None, out=None, copy=True, h=None, dtype=np.float64):
+    """Filter ``data`` (n_channels, n_times) in one pass over channel blocks.
+
+    Rows not in ``picks`` are only decimated. With ``copy=False`` the result
+    is written back into ``data`` and ``data[:, :n_out]`` is returned;
+    otherwise it goes to ``out`` (allocated if None, may be float32).
+    ``dtype`` is the precision the blocks are filtered in.
+    """
+    n_chan, n_times = data.shape
+    n_out = (n_times + decim - 1) // decim
+    if h is None:
+        h = design_chain(sfreq, l_freq, notch_freqs, decim)
+    if not copy:
+        out = data
+    elif out is None:
+        out = np.empty((n_chan, n_out), dtype=data.dtype)
+    elif out.shape[0] != n_chan or out.shape[1] < n_out:
+        raise ValueError('out must have shape ({}, {}), got {}'.format(
+            n_chan, n_out, out.shape))
+
+    picks = np.arange(n_chan) if picks is None else np.asarray(picks, int)
+    others = np.setdiff1d(np.arange(n_chan), picks)
+    for start in range(0, len(picks), block_channels):
+        rows = picks[start:start + block_channels]
+        block = np.asarray(data[rows], dtype=dtype)  # block-sized scratch
+        out[rows, :n_out] = apply_kernel(block, h)[:, ::decim]
+    if len(others) and (decim > 1 or out is not data):
+        # reading a row fully before writing keeps copy=False safe
+        for row in others:
+            out[row, :n_out] = data[row, ::decim]
+    return out[:, :n_out]
+
+
+def filter_raw(raw, l_freq=None, notch_freqs=None, decim=1, picks=None,
+               copy=True, dtype=None):
+    """Fused chain on a preloaded Raw.
+
+    Without decimation and with ``copy=False`` the Raw is filtered in place;
+    otherwise a new RawArray is built around one output buffer. ``dtype``
+    (None: the dtype of the Raw's data) is the precision of the filtering and
+    of the output; float32 gives a float32 Raw (see eeg_float32).
+    """
+    sfreq = raw.info['sfreq']
+    if picks is None:  # data channels, like raw.filter
+        picks = mne.pick_types(raw.info, meg=True, eeg=True, seeg=True,
+                               ecog=True, exclude=[])
+    h = design_chain(sfreq, l_freq, notch_freqs, decim)
+    data = raw._data
+    dtype = data.dtype if dtype is None else np.dtype(dtype)
+    if decim == 1 and not copy:
+        if dtype != data.dtype:
+            eeg_float32.astype(raw, dtype)
+            data = raw._data
+        filter_chain(data, sfreq, picks=picks, copy=False, h=h, dtype=dtype)
+        return raw
+
+    out = np.empty((data.shape[0], (data.shape[1] + decim - 1) // decim), dtype)
+    out = filter_chain(data, sfreq, picks=picks, decim=decim, out=out, h=h,
+                       dtype=dtype)
+    stim = mne.pick_types(raw.info, meg=False, stim=True, exclude=[])
+    if decim > 1 and len(stim):  # keep every trigger pulse
+        idx = np.arange(0, data.shape[1], decim)
+        out[stim] = np.maximum.reduceat(data[stim], idx, axis=1)
+    info = raw.info.copy()
+    with info._unlock():
+        info['sfreq'] = sfreq / decim
+        if l_freq is not None:
+            info['highpass'] = max(info['highpass'], l_freq)
+        if decim > 1:
+            info['lowpass'] = min(info['lowpass'], sfreq / decim / 3.)
+    new = eeg_float32.raw_array(out, info, first_samp=raw.first_samp // decim)
+    new.set_annotations(raw.annotations)
+    return new
+
+
+# #### streaming (out-of-core) version ####
+
+def filter_stream(raw, cache_dir, name, l_freq=None, notch_freqs=None,
+                  decim=1, picks=None, chunk_duration=10.):
+    """Fused chain over a raw that is never loaded, written to the cache.
+
+    ``raw`` is anything with ``get_data(start=, stop=)`` (a non-preloaded
+    mne Raw or an eeg_cache.CachedRaw). Chunks of ``chunk_duration`` s are
+    read one at a time; the last 2 * (len(h) // 2) input samples are carried
+    over to the next chunk (overlap-save), and the first/last chunk get the
+    same reflect_limited padding as the in-memory filter, so the output
+    matches filter_chain up to float32 rounding. Memory use depends on the
+    chunk size only. Returns the output eeg_cache.CachedRaw.
+    """
+    import eeg_cache
+
+    info = raw.info
+    sfreq = info['sfreq']
+    n_chan, n_times = len(info['ch_names']), int(raw.n_times)
+    if picks is None:  # data channels, like raw.filter
+        picks = mne.pick_types(info, meg=True, eeg=True, seeg=True,
+                               ecog=True, exclude=[])
+    picks = np.asarray(picks, int)
+    others = np.setdiff1d(np.arange(n_chan), picks)
+    stim = np.intersect1d(others, mne.pick_types(info, meg=False, stim=True,
+                                                 exclude=[]))
+
+    h = design_chain(sfreq, l_freq, notch_freqs, decim)
+    n_pad = len(h) // 2
+    if n_times <= 2 * n_pad:
+        raise ValueError('recording ({} samples) is shorter than the filter '
+                         '({} samples), filter it in memory'.format(n_times, len(h)))
+    # whole number of decimation steps, and long enough for the edge padding
+    chunk = max(int(chunk_duration * sfreq), 4 * len(h))
+    chunk -= chunk % decim
+    n_out = (n_times + decim - 1) // decim
+    out = eeg_cache.create_data(cache_dir, name, (n_chan, n_out))
+
+    carry = None  # last 2 * n_pad samples of the previous (padded) segment
+    y_start = 0   # input index of the next filtered sample to come out
+    for start in range(0, n_times, chunk):
+        stop = min(start + chunk, n_times)
+        x = raw.get_data(start=start, stop=stop)
+        if stop < n_times and n_times - stop <= n_pad:
+            # never leave a tail too short to reflect; take it now
+            x = np.concatenate([x, raw.get_data(start=stop, stop=n_times)], axis=1)
+            stop = n_times
+
+        # channels that are not filtered: only decimated (stim keeps pulses)
+        o0, o1 = start // decim, (stop + decim - 1) // decim
+        if len(others):
+            out[others, o0:o1] = x[others, ::decim]
+        if decim > 1 and len(stim):
+            out[stim, o0:o1] = np.maximum.reduceat(
+                x[stim], np.arange(0, x.shape[1], decim), axis=1)
+
+        xp = x[picks].astype(np.float64)
+        if carry is None:
+            xp = np.concatenate([2 * xp[:, :1] - xp[:, n_pad:0:-1], xp], axis=1)
+        else:
+            xp = np.concatenate([carry, xp], axis=1)
+        if stop == n_times:
+            xp = np.concatenate([xp, 2 * xp[:, -1:] - xp[:, -2:-n_pad - 2:-1]],
+                                axis=1)
+        carry = xp[:, xp.shape[1] - 2 * n_pad:]
+        y = fft_convolve(xp, h)
+
+        # y holds input samples y_start...; keep those on the decimated grid
+        first = (-y_start) % decim
+        o0 = (y_start + first) // decim
+        kept = y[:, first::decim]
+        out[picks, o0:o0 + kept.shape[1]] = kept
+        y_start += y.shape[1]
+        out.flush()
+        if stop == n_times:
+            break
+    del out
+
+    new_info = info.copy()
+    with new_info._unlock():
+        new_info['sfreq'] = sfreq / decim
+        if l_freq is not None:
+            new_info['highpass'] = max(new_info['highpass'], l_freq)
+        if decim > 1:
+            new_info['lowpass'] = min(new_info['lowpass'], sfreq / decim / 3.)
+    eeg_cache.write_sidecars(cache_dir, name, new_info, raw.annotations,
+                             (n_chan, n_out), raw.first_samp // decim)
+    return eeg_cache.open_cached(cache_dir, name)
@@ -0,0 +1,222 @@
+"""
+Opt-in float32 processing: half the memory and bandwidth of the float64 path.
+
+mne keeps Raw and Epochs data in float64. With float32 data (``astype``)
+
+- eeg_filter.filter_raw / filter_chain filter and decimate in float32, with
+  float32 kernel FFTs,
+- eeg_ica.apply_ica subtracts the excluded components in float32,
+- eeg_epochs.make_epochs(..., dtype=np.float32) gathers, baseline-corrects
+  and keeps the epochs in float32,
+- eeg_psd runs the Welch FFTs in float32,
+
+while the numerically sensitive parts stay float64: the ICA fit (PCA and
+unmixing, see eeg_ica.shared_pca), the averages (mne's Evoked is float64)
+and the PSD averaging over segments.
+
+    raw = eeg_float32.astype(mne.io.read_raw_fif(fname, preload=True))
+    pipe = eeg_pipeline.study2_pipeline(fname, raw=dict(dtype='float32'))
+
+mne's containers copy their input to float64, so float32 Raw/Epochs are
+built around their data instead (``raw_array``, ``epochs_array``). mne's own
+filter/notch_filter/resample refuse float32 data; use eeg_filter.
+
+``validate`` runs the chain both ways and reports how far the float32 evoked
+responses and PSD are from the float64 ones:
+
+    python eeg_float32.py sample_audvis_raw.fif --ica 20 --out f32.json
+"""
+
+import json
+import time
+import argparse
+
+import numpy as np
+import mne
+try:
+    from mne.io.proj import setup_proj
+except ImportError:  # mne >= 1.6
+    from mne._fiff.proj import setup_proj
+
+# largest deviations of the float32 path accepted by ``validate``
+tolerances = dict(evoked_rel=1e-4, psd_db=0.01)
+
+
+def raw_array(data, info, first_samp=0):
+    """mne RawArray holding ``data`` itself, float32 too (no float64 copy)."""
+    if data.dtype == np.float64:
+        return mne.io.RawArray(data, info, first_samp=first_samp, verbose=False)
+    # RawArray only takes float64: give it a buffer that is never written
+    # (so never resident) and swap the data in
+    raw = mne.io.RawArray(np.empty(data.shape), info, first_samp=first_samp,
+                          verbose=False)
+    raw._data = data
+    return raw
+
+
+def epochs_array(data, info, proj=True, **kwargs):
+    """mne EpochsArray holding ``data`` itself, like ``raw_array``.
+
+    With ``proj`` the inactive projectors of ``info`` are applied to ``data``
+    (in its dtype) and marked active, like mne.EpochsArray(proj=True).
+    """
+    if data.dtype == np.float64:
+        return mne.EpochsArray(data, info, proj=proj, verbose=False, **kwargs)
+    # EpochsArray would project the placeholder buffer: project ``data``
+    # here and build the epochs with proj=False
+    if proj and not all(p['active'] for p in info['projs']):
+        projector, info = setup_proj(info.copy(), add_eeg_ref=False,
+                                     verbose=False)
+        if projector is not None:
+            data = np.matmul(projector.astype(data.dtype), data)
+    epochs = mne.EpochsArray(np.empty(data.shape), info, proj=False,
+                             verbose=False, **kwargs)
+    epochs._data = data
+    return epochs
+
+
+def astype(inst, dtype=np.float32):
+    """Cast the data of a preloaded Raw or Epochs in place; returns ``inst``."""
+    if not inst.preload:
+        raise RuntimeError('{} must be preloaded'.format(type(inst).__name__))
+    inst._data = inst._data.astype(dtype, copy=False)
+    return inst
+
+
+def dtype_of(inst):
+    """dtype of a preloaded Raw/Epochs; float64 for anything else."""
+    data = getattr(inst, '_data', None)
+    return np.float64 if data is None else data.dtype
+
+
+# #### validation ####
+
+def _run(raw, dtype, events, event_id, ica, l_freq, notch_freqs, decim, tmin,
+         tmax, baseline, reject, conditions, n_fft):
+    import eeg_epochs
+    import eeg_filter
+    import eeg_ica
+    import eeg_psd
+
+    t0 = time.perf_counter()
+    filtered = eeg_filter.filter_raw(raw, l_freq=l_freq, notch_freqs=notch_freqs,
+                                     decim=decim, dtype=dtype)
+    if ica is not None:
+        eeg_ica.apply_ica(filtered, ica)
+    epochs = eeg_epochs.make_epochs(filtered, events, event_id, tmin=tmin,
+                                    tmax=tmax, baseline=baseline, reject=reject,
+                                    dtype=dtype)
+    evokeds = {c: epochs[c].average() for c in conditions}
+    picks = mne.pick_types(filtered.info, meg=True, eeg=True, exclude=[])
+    psds, freqs = eeg_psd.welch_many([filtered.get_data(picks)],
+                                     filtered.info['sfreq'], n_fft)
+    return dict(evokeds=evokeds, psd=psds[0], freqs=freqs,
+                seconds=time.perf_counter() - t0,
+                mbytes=(filtered._data.nbytes + epochs._data.nbytes) / 2. ** 20)
+
+
+def _rel(x, ref):
+    diff = x - ref
+    scale = np.abs(ref).max()
+    return dict(max_rel=float(np.abs(diff).max() / scale),
+                rms_rel=float(np.sqrt((diff ** 2).mean() / (ref ** 2).mean())))
+
+
+def validate(raw, events, event_id, ica=None, l_freq=1., notch_freqs=None,
+             decim=1, tmin=-0.2, tmax=0.5, baseline=(None, 0), reject=None,
+             conditions=None, n_fft=2048, add_proj=True, out=None):
+    """Filter (+ ICA apply) -> epochs -> average and Welch PSD of ``raw`` in
+    float64 and in float32; returns the deviations of the float32 path.
+
+    ``ica`` is a fitted ICA (fits are float64 either way) whose exclusions
+    are applied. Evoked deviations are relative to the largest |value| of the
+    float64 evoked (max) and to its RMS (rms), per condition; PSD deviations
+    are in dB. With ``add_proj`` a raw without projectors gets an EEG
+    average-reference projector (on a copy), so that the projection of the
+    epochs is checked too. ``out`` is a JSON file name for the report.
+    """
+    if add_proj and not raw.info['projs'] and 'eeg' in raw:
+        raw = raw.copy().set_eeg_reference(projection=True, verbose=False)
+    events = np.array(events)
+    if decim > 1:  # sample numbers of the decimated recording
+        events[:, 0] = ((events[:, 0] - raw.first_samp) // decim +
+                        raw.first_samp // decim)
+    if conditions is None:
+        conditions = list(event_id)
+    args = (events, event_id, ica, l_freq, notch_freqs, decim, tmin, tmax,
+            baseline, reject, conditions, n_fft)
+    ref = _run(raw, np.float64, *args)
+    test = _run(raw, np.float32, *args)
+
+    report = dict(evoked={}, projs=[p['desc'] for p in raw.info['projs']],
+                  seconds=dict(float64=ref['seconds'],
+                               float32=test['seconds']),
+                  mbytes=dict(float64=ref['mbytes'], float32=test['mbytes']))
+    for c in conditions:
+        report['evoked'][c] = dict(_rel(test['evokeds'][c].data,
+                                        ref['evokeds'][c].data),
+                                   nave=int(ref['evokeds'][c].nave))
+    # bins with no power in float64 (e.g. DC after the high-pass) are skipped
+    good = (ref['psd'] > 0) & (test['psd'] > 0)
+    db = np.zeros(good.shape)
+    db[good] = 10 * np.abs(np.log10(test['psd'][good] / ref['psd'][good]))
+    worst = np.unravel_index(np.argmax(db), db.shape)
+    report['psd'] = dict(max_db=float(db.max()),
+                         median_db=float(np.median(db[good])),
+                         worst_freq=float(ref['freqs'][worst[1]]))
+    report['ok'] = bool(
+        all(e['max_rel'] <= tolerances['evoked_rel']
+            for e in report['evoked'].values()) and
+        report['psd']['max_db'] <= tolerances['psd_db'])
+    if out is not None:
+        with open(out, 'w') as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+def format_report(report):
+    """The report of ``validate`` as a table."""
+    lines = ['{:<24} {:>12} {:>12} {:>6}'.format('evoked', 'max rel',
+                                                  'rms rel', 'nave')]
+    for c, e in report['evoked'].items():
+        lines.append('{:<24} {:12.2e} {:12.2e} {:6d}'.format(
+            c, e['max_rel'], e['rms_rel'], e['nave']))
+    psd = report['psd']
+    lines.append('PSD: max {:.2e} dB (at {:.1f} Hz), median {:.2e} dB'.format(
+        psd['max_db'], psd['worst_freq'], psd['median_db']))
+    lines.append('projectors: {}'.format(', '.join(report['projs']) or 'none'))
+    s, mb = report['seconds'], report['mbytes']
+    lines.append('float64 {:.2f} s, {:.0f} MB; float32 {:.2f} s, {:.0f} MB'.format(
+        s['float64'], mb['float64'], s['float32'], mb['float32']))
+    lines.append('within tolerances {}: {}'.format(
+        tolerances, 'yes' if report['ok'] else 'NO'))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('fname', help='raw fif file')
+    parser.add_argument('--stim', default=None, help='stim channel')
+    parser.add_argument('--l-freq', type=float, default=1.)
+    parser.add_argument('--decim', type=int, default=1)
+    parser.add_argument('--ica', type=int, default=None, metavar='N',
+                        help='fit an ICA with N components, apply its '
+                             'EOG/ECG components')
+    parser.add_argument('--out', default=None, help='JSON report')
+    args = parser.parse_args()
+
+    raw = mne.io.read_raw_fif(args.fname, preload=True, verbose=False)
+    events = mne.find_events(raw, stim_channel=args.stim, verbose=False)
+    event_id = {str(e): int(e) for e in np.unique(events[:, 2])}
+    ica = None
+    if args.ica:
+        import eeg_artifacts
+        import eeg_filter
+        import eeg_ica
+
+        ica = eeg_ica.fit_ica(eeg_filter.filter_raw(raw, l_freq=1.),
+                              n_components=args.ica, random_state=97)
+        eeg_artifacts.classify(raw, ica)
+    report = validate(raw, events, event_id, ica=ica, l_freq=args.l_freq,
+                      decim=args.decim, out=args.out)
+    print(format_report(report))
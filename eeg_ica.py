@@ -0,0 +1,542 @@
+"""
+ICA fits with an on-disk cache.
+
+``fit_ica(inst, **params)`` does ``ICA(**params).fit(inst)``, except that
+
+- the finished solution is saved under a hash of the data, picks and
+  parameters, and an identical refit just reads it back;
+- the PCA step (pre-whitened data -> principal components) is cached too and
+  shared by every fit on the same data, so a sweep over n_components only
+  runs the ICA iterations once per value.
+
+The ICA solutions are the ones ``ICA.fit`` gives (same random_state, same
+components); only the SVD is skipped on a PCA hit.
+
+For method='fastica' the fit can also run the FastICA iterations over blocks
+of samples on several cores (``n_jobs``), start from another fit's unmixing
+matrix (``warm_start``, e.g. the previous session of the same subject) and
+report every iteration's time and convergence delta (``callback``).
+
+``apply_ica(inst, ica)`` is ``ica.apply(inst)`` as a low-rank update: only
+the excluded components' contribution is subtracted, in place and chunk by
+chunk, which costs O(channels x k x samples) instead of a full
+channels x channels reconstruction. ``preview``/``plot_overlay`` clean the
+same data with several exclusion sets from one source decomposition.
+"""
+
+import os
+import time
+import hashlib
+from contextlib import contextmanager
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy import linalg
+import mne
+from mne.preprocessing import ica as _ica_module
+try:
+    from mne.io.proj import make_projector
+except ImportError:  # mne >= 1.6
+    from mne._fiff.proj import make_projector
+
+# set to None to keep only the in-memory PCA cache
+cache_dir = os.environ.get('EEG_ICA_CACHE', os.path.join(
+    os.path.expanduser('~'), '.cache', 'eeg_ica'))
+max_pca_cached = 4  # PCA decompositions kept in memory (LRU)
+
+_pca_cache = OrderedDict()
+_stats = dict(hits=0, misses=0, pca_hits=0, pca_misses=0)
+
+
+def cache_info():
+    return dict(_stats, pca_size=len(_pca_cache))
+
+
+# #### hashing ####
+
+def data_hash(inst, block=100000):
+    """sha1 over the data, channel info and annotations of a Raw/Epochs."""
+    h = hashlib.sha1()
+    info = inst.info
+    h.update(repr((info['ch_names'], inst.get_channel_types(), info['bads'],
+                   float(info['sfreq']))).encode())
+    if isinstance(inst, mne.io.BaseRaw):
+        annot = inst.annotations
+        h.update(repr((list(annot.onset), list(annot.duration),
+                       list(annot.description))).encode())
+        for start in range(0, inst.n_times, block):  # never the whole raw at once
+            h.update(np.ascontiguousarray(inst.get_data(start=start,
+                                                        stop=start + block)))
+    else:
+        h.update(np.ascontiguousarray(inst.get_data()))
+        h.update(np.ascontiguousarray(inst.events))
+    return h.hexdigest()
+
+
+def _params_key(data_key, ica_params, fit_params):
+    params = sorted(ica_params.items()) + sorted(fit_params.items())
+    return hashlib.sha1((data_key + repr(params)).encode()).hexdigest()
+
+
+# #### shared PCA ####
+
+_PCA = getattr(_ica_module, '_PCA', None)
+
+
+def _load_pca(key):
+    if key in _pca_cache:
+        _pca_cache.move_to_end(key)
+        return _pca_cache[key]
+    fname = cache_dir and os.path.join(cache_dir, key + '-pca.npz')
+    if fname and os.path.exists(fname):
+        with np.load(fname) as f:
+            state = {k: f[k] for k in f.files}
+        _remember_pca(key, state)
+        return state
+    return None
+
+
+def _remember_pca(key, state, save=False):
+    _pca_cache[key] = state
+    while len(_pca_cache) > max_pca_cached:
+        _pca_cache.popitem(last=False)
+    if save and cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        fname = os.path.join(cache_dir, key + '-pca.npz')
+        tmp = '{}.{}.tmp.npz'.format(fname[:-4], os.getpid())
+        np.savez(tmp, **state)
+        os.replace(tmp, fname)
+
+
+if _PCA is not None:
+    class _SharedPCA(_PCA):
+        """mne's _PCA, with the SVD looked up by a hash of its input."""
+
+        def _fit(self, X):
+            # float64 even for float32 data: the SVD and the unmixing
+            # matrix fitted on its output are the sensitive part
+            X = np.ascontiguousarray(X, dtype=np.float64)
+            key = hashlib.sha1(X).hexdigest() + '-{}'.format(self.n_components)
+            state = _load_pca(key)
+            if state is None:
+                _stats['pca_misses'] += 1
+                U, S, V = super()._fit(X)
+                state = {k: np.asarray(v) for k, v in vars(self).items()
+                         if k.endswith('_')}
+                state.update(_S=S, _V=V)
+                _remember_pca(key, state, save=True)
+                return U, S, V
+
+            _stats['pca_hits'] += 1
+            for k, v in state.items():
+                if not k.startswith('_'):
+                    setattr(self, k, v.item() if v.ndim == 0 else v)
+            S, V = state['_S'], state['_V']
+            X -= self.mean_
+            U = X @ V.T  # one GEMM instead of the SVD
+            nonzero = S > 0
+            U[:, nonzero] /= S[nonzero]
+            return U, S, V
+
+
+@contextmanager
+def shared_pca():
+    """Inside this block, ICA.fit reuses PCA decompositions of identical data."""
+    if _PCA is None:  # mne without _PCA: nothing to share
+        yield
+        return
+    _ica_module._PCA = _SharedPCA
+    try:
+        yield
+    finally:
+        _ica_module._PCA = _PCA
+
+
+# #### block-parallel FastICA ####
+
+class ConvergenceLog(object):
+    """Callback that keeps (and optionally prints) the per-iteration stats.
+
+    Long ``seconds`` per iteration means the fit is compute-bound (more
+    cores/fewer samples help); many iterations with a slowly shrinking
+    ``delta`` means it converges slowly (warm start/tol help).
+    """
+
+    def __init__(self, verbose=False):
+        self.verbose = verbose
+        self.history = []
+
+    def __call__(self, stats):
+        self.history.append(stats)
+        if self.verbose:
+            print('iter {:4d}  {:7.1f} ms  delta {:.2e}'.format(
+                stats['iteration'], stats['seconds'] * 1e3, stats['delta']))
+
+    @property
+    def n_iter(self):
+        return len(self.history)
+
+    @property
+    def seconds_per_iter(self):
+        if not self.history:
+            return 0.
+        return sum(s['seconds'] for s in self.history) / len(self.history)
+
+
+def _g_logcosh(y, alpha):
+    y *= alpha
+    np.tanh(y, out=y)
+    return y, (alpha * (1 - y ** 2)).sum(axis=1)
+
+
+def _g_exp(y, alpha):
+    y2 = y ** 2
+    e = np.exp(-y2 / 2)
+    return y * e, ((1 - y2) * e).sum(axis=1)
+
+
+def _g_cube(y, alpha):
+    return y ** 3, (3 * y ** 2).sum(axis=1)
+
+
+_nonlinearities = dict(logcosh=_g_logcosh, exp=_g_exp, cube=_g_cube)
+
+
+def _sym_decorrelation(W):
+    # W <- (W W.T)^-1/2 W, as in sklearn
+    s, u = linalg.eigh(W @ W.T)
+    s = np.clip(s, np.finfo(W.dtype).tiny, None)
+    return np.linalg.multi_dot([u * (1. / np.sqrt(s)), u.T, W])
+
+
+def fastica_par(X, w_init, fun='logcosh', fun_args=None, max_iter=200,
+                tol=1e-4, n_jobs=1, callback=None):
+    """sklearn's parallel FastICA loop with the sums split over sample blocks.
+
+    ``X`` is whitened data (n_components, n_samples). Every iteration needs
+    E[g(WX) X.T] and E[g'(WX)]; each block computes its partial sums in a
+    thread (numpy releases the GIL) and they are added up. Returns (W, n_iter).
+    """
+    g = _nonlinearities[fun]
+    alpha = (fun_args or {}).get('alpha', 1.)
+    n_jobs = os.cpu_count() if n_jobs in (None, -1) else n_jobs
+    n_samples = X.shape[1]
+    bounds = np.linspace(0, n_samples, n_jobs + 1).astype(int)
+    blocks = [X[:, a:b] for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+
+    def partial(W, Xb):
+        gy, gpy = g(W @ Xb, alpha)
+        return gy @ Xb.T, gpy
+
+    W = _sym_decorrelation(w_init)
+    with ThreadPoolExecutor(max_workers=len(blocks)) as pool, _one_blas_thread(n_jobs):
+        for ii in range(max_iter):
+            t0 = time.perf_counter()
+            if len(blocks) == 1:
+                parts = [partial(W, blocks[0])]
+            else:
+                parts = list(pool.map(lambda Xb: partial(W, Xb), blocks))
+            gwtx = sum(p[0] for p in parts) / n_samples
+            g_wtx = sum(p[1] for p in parts) / n_samples
+            W1 = _sym_decorrelation(gwtx - g_wtx[:, np.newaxis] * W)
+            delta = max(abs(abs(np.einsum('ij,ij->i', W1, W)) - 1))
+            W = W1
+            if callback is not None:
+                callback(dict(iteration=ii + 1, seconds=time.perf_counter() - t0,
+                              delta=float(delta), n_blocks=len(blocks)))
+            if delta < tol:
+                break
+        else:
+            mne.utils.warn('FastICA did not converge in {} iterations'.format(max_iter))
+    return W, ii + 1
+
+
+@contextmanager
+def _one_blas_thread(n_jobs):
+    # the blocks already use every core; a threaded BLAS inside each block
+    # would only oversubscribe
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        threadpool_limits = None
+    if n_jobs == 1 or threadpool_limits is None:
+        yield
+        return
+    with threadpool_limits(limits=1, user_api='blas'):
+        yield
+
+
+def _warm_start_matrix(prev, ica, rng):
+    """Unmixing of ``prev`` expressed in ``ica``'s PCA-whitened space.
+
+    Both fits must be on the same channels; goes through channel space, so
+    the two PCA bases (subjects/sessions) can differ.
+    """
+    if isinstance(prev, np.ndarray):
+        return prev
+    if list(prev.ch_names) != list(ica.ch_names):
+        raise ValueError('warm_start ICA was fit on different channels')
+    n_prev, n = prev.n_components_, ica.n_components_
+
+    def pre_whitener(inst):  # as a matrix acting on channel data
+        pw = inst.pre_whitener_
+        return np.diag(1. / pw[:, 0]) if pw.shape[1] == 1 else pw
+
+    # channel-space unmixing of the previous fit
+    U = prev.unmixing_matrix_ @ prev.pca_components_[:n_prev] @ pre_whitener(prev)
+    # -> pre-whitened space of the new fit -> its whitened PCA space
+    U = U @ linalg.pinv(pre_whitener(ica))
+    W = U @ ica.pca_components_[:n].T * np.sqrt(ica.pca_explained_variance_[:n])
+    if n_prev < n:  # more components this time: random rows for the rest
+        W = np.vstack([W, rng.normal(size=(n - n_prev, n))])
+    return W[:n]
+
+
+@contextmanager
+def parallel_fastica(ica, n_jobs=1, warm_start=None, callback=None):
+    """Inside this block, ``ica.fit`` runs ``fastica_par`` instead of sklearn."""
+    import sklearn.decomposition as skd
+
+    orig = skd.FastICA
+
+    class _BlockFastICA(object):
+        # the parts of sklearn.decomposition.FastICA that ICA._fit uses
+        def __init__(self, whiten=False, random_state=None, fun='logcosh',
+                     fun_args=None, max_iter=200, tol=1e-4, w_init=None,
+                     algorithm='parallel', **kwargs):
+            self.random_state = random_state
+            self.fun, self.fun_args = fun, fun_args
+            self.max_iter, self.tol, self.w_init = max_iter, tol, w_init
+
+        def fit(self, X):
+            XT = np.asarray(X, dtype=np.float64).T
+            n = XT.shape[0]
+            rng = np.random.RandomState(self.random_state) \
+                if not isinstance(self.random_state, np.random.RandomState) \
+                else self.random_state
+            if warm_start is not None:
+                w_init = _warm_start_matrix(warm_start, ica, rng)
+            elif self.w_init is not None:
+                w_init = np.asarray(self.w_init)
+            else:  # same draw as sklearn, so n_jobs doesn't change the result
+                w_init = rng.normal(size=(n, n))
+            self.components_, self.n_iter_ = fastica_par(
+                XT, w_init, self.fun, self.fun_args, self.max_iter, self.tol,
+                n_jobs=n_jobs, callback=callback)
+            return self
+
+    skd.FastICA = _BlockFastICA
+    try:
+        yield
+    finally:
+        skd.FastICA = orig
+
+
+# #### cached fits ####
+
+def fit_ica(inst, picks=None, start=None, stop=None, decim=None, reject=None,
+            data_key=None, n_jobs=None, warm_start=None, callback=None,
+            **ica_params):
+    """``ICA(**ica_params).fit(inst, ...)``, cached on disk.
+
+    ``data_key`` can be passed to skip hashing the data (e.g. from data_hash
+    when fitting the same data several times). ``n_jobs``, ``warm_start`` (an
+    ICA fit on the same channels, or a whitened-space unmixing matrix) and
+    ``callback`` (called with a dict per iteration, see ConvergenceLog) use
+    the block-parallel FastICA and need method='fastica'.
+    """
+    fit_params = dict(picks=picks, decim=decim, reject=reject)
+    if isinstance(inst, mne.io.BaseRaw):
+        fit_params.update(start=start, stop=stop)
+    block_fit = n_jobs is not None or warm_start is not None or callback is not None
+    if block_fit and ica_params.get('method', 'fastica') != 'fastica':
+        raise ValueError('n_jobs/warm_start/callback need method="fastica"')
+    data_key = data_key or data_hash(inst)
+    fname = None
+    if cache_dir:
+        key_params = dict(ica_params)
+        if warm_start is not None:  # a warm start can end in another solution
+            w = warm_start if isinstance(warm_start, np.ndarray) else \
+                warm_start.unmixing_matrix_
+            key_params['warm_start'] = hashlib.sha1(
+                np.ascontiguousarray(w)).hexdigest()
+        key = _params_key(data_key, key_params, fit_params)
+        fname = os.path.join(cache_dir, key + '-ica.fif')
+        if os.path.exists(fname):
+            _stats['hits'] += 1
+            return mne.preprocessing.read_ica(fname, verbose=False)
+
+    _stats['misses'] += 1
+    ica = mne.preprocessing.ICA(**ica_params)
+    with shared_pca():
+        if block_fit:
+            with parallel_fastica(ica, n_jobs or 1, warm_start, callback):
+                ica.fit(inst, **fit_params)
+        else:
+            ica.fit(inst, **fit_params)
+    if fname:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = '{}.{}.tmp-ica.fif'.format(fname[:-len('-ica.fif')], os.getpid())
+        ica.save(tmp, overwrite=True, verbose=False)
+        os.replace(tmp, fname)
+    return ica
+
+
+def fit_ica_sweep(inst, n_components, **kwargs):
+    """One fit per value of ``n_components``; the PCA is computed once."""
+    kwargs.setdefault('data_key', data_hash(inst))
+    return {n: fit_ica(inst, n_components=n, **kwargs) for n in n_components}
+
+
+# #### apply ####
+
+chunk_samples = 100000  # samples (x epochs) cleaned at a time by apply_ica
+
+
+def _ica_picks(info, ica):
+    picks = mne.pick_types(info, meg=False, ref_meg=False, include=ica.ch_names,
+                           exclude=[])
+    if len(picks) != len(ica.ch_names):
+        raise RuntimeError('Data does not match the fit: {} channels fitted but '
+                           '{} supplied'.format(len(ica.ch_names), len(picks)))
+    return picks
+
+
+def exclusion_update(ica, exclude=None):
+    """(A, B, c) with ``ica.apply`` == ``data - A @ (B @ data - c)``.
+
+    Rows/columns are the excluded components (in the order of ``exclude``),
+    then the PCA components ica.apply drops (beyond n_pca_components) and
+    the active projectors, so the result is exact. Returns None when the
+    ICA was fitted with a noise_cov (use ica.apply then).
+    """
+    if ica.noise_cov is not None:
+        return None
+    exclude = list(ica.exclude if exclude is None else exclude)
+    n_comp = ica.n_components_
+    n_pca = ica._check_n_pca_components(ica.n_pca_components)
+    pca = ica.pca_components_
+    n_ch = pca.shape[1]
+    if pca.shape[0] != n_ch:
+        return None  # the dropped part is not spanned by the stored PCs
+    # excluded components + dropped PCA components, in the pre-whitened space
+    left = np.concatenate([np.dot(pca[:n_comp].T, ica.mixing_matrix_[:, exclude]),
+                           pca[n_pca:].T], axis=1)
+    right = np.concatenate([np.dot(ica.unmixing_matrix_[exclude], pca[:n_comp]),
+                            pca[n_pca:]])
+    mean = np.zeros(n_ch) if ica.pca_mean_ is None else ica.pca_mean_
+    c = np.dot(right, mean)
+    scale = ica.pre_whitener_[:, 0]
+    A, B = left * scale[:, None], right / scale[None, :]
+    projs = [p for p in ica.info['projs'] if p['active']] if ica.info else []
+    if projs:
+        # ica.apply projects before whitening: B -> B @ P, plus (I - P) itself
+        proj, n_proj, _ = make_projector(projs, ica.info['ch_names'],
+                                         include_active=True)
+        if n_proj:
+            u = linalg.svd(np.eye(n_ch) - proj)[0][:, :n_proj]
+            A = np.concatenate([A, u], axis=1)
+            B = np.concatenate([np.dot(B, proj), u.T])
+            c = np.concatenate([c, np.zeros(n_proj)])
+    return A, B, c
+
+
+def _subtract(block, A, B, c):
+    # block: (..., n_channels, n_times), in place
+    block -= np.matmul(A, np.matmul(B, block) - c[:, None])
+    return block
+
+
+def apply_ica(inst, ica, exclude=None):
+    """``ica.apply(inst, exclude=exclude)`` as a rank-k update, in place.
+
+    Works on a preloaded Raw, Epochs or an Evoked, ``chunk_samples`` at a
+    time, in the precision of its data. Channels are picked and ``exclude``
+    is merged with ica.exclude like in ica.apply.
+    """
+    exclude = sorted(set(ica.exclude) | set(exclude or []))
+    update = exclusion_update(ica, exclude)
+    if update is None:
+        return ica.apply(inst, exclude=exclude)
+    picks = _ica_picks(inst.info, ica)
+    data = inst.data if isinstance(inst, mne.Evoked) else inst._data
+    # float32 data is cleaned in float32
+    update = [m.astype(data.dtype, copy=False) for m in update]
+    if isinstance(inst, mne.BaseEpochs):
+        step = max(chunk_samples // data.shape[-1], 1)
+        for start in range(0, len(data), step):
+            block = data[start:start + step][:, picks]
+            data[start:start + step, picks] = _subtract(block, *update)
+    else:
+        for start in range(0, data.shape[-1], chunk_samples):
+            block = data[picks, start:start + chunk_samples]
+            data[picks, start:start + chunk_samples] = _subtract(block, *update)
+    return inst
+
+
+def preview(inst, ica, exclude_sets, start=None, stop=None):
+    """(data, [cleaned, ...]) of ica's channels, one per exclusion set.
+
+    Each set is used as is (ica.exclude is not added). The sources of the
+    union of all sets are computed once; each variant is then one rank-k
+    subtraction. ``start``/``stop`` (s) crop a Raw.
+    """
+    picks = _ica_picks(inst.info, ica)
+    if isinstance(inst, mne.io.BaseRaw):
+        start, stop = inst.time_as_index([start or 0., stop or inst.times[-1]])
+        data = inst.get_data(picks=picks, start=start, stop=stop + 1)
+    elif isinstance(inst, mne.Evoked):
+        data = inst.data[picks]
+    else:
+        data = inst.get_data(picks=picks)
+    union = sorted(set(int(i) for these in exclude_sets for i in these))
+    A, B, c = exclusion_update(ica, union)
+    sources = np.matmul(B, data) - c[:, None]
+    fixed = list(range(len(union), len(c)))  # dropped PCs + projectors
+    cleaned = []
+    for these in exclude_sets:
+        rows = [union.index(int(i)) for i in these] + fixed
+        cleaned.append(data - np.matmul(A[:, rows], sources[..., rows, :]))
+    return data, cleaned
+
+
+def plot_overlay(inst, ica, exclude_sets, start=0., stop=3., show=True):
+    """``ica.plot_overlay`` for several exclusion sets, one preview for all.
+
+    One figure per set, one row per channel type: a Raw shows the channel
+    mean over ``start``-``stop`` s, an Evoked all channels (butterfly);
+    before in red, after in black.
+    """
+    import matplotlib.pyplot as plt
+    from mne.defaults import DEFAULTS
+
+    if isinstance(inst, mne.io.BaseRaw):
+        data, cleaned = preview(inst, ica, exclude_sets, start, stop)
+        times = start + np.arange(data.shape[-1]) / inst.info['sfreq']
+    else:
+        data, cleaned = preview(inst, ica, exclude_sets)
+        times = inst.times
+    info = mne.pick_info(inst.info, _ica_picks(inst.info, ica))
+    types = info.get_channel_types()
+    ch_types = [t for t in DEFAULTS['units'] if t in types]
+    figs = []
+    for these, clean in zip(exclude_sets, cleaned):
+        fig, axes = plt.subplots(len(ch_types), 1, sharex=True, squeeze=False,
+                                 figsize=(8, 2.5 * len(ch_types)))
+        for ax, ch_type in zip(axes[:, 0], ch_types):
+            idx = [i for i, t in enumerate(types) if t == ch_type]
+            scale = DEFAULTS['scalings'][ch_type]
+            before, after = data[idx] * scale, clean[idx] * scale
+            if isinstance(inst, mne.io.BaseRaw):
+                before, after = before.mean(axis=0), after.mean(axis=0)
+            ax.plot(times, before.T, color='r', linewidth=0.5)
+            ax.plot(times, after.T, color='k', linewidth=0.5)
+            ax.set(ylabel='{} ({})'.format(ch_type.upper(),
+                                           DEFAULTS['units'][ch_type]))
+        axes[-1, 0].set(xlabel='Time (s)', xlim=(times[0], times[-1]))
+        fig.suptitle('Cleaned signal, excluding ICA {}'.format(list(these)))
+        figs.append(fig)
+    if show:
+        plt.show()
+    return figs
@@ -8,10 +8,21 @@ from sklearn.model_selection import ShuffleSplit, cross_val_score
 
 import mne
 
+import eeg_cache
+import eeg_decoding
+import eeg_events
+import eeg_psd
+import eeg_pyramid
+
 # #### 1) Loading data ####
 
-sample_data_raw_file = 'C:/Users/lykoi/Desktop/BCICIV_2a_gdf/A01T.gdf'
-raw = mne.io.read_raw_gdf(sample_data_raw_file)
+# GDFs are converted once into a memory-mapped cache (see eeg_cache.py);
+# unchanged files are skipped, so this is only slow on the first run
+gdf_folder = 'C:/Users/lykoi/Desktop/BCICIV_2a_gdf'
+cache_folder = os.path.join(gdf_folder, 'cache')
+eeg_cache.import_dir(gdf_folder, cache_folder)
+cached = eeg_cache.open_cached(cache_folder, 'A01T')
+raw = cached.to_raw()
 
 print(raw.info)
 
@@ -24,20 +35,15 @@ print('the (cropped) sample data object has {} time samples and {} channels.'
 print('The last time sample is at {} seconds.'.format(time_secs[-1]))
 
 raw.plot()
-raw.plot(duration=60, proj=False, n_channels=len(raw.ch_names),
-         remove_dc=False)
+# all channels over the whole recording: redrawn from the min/max pyramid
+# next to the cache (see eeg_pyramid.py), not from the full-rate data
+eeg_pyramid.browse(cached, duration=60, remove_dc=False)
 
 # plot spectral density
-raw.plot_psd(average=True)
-
-# edit channel types & names
-raw.set_channel_types({'EOG-left': 'eog', 'EOG-central': 'eog', 'EOG-right': 'eog'})
-channel_renaming_dict = {'EEG-0': 'EEG-FC3', 'EEG-1': 'EEG-FC1', 'EEG-2': 'EEG-FCz', 'EEG-3': 'EEG-FC2', 'EEG-4': 'EEG-FC4',
-                         'EEG-5': 'EEG-C5', 'EEG-6': 'EEG-C1', 'EEG-7': 'EEG-C2', 'EEG-8': 'EEG-C6',
-                         'EEG-9': 'EEG-CP3', 'EEG-10': 'EEG-CP1', 'EEG-11': 'EEG-CPz', 'EEG-12': 'EEG-CP2', 'EEG-13': 'EEG-CP4',
-                         'EEG-14': 'EEG-P1', 'EEG-15': 'EEG-P2', 'EEG-16': 'EEG-POz'}
-raw.rename_channels(channel_renaming_dict)
+eeg_psd.compute_psd(raw).plot(average=True)
 
+# channel types & names (EOG typing, EEG-0... -> 10-20) are already fixed
+# in the cache, see eeg_cache.fix_channels
 eeg_raw = raw.copy().pick_types(eeg=True, eog=False)
 eog_raw = raw.copy().pick_types(eeg=False, eog=True)
 print(len(raw.ch_names), '→', len(eeg_raw.ch_names), '+', len(eog_raw.ch_names))
@@ -46,7 +52,8 @@ print(len(raw.ch_names), '→', len(eeg_raw.ch_names), '+', len(eog_raw.ch_names
 # read embedded events as annotations
 print(raw.annotations)
 
-events_from_annot, event_dict = mne.events_from_annotations(raw)
+annot_table = eeg_events.from_annotations(raw)
+events_from_annot, event_dict = annot_table.events, annot_table.event_id
 print(event_dict)
 print(events_from_annot[:10])
 
@@ -56,8 +63,8 @@ fig = mne.viz.plot_events(events_from_annot, event_id=event_dict, sfreq=raw.info
                           first_samp=raw.first_samp)
 
 # subselecting events
-events_lh = mne.pick_events(events_from_annot, include=7)
-events_rh = mne.pick_events(events_from_annot, include=8)
+events_lh = annot_table.select(code=7).events
+events_rh = annot_table.select(code=8).events
 
 custom_dict = {'1023': 'rejected trial', '1072': 'eye movement',
                   '276': 'idling/eyes open', '277': 'idling/eyes closed',
@@ -65,4 +72,19 @@ custom_dict = {'1023': 'rejected trial', '1072': 'eye movement',
                   '769': 'cue onset/left hand', '770': 'cue onset/right hand',
                   '771': 'cue onset/foot', '772': 'cue onset/tongue'}
 
-(events_from_annot, event_dict) = mne.events_from_annotations(raw, event_id=custom_dict)
\ No newline at end of file
+# BCICIV codes as event codes, named by custom_dict ('cue onset/left hand',
+# ...), so table.select(tag='cue onset') picks all four cues
+annot_table = eeg_events.from_annotations(
+    raw, event_id={code: int(code) for code in custom_dict}, names=custom_dict)
+events_from_annot, event_dict = annot_table.events, annot_table.event_id
+
+# #### 2) Decoding ####
+
+# CSP + LDA, left vs right hand cues of every subject, 10 ShuffleSplit folds;
+# the band-passed epoch covariances are computed once per subject and cached
+# (see eeg_decoding.py). In this process: pool workers would re-run this
+# script; for the process pool use
+#   python eeg_decoding.py <cache_folder> A01T A02T ... A09T
+subjects = {name: eeg_cache.open_cached(cache_folder, name)
+            for name in ['A0{}T'.format(i) for i in range(1, 10)]}
+decoding = eeg_decoding.evaluate(subjects, n_splits=10, n_jobs=1)
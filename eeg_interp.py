@@ -0,0 +1,160 @@
+"""
+Bad-channel interpolation with cached interpolation matrices.
+
+``raw.interpolate_bads()`` and autoreject's per-epoch repair rebuild the
+spherical-spline (EEG) or field-mapping (MEG) matrix on every call, although
+it only depends on the sensor geometry and on which channels are bad. Here the
+matrices are kept in an LRU cache keyed on (geometry, bad set, method, origin,
+mode), and applying one is a single matmul over the whole (n_epochs,
+n_channels, n_times) array:
+
+    eeg_interp.interpolate_bads(epochs)                  # like epochs.interpolate_bads()
+    eeg_interp.interpolate_epochs(data, info, bads_per_epoch, picks)  # autoreject
+"""
+
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+import mne
+from mne.bem import _check_origin
+from mne.channels.interpolation import _make_interpolation_matrix
+from mne.forward import _map_meg_or_eeg_channels
+
+max_cached = 256  # matrices kept in memory (LRU)
+
+_cache = OrderedDict()
+_stats = dict(hits=0, misses=0)
+
+
+def cache_info():
+    return dict(_stats, size=len(_cache), max_size=max_cached)
+
+
+def clear_cache():
+    _cache.clear()
+    for k in _stats:
+        _stats[k] = 0
+
+
+def geometry_key(info, picks):
+    """Hash of names, coil types and positions of ``picks`` (+ dev_head_t)."""
+    h = hashlib.sha1()
+    for p in picks:
+        ch = info['chs'][p]
+        h.update(ch['ch_name'].encode())
+        h.update(np.int64(ch['coil_type']).tobytes())
+        h.update(np.asarray(ch['loc'], np.float64).tobytes())
+    if info['dev_head_t'] is not None:
+        h.update(np.asarray(info['dev_head_t']['trans'], np.float64).tobytes())
+    return h.hexdigest()
+
+
+# #### matrices ####
+
+def interpolation_matrix(info, picks, bads, method='spline', origin=None,
+                         mode='accurate'):
+    """(goods, bad_picks, M) such that ``data[bad_picks] = M @ data[goods]``.
+
+    ``picks`` are the channels of one sensor family (EEG or MEG) to interpolate
+    from/to, ``bads`` are channel names. ``method`` is 'spline' (EEG spherical
+    splines) or 'MNE' (field mapping, MEG or EEG). ``origin`` is a head-frame
+    point in m; None means no shift (what autoreject does for EEG).
+    """
+    picks = np.asarray(picks)
+    bads = set(bads)
+    is_bad = np.array([info['ch_names'][p] in bads for p in picks], bool)
+    goods, bad_picks = picks[~is_bad], picks[is_bad]
+    if origin is not None:
+        origin = tuple(float(o) for o in origin)
+    key = (method, geometry_key(info, picks), tuple(bad_picks.tolist()),
+           origin, mode)
+    if key in _cache:
+        _cache.move_to_end(key)
+        _stats['hits'] += 1
+        return goods, bad_picks, _cache[key]
+    _stats['misses'] += 1
+
+    if method == 'spline':
+        pos = np.array([info['chs'][p]['loc'][:3] for p in picks])
+        if origin is not None:
+            pos = pos - origin
+        M = _make_interpolation_matrix(pos[~is_bad], pos[is_bad])
+    elif method == 'MNE':
+        origin = (0., 0., 0.04) if origin is None else origin
+        is_eeg = info['chs'][picks[0]]['kind'] == mne.io.constants.FIFF.FIFFV_EEG_CH
+        # like mne: EEG is mapped to all channels and the bad rows selected
+        picks_to = picks if is_eeg else bad_picks
+        with mne.utils.use_log_level('error'):
+            M = _map_meg_or_eeg_channels(mne.pick_info(info, goods),
+                                         mne.pick_info(info, picks_to),
+                                         mode=mode, origin=np.array(origin))
+        if is_eeg:
+            M = M[is_bad]
+    else:
+        raise ValueError('method must be "spline" or "MNE", got {!r}'
+                         .format(method))
+
+    M.flags.writeable = False  # shared between callers
+    _cache[key] = M
+    while len(_cache) > max_cached:
+        _cache.popitem(last=False)
+    return goods, bad_picks, M
+
+
+def _families(info, picks, eeg_method):
+    """Split ``picks`` into EEG and MEG, with their interpolation method."""
+    eeg = set(mne.pick_types(info, meg=False, eeg=True, exclude=[]))
+    meg = set(mne.pick_types(info, meg=True, eeg=False, exclude=[]))
+    families = []
+    for method, family in ((eeg_method, eeg), ('MNE', meg)):
+        these = [p for p in picks if p in family]
+        if these:
+            families.append((these, method))
+    return families
+
+
+# #### apply ####
+
+def interpolate_bads(inst, picks=None, reset_bads=True, mode='accurate',
+                     origin='auto', eeg_method='spline'):
+    """``inst.interpolate_bads()`` (Raw, Epochs or Evoked, in place), cached."""
+    if picks is None:
+        picks = mne.pick_types(inst.info, meg=True, eeg=True, exclude=[])
+    if origin is not None:
+        origin = _check_origin(origin, inst.info)
+    bads = inst.info['bads']
+    data = inst._data
+    for these, method in _families(inst.info, picks, eeg_method):
+        if not any(inst.ch_names[p] in bads for p in these):
+            continue
+        goods, bad_picks, M = interpolation_matrix(
+            inst.info, these, bads, method=method, origin=origin, mode=mode)
+        data[..., bad_picks, :] = np.matmul(M, data[..., goods, :])
+    if reset_bads:
+        inst.info['bads'] = []
+    return inst
+
+
+def interpolate_epochs(data, info, bads_per_epoch, picks, origin=None,
+                       mode='accurate'):
+    """Repair ``data`` (n_epochs, n_channels, n_times) in place.
+
+    ``bads_per_epoch`` holds a list of channel names per epoch (e.g. from
+    autoreject's ``_get_interp_chs``). Epochs sharing a bad set are repaired
+    with one matmul.
+    """
+    groups = OrderedDict()
+    for idx, bads in enumerate(bads_per_epoch):
+        if len(bads):
+            groups.setdefault(tuple(bads), []).append(idx)
+    families = _families(info, picks, 'spline')
+    for bads, idx in groups.items():
+        sub = data[idx]
+        for these, method in families:
+            goods, bad_picks, M = interpolation_matrix(
+                info, these, bads, method=method, origin=origin, mode=mode)
+            if len(bad_picks):
+                sub[:, bad_picks] = np.matmul(M, sub[:, goods])
+        data[idx] = sub
+    return data
@@ -0,0 +1,193 @@
+"""
+Line-noise removal by sinusoid fits, all harmonics and channels at once.
+
+``raw.notch_filter(freqs, method='spectrum_fit', filter_length='10s')`` goes
+channel by channel and, per channel, window by window through a multitaper
+spectrum to fit the sinusoids at the line frequencies. Here a window of all
+channels is fitted in one least-squares solve: the cos/sin design matrix of
+every sinusoid (the same bins around each harmonic that spectrum_fit
+removes, ``notch_widths`` = freq / 200 by default) and its pseudo-inverse
+are computed once and shared by all windows, so a block of windows is two
+batched matmuls:
+
+    coefs = windows @ pinv(D).T        # (n_windows, n_channels, 2 n_sines)
+    fits = coefs @ D.T                 # the line noise in every window
+
+Windows overlap by half and are cross-faded with a Hann window (like the
+COLA scheme of spectrum_fit) and blocks of windows run in threads.
+
+With ``track=True`` the mains frequency may drift: per window, the phase
+advance of the fundamental between the two halves of the window gives its
+actual frequency, and every harmonic is fitted at its multiple (design
+matrices are kept per drift, quantized to ``track_resolution``).
+
+    eeg_linenoise.remove_line_noise_raw(raw, (60, 120, 180, 240), picks=picks)
+"""
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+import mne
+
+block_windows = 8  # windows fitted per batched solve
+track_resolution = 0.005  # Hz, drift steps of the tracked mains frequency
+max_designs = 32  # design matrices kept in memory (LRU)
+
+_designs = OrderedDict()
+
+
+def _design(n_times, sfreq, freqs, t0=0):
+    """(D, pinv(D)) of cos/sin columns at ``freqs`` over ``n_times`` samples
+    starting at sample ``t0``, cached."""
+    key = (n_times, sfreq, tuple(np.round(freqs, 9)), t0)
+    if key in _designs:
+        _designs.move_to_end(key)
+        return _designs[key]
+    phase = 2 * np.pi * np.outer((t0 + np.arange(n_times)) / sfreq, freqs)
+    D = np.concatenate([np.cos(phase), np.sin(phase)], axis=1)
+    value = (D, np.linalg.pinv(D))
+    _designs[key] = value
+    while len(_designs) > max_designs:
+        _designs.popitem(last=False)
+    return value
+
+
+def sine_freqs(freqs, notch_widths, duration, sfreq):
+    """The sinusoids fitted per window: each line frequency and the
+    1 / ``duration`` spaced bins within +-width/2 of it (like spectrum_fit)."""
+    out = []
+    for freq, width in zip(freqs, notch_widths):
+        n = int(np.ceil(round(width / 2. * duration, 6))) - 1
+        out += [freq + k / duration for k in range(-n, n + 1)]
+    out = np.array(out)
+    return out[(out > 0) & (out < sfreq / 2.)]
+
+
+def _windows(n_times, n_win):
+    # starts of half-overlapping windows, the last one flush with the end
+    starts = list(range(0, n_times - n_win + 1, n_win // 2))
+    if starts[-1] != n_times - n_win:
+        starts.append(n_times - n_win)
+    return np.array(starts)
+
+
+def track_line(data, sfreq, freq, window=10., starts=None):
+    """Drift (Hz) of the line frequency ``freq`` in every window.
+
+    The fundamental is fitted on both halves of a window (shared design
+    matrices, one solve for all channels); its phase advance, pooled over
+    channels by amplitude, is the drift. Unambiguous up to +-1 / window Hz.
+    """
+    n_win = min(int(round(window * sfreq)), data.shape[-1])
+    half = n_win // 2
+    if starts is None:
+        starts = _windows(data.shape[-1], n_win)
+    _, first = _design(half, sfreq, [freq])
+    _, second = _design(half, sfreq, [freq], t0=half)
+    views = sliding_window_view(data, n_win, axis=-1)
+    drift = np.empty(len(starts))
+    for i in range(0, len(starts), block_windows):
+        X = views[:, starts[i:i + block_windows]].transpose(1, 0, 2)
+        a = np.matmul(X[..., :half], first.T)
+        b = np.matmul(X[..., half:2 * half], second.T)
+        # complex amplitudes of x = c cos + s sin: c - i s
+        a, b = a[..., 0] - 1j * a[..., 1], b[..., 0] - 1j * b[..., 1]
+        advance = np.angle((b * a.conj()).sum(axis=-1))
+        drift[i:i + block_windows] = advance / (2 * np.pi * half / sfreq)
+    return drift
+
+
+def remove_line_noise(data, sfreq, freqs, notch_widths=None, window=10.,
+                      picks=None, track=False, n_jobs=None, copy=True):
+    """Subtract fitted line-noise sinusoids from (n_channels, n_times) data.
+
+    ``freqs`` are the line frequency and its harmonics, ``notch_widths``
+    (default freqs / 200, like mne) the band of bins fitted around each and
+    ``window`` the window length in s (filter_length='10s'). Rows not in
+    ``picks`` are left alone. With ``copy=False`` the data is cleaned in
+    place. ``n_jobs`` threads solve blocks of windows.
+    """
+    from scipy.signal import get_window  # ~0.5 s to import, only needed here
+
+    freqs = np.atleast_1d(np.asarray(freqs, float))
+    if notch_widths is None:
+        notch_widths = freqs / 200.
+    notch_widths = np.broadcast_to(notch_widths, freqs.shape)
+    picks = np.arange(len(data)) if picks is None else np.asarray(picks, int)
+    n_times = data.shape[-1]
+    n_win = min(int(round(window * sfreq)), n_times)
+    x = np.asarray(data[picks], dtype=np.float64)
+    starts = _windows(n_times, n_win)
+
+    # drift per window, in steps of track_resolution; 0 without tracking
+    drift = np.zeros(len(starts))
+    if track:
+        drift = track_line(x, sfreq, freqs[0], window, starts)
+        drift = np.round(drift / track_resolution) * track_resolution
+
+    taper = get_window('hann', n_win)
+    lead, tail = taper.copy(), taper.copy()
+    lead[:n_win // 2] = 1.  # nothing before the first window to fade with
+    tail[n_win // 2:] = 1.
+    weights = np.zeros(n_times)
+    for i, start in enumerate(starts):
+        w = lead if i == 0 else tail if i == len(starts) - 1 else taper
+        weights[start:start + n_win] += w
+
+    views = sliding_window_view(x, n_win, axis=-1)
+
+    def fit(idx):
+        # (starts, tapered fits) of a block of windows with the same drift
+        these = starts[idx]
+        scale = 1. + drift[idx[0]] / freqs[0]
+        D, P = _design(n_win, sfreq, sine_freqs(freqs * scale, notch_widths,
+                                                n_win / sfreq, sfreq))
+        X = views[:, these].transpose(1, 0, 2)
+        fits = np.matmul(np.matmul(X, P.T), D.T)
+        for j, i in enumerate(idx):
+            fits[j] *= lead if i == 0 else tail if i == len(starts) - 1 else taper
+        return these, fits
+
+    blocks = []
+    for value in np.unique(drift):
+        idx = np.flatnonzero(drift == value)
+        blocks += [idx[i:i + block_windows]
+                   for i in range(0, len(idx), block_windows)]
+    noise = np.zeros_like(x)
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        for these, fits in pool.map(fit, blocks):
+            for start, f in zip(these, fits):
+                noise[:, start:start + n_win] += f
+    noise /= weights
+
+    out = data if not copy else data.copy()
+    out[picks] = x - noise
+    return out
+
+
+def window_seconds(filter_length, sfreq):
+    """Window length in s of a spectrum_fit ``filter_length`` ('auto': 10 s,
+    '<n>s', '<n>ms' or a number of samples)."""
+    if filter_length == 'auto':
+        return 10.
+    if isinstance(filter_length, str):
+        if filter_length.endswith('ms'):
+            return float(filter_length[:-2]) / 1000.
+        return float(filter_length.rstrip('s'))
+    return filter_length / float(sfreq)
+
+
+def remove_line_noise_raw(raw, freqs, notch_widths=None, window=10.,
+                          picks=None, track=False, n_jobs=None, copy=False):
+    """``raw.notch_filter(freqs, method='spectrum_fit')`` on a preloaded Raw
+    (data channels by default); in place unless ``copy``."""
+    if picks is None:
+        picks = mne.pick_types(raw.info, meg=True, eeg=True, seeg=True,
+                               ecog=True, exclude=[])
+    if copy:
+        raw = raw.copy()
+    remove_line_noise(raw._data, raw.info['sfreq'], freqs, notch_widths,
+                      window, picks, track, n_jobs, copy=False)
+    return raw
@@ -0,0 +1,493 @@
+"""
+The study2 chain as a pipeline of cached stages.
+
+The scripts ran read -> filter -> ICA -> events -> epochs -> average from
+scratch, and study2_0324_events.py / study2_0324_epoching.py fitted the same
+ICA on the same file. Here the chain is a list of stages (see
+``study2_stages``); a stage is a function of the outputs of the stages it
+depends on plus its own parameters, and its output is saved under a key that
+hashes those parameters, the stage's code (bytecode and constants), the
+source files of the eeg_* modules it names and the keys of its inputs (the
+first stage hashes the content of the source file). So
+
+- running the same stages again, from any script, reads the outputs back,
+- changing a parameter re-runs that stage and the ones downstream of it only,
+  e.g. a new epoch window re-runs 'epochs' (+ 'autoreject') and 'evoked',
+- stages that do not depend on each other ('events' next to 'filter' ->
+  'ica' -> 'clean') run at the same time, in a thread pool.
+
+    pipe = eeg_pipeline.study2_pipeline(fname, epochs=dict(tmin=-0.3))
+    out = pipe.run(['ica', 'evoked'])
+    out['evoked']['auditory'].plot()
+
+``raw=dict(dtype='float32')`` runs filter -> clean -> epochs in float32
+(see eeg_float32); the ICA fit itself stays float64. The epochs are of the
+ICA-cleaned raw; ``epochs=dict(source='raw')`` epochs the raw as it is.
+
+Stage functions must not modify their inputs (they are shared with other
+stages and the in-memory cache); copy first. Stages that run or are read
+from disk are recorded by the installed eeg_profile profiler, if any.
+"""
+
+import os
+import time
+import types
+import pickle
+import hashlib
+import importlib.util
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+import mne
+
+import eeg_artifacts
+import eeg_cache
+import eeg_epochs
+import eeg_events
+import eeg_filter
+import eeg_float32
+import eeg_ica
+import eeg_profile
+
+# set to None to keep stage outputs in memory only
+cache_dir = os.environ.get('EEG_PIPELINE_CACHE', os.path.join(
+    os.path.expanduser('~'), '.cache', 'eeg_pipeline'))
+max_cached = 16  # stage outputs kept in memory (LRU)
+
+_cache = OrderedDict()
+_stats = dict(hits=0, disk_hits=0, misses=0)
+_file_keys = dict()  # (path, mtime, size) -> sha1 of the content
+
+
+def cache_info():
+    return dict(_stats, size=len(_cache))
+
+
+def clear_cache(disk=False):
+    _cache.clear()
+    for k in _stats:
+        _stats[k] = 0
+    if disk and cache_dir and os.path.isdir(cache_dir):
+        for f in os.listdir(cache_dir):
+            os.remove(os.path.join(cache_dir, f))
+
+
+def _remember(key, value):
+    _cache[key] = value
+    _cache.move_to_end(key)
+    while len(_cache) > max_cached:
+        _cache.popitem(last=False)
+
+
+# #### keys ####
+
+def file_key(fname):
+    """sha1 of a file's content, hashed once per (path, mtime, size)."""
+    fname = os.path.abspath(fname)
+    stat = os.stat(fname)
+    source = (fname, stat.st_mtime, stat.st_size)
+    if source not in _file_keys:
+        _file_keys[source] = eeg_cache.file_hash(fname)
+    return _file_keys[source]
+
+
+def _canonical(value):
+    # repr that does not depend on dict insertion order
+    if isinstance(value, dict):
+        return '{' + ', '.join('{!r}: {}'.format(k, _canonical(value[k]))
+                               for k in sorted(value, key=repr)) + '}'
+    if isinstance(value, (list, tuple)):
+        return '[' + ', '.join(_canonical(v) for v in value) + ']'
+    if isinstance(value, np.ndarray):
+        return hashlib.sha1(np.ascontiguousarray(value)).hexdigest()
+    return repr(value)
+
+
+def _hash_code(code, h, names):
+    # bytecode + constants, nested code (lambdas, comprehensions) included;
+    # collects the global names used on the way
+    h.update(code.co_code)
+    names.update(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            _hash_code(const, h, names)
+        elif isinstance(const, frozenset):  # set order depends on the hash seed
+            h.update(repr(sorted(const, key=repr)).encode())
+        else:
+            h.update(repr(const).encode())
+
+
+def code_key(func):
+    """sha1 of ``func``'s code and of the source files of the eeg_* modules
+    it names (imported inside it too). Modules those import are not
+    followed: after changing one, ``force`` the stages that use it."""
+    h = hashlib.sha1()
+    names = set()
+    _hash_code(func.__code__, h, names)
+    for name in sorted(n for n in names if n.startswith('eeg_')):
+        spec = importlib.util.find_spec(name)
+        if spec is not None and spec.origin and os.path.isfile(spec.origin):
+            h.update(file_key(spec.origin).encode())
+    return h.hexdigest()
+
+
+# #### stage outputs on disk ####
+
+def _save_evoked_dict(evokeds, fname):
+    out = []
+    for name, evoked in evokeds.items():
+        evoked = evoked.copy()
+        evoked.comment = name
+        out.append(evoked)
+    mne.write_evokeds(fname, out, verbose=False)
+
+
+def _read_evoked_dict(fname):
+    return OrderedDict((e.comment, e) for e in
+                       mne.read_evokeds(fname, verbose=False))
+
+
+def _is_evoked_dict(value):
+    return (isinstance(value, dict) and len(value) > 0 and
+            all(isinstance(v, mne.Evoked) for v in value.values()))
+
+
+def _is_float32(value):
+    return getattr(value, '_data', None) is not None and \
+        value._data.dtype == np.float32
+
+
+def _save_float32_epochs(epochs, fname):
+    # Epochs.save only writes float64; the reader casts back
+    eeg_float32.astype(epochs.copy(), np.float64).save(fname, overwrite=True,
+                                                       verbose=False)
+
+
+def _save_pickle(value, fname):
+    with open(fname, 'wb') as f:
+        pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _read_pickle(fname):
+    with open(fname, 'rb') as f:
+        return pickle.load(f)
+
+
+# (suffix, test, save, read), first match wins; mne objects go to fif
+_formats = [
+    ('-f32-raw.fif', lambda v: isinstance(v, mne.io.BaseRaw) and _is_float32(v),
+     lambda v, f: v.save(f, overwrite=True, verbose=False),
+     lambda f: eeg_float32.astype(mne.io.read_raw_fif(f, preload=True,
+                                                      verbose=False))),
+    ('-f32-epo.fif', lambda v: isinstance(v, mne.BaseEpochs) and _is_float32(v),
+     _save_float32_epochs,
+     lambda f: eeg_float32.astype(mne.read_epochs(f, verbose=False))),
+    ('-raw.fif', lambda v: isinstance(v, mne.io.BaseRaw),
+     lambda v, f: v.save(f, overwrite=True, verbose=False),
+     lambda f: mne.io.read_raw_fif(f, preload=True, verbose=False)),
+    ('-epo.fif', lambda v: isinstance(v, mne.BaseEpochs),
+     lambda v, f: v.save(f, overwrite=True, verbose=False),
+     lambda f: mne.read_epochs(f, verbose=False)),
+    ('-ica.fif', lambda v: isinstance(v, mne.preprocessing.ICA),
+     lambda v, f: v.save(f, overwrite=True, verbose=False),
+     lambda f: mne.preprocessing.read_ica(f, verbose=False)),
+    ('-ave.fif', _is_evoked_dict, _save_evoked_dict, _read_evoked_dict),
+    ('.npy', lambda v: isinstance(v, np.ndarray), lambda v, f: np.save(f, v),
+     np.load),
+    ('.pkl', lambda v: True, _save_pickle, _read_pickle),
+]
+
+
+def _stored(base):
+    # (fname, read) of a saved output, or None
+    for suffix, _, _, read in _formats:
+        if os.path.exists(base + suffix):
+            return base + suffix, read
+    return None
+
+
+def _store(value, base):
+    for suffix, test, save, _ in _formats:
+        if test(value):
+            break
+    os.makedirs(os.path.dirname(base), exist_ok=True)
+    # mne wants its suffix at the end of the name, so the pid goes before it
+    tmp = '{}.{}.tmp{}'.format(base, os.getpid(), suffix)
+    save(value, tmp)
+    os.replace(tmp, base + suffix)
+
+
+# #### pipeline ####
+
+class Stage(object):
+    """``func(*outputs of inputs, **params)``.
+
+    ``files`` names the parameters that are file names; their content goes
+    into the key instead of the name. With ``cache=False`` the output is
+    only kept in memory (e.g. reading a file that is already on disk).
+    """
+
+    def __init__(self, name, func, inputs=(), params=None, files=(),
+                 cache=True):
+        self.name = name
+        self.func = func
+        self.inputs = tuple(inputs)
+        self.params = dict(params or {})
+        self.files = tuple(files)
+        self.cache = cache
+
+    def key(self, input_keys):
+        params = dict(self.params)
+        for p in self.files:
+            params[p] = file_key(params[p])
+        h = hashlib.sha1()
+        h.update(repr((self.name, self.func.__module__,
+                       self.func.__qualname__, _canonical(params),
+                       list(input_keys))).encode())
+        # editing the stage or the eeg_* modules it calls invalidates it
+        h.update(code_key(self.func).encode())
+        return h.hexdigest()
+
+    def __repr__(self):
+        return '<Stage {} <- {}>'.format(self.name, ', '.join(self.inputs) or '-')
+
+
+class Pipeline(object):
+    """Stages in dependency order (every input is listed before its users)."""
+
+    def __init__(self, stages, cache_dir=cache_dir, verbose=True, name=None):
+        self.stages = OrderedDict()
+        for stage in stages:
+            missing = [i for i in stage.inputs if i not in self.stages]
+            if missing:
+                raise ValueError('{}: unknown input(s) {}'.format(stage.name,
+                                                                  missing))
+            self.stages[stage.name] = stage
+        self.cache_dir = cache_dir
+        self.verbose = verbose
+        self.name = name  # subject, in eeg_profile records
+        self.log = []  # dict(stage, key, action, seconds) per stage and run
+
+    def keys(self):
+        """{stage: key}; hashes the source files only when they changed."""
+        keys = dict()
+        for name, stage in self.stages.items():
+            keys[name] = stage.key([keys[i] for i in stage.inputs])
+        return keys
+
+    def _base(self, name, key):
+        return self.cache_dir and os.path.join(self.cache_dir,
+                                               '{}-{}'.format(name, key))
+
+    def _available(self, name, key):
+        if key in _cache:
+            return True
+        return (self.stages[name].cache and self.cache_dir is not None and
+                _stored(self._base(name, key)) is not None)
+
+    def plan(self, targets=None, force=()):
+        """{stage: 'memory' | 'read' | 'run'} of what ``run`` has to do."""
+        targets = self._targets(targets)
+        keys = self.keys()
+        todo = dict()
+
+        def visit(name):
+            if name in todo:
+                return
+            if name not in force and self._available(name, keys[name]):
+                todo[name] = 'memory' if keys[name] in _cache else 'read'
+                return
+            todo[name] = 'run'
+            for i in self.stages[name].inputs:
+                visit(i)
+
+        for name in targets:
+            visit(name)
+        return OrderedDict((n, todo[n]) for n in self.stages if n in todo)
+
+    def _targets(self, targets):
+        if targets is None:
+            return list(self.stages)
+        if isinstance(targets, str):
+            targets = [targets]
+        unknown = [t for t in targets if t not in self.stages]
+        if unknown:
+            raise ValueError('unknown stage(s) {}'.format(unknown))
+        return list(targets)
+
+    def _do(self, name, key, action, inputs):
+        t0 = time.perf_counter()
+        if action == 'memory':
+            _stats['hits'] += 1
+            value = _cache[key]
+        elif action == 'read':
+            _stats['disk_hits'] += 1
+            fname, read = _stored(self._base(name, key))
+            with eeg_profile.stage(name, subject=self.name,
+                                   action=action) as st:
+                value = read(fname)
+                st.output(value)
+        else:
+            _stats['misses'] += 1
+            stage = self.stages[name]
+            with eeg_profile.stage(name, *inputs, subject=self.name,
+                                   action=action) as st:
+                value = stage.func(*inputs, **stage.params)
+                st.output(value)
+            if stage.cache and self.cache_dir:
+                _store(value, self._base(name, key))
+        _remember(key, value)
+        seconds = time.perf_counter() - t0
+        self.log.append(dict(stage=name, key=key, action=action,
+                             seconds=seconds))
+        if self.verbose and action != 'memory':
+            print('{}: {} ({:.1f} s)'.format(
+                name, 'ran' if action == 'run' else 'read', seconds))
+        return value
+
+    def run(self, targets=None, force=(), n_jobs=None):
+        """{target: output}, running only the stages that are not cached.
+
+        ``force`` re-runs the given stages (and so everything after them).
+        Independent stages run in up to ``n_jobs`` threads at once.
+        """
+        targets = self._targets(targets)
+        keys = self.keys()
+        todo = self.plan(targets, force)
+        done = dict()
+        with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+            running = dict()
+            while todo or running:
+                for name, action in list(todo.items()):
+                    deps = self.stages[name].inputs if action == 'run' else ()
+                    if all(d in done for d in deps):
+                        del todo[name]
+                        future = pool.submit(self._do, name, keys[name], action,
+                                             [done[d] for d in deps])
+                        running[future] = name
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    done[running.pop(future)] = future.result()
+        return OrderedDict((name, done[name]) for name in targets)
+
+
+# #### the study2 stages ####
+
+def read_raw(fname, crop=None, pick_types=None, dtype=None):
+    """``dtype='float32'`` runs the stages downstream in float32."""
+    raw = mne.io.read_raw_fif(fname, verbose=False)
+    if crop:
+        raw.crop(*crop)
+    if pick_types:
+        raw.pick_types(**pick_types)
+    raw.load_data()
+    if dtype is not None:
+        eeg_float32.astype(raw, dtype)
+    return raw
+
+
+def filter_raw(raw, l_freq=1., notch_freqs=None):
+    # new RawArray, the input stays as it is
+    return eeg_filter.filter_raw(raw, l_freq=l_freq, notch_freqs=notch_freqs)
+
+
+def fit_ica(raw, classify=True, **ica_params):
+    """eeg_ica.fit_ica, with the EOG/ECG components put in ica.exclude."""
+    ica = eeg_ica.fit_ica(raw, **ica_params)
+    if classify:
+        eeg_artifacts.classify(raw, ica, verbose=True)
+    return ica
+
+
+def clean_raw(raw, ica):
+    return eeg_ica.apply_ica(raw.copy(), ica)
+
+
+def find_events(raw, stim_channel=None, consecutive='increasing'):
+    return eeg_events.find_events(raw, stim_channel, consecutive).events
+
+
+def make_epochs(raw, events, event_id=None, tmin=-0.2, tmax=0.5,
+                baseline=(None, 0), reject=None, flat=None):
+    return eeg_epochs.make_epochs(raw, events, event_id, tmin=tmin, tmax=tmax,
+                                  baseline=baseline, reject=reject, flat=flat,
+                                  dtype=eeg_float32.dtype_of(raw))
+
+
+def run_autoreject(epochs, n_interpolate=None, consensus=None,
+                   random_state=None):
+    import eeg_autoreject  # needs autoreject + sklearn
+
+    ar = eeg_autoreject.fit_autoreject(epochs.copy(), n_interpolate=n_interpolate,
+                                       consensus=consensus,
+                                       random_state=random_state)
+    return ar.transform(epochs.copy())
+
+
+def average(epochs, conditions, equalize=None):
+    """{condition: evoked}; ``equalize`` conditions get equal counts first."""
+    epochs = epochs.copy()
+    if equalize:
+        epochs.equalize_event_counts(equalize)
+    return OrderedDict((c, epochs[c].average()) for c in conditions)
+
+
+study2_spec = dict(
+    raw=dict(crop=None, pick_types=None, dtype=None),  # or 'float32'
+    filter=dict(l_freq=1., notch_freqs=None),  # only the ICA fit sees this
+    ica=dict(n_components=20, random_state=97, max_iter=800, classify=True),
+    events=dict(stim_channel='STI 014'),
+    # source: 'clean' (the ICA-cleaned raw) or 'raw' (the ICA is only fitted)
+    epochs=dict(source='clean',
+                event_id={'auditory/left': 1, 'auditory/right': 2,
+                          'visual/left': 3, 'visual/right': 4, 'smiley': 5,
+                          'buttonpress': 32},
+                tmin=-0.2, tmax=0.5, baseline=(None, 0),
+                reject=dict(mag=4000e-15, grad=4000e-13, eeg=150e-6,
+                            eog=250e-6)),
+    autoreject=None,  # e.g. dict(random_state=11) to clean the epochs with it
+    evoked=dict(conditions=['auditory', 'visual'],
+                equalize=['auditory/left', 'auditory/right', 'visual/left',
+                          'visual/right']),
+)
+
+
+def study2_stages(fname, spec=None):
+    """The stages of study2 for one recording; ``spec`` as in ``study2_spec``."""
+    spec = dict(study2_spec, **(spec or {}))
+    epochs_params = dict(spec['epochs'])
+    source = epochs_params.pop('source', 'clean')
+    if source not in ('raw', 'clean'):
+        raise ValueError("epochs source must be 'raw' or 'clean', got {!r}"
+                         .format(source))
+    stages = [
+        Stage('raw', read_raw, params=dict(spec['raw'], fname=fname),
+              files=['fname'], cache=False),
+        Stage('filter', filter_raw, ['raw'], spec['filter']),
+        Stage('ica', fit_ica, ['filter'], spec['ica']),
+        Stage('clean', clean_raw, ['raw', 'ica']),
+        Stage('events', find_events, ['raw'], spec['events']),
+        Stage('epochs', make_epochs, [source, 'events'], epochs_params),
+    ]
+    epochs = 'epochs'
+    if spec['autoreject'] is not None:
+        stages.append(Stage('autoreject', run_autoreject, ['epochs'],
+                            spec['autoreject']))
+        epochs = 'autoreject'
+    stages.append(Stage('evoked', average, [epochs], spec['evoked']))
+    return stages
+
+
+def study2_pipeline(fname, cache_dir=cache_dir, verbose=True, **spec):
+    """Pipeline of ``study2_stages``; keyword arguments update one stage each.
+
+    e.g. ``study2_pipeline(fname, epochs=dict(tmin=-0.3, tmax=0.7))``.
+    """
+    unknown = [k for k in spec if k not in study2_spec]
+    if unknown:
+        raise ValueError('unknown stage(s) {}'.format(unknown))
+    spec = {k: v if v is None or study2_spec[k] is None
+            else dict(study2_spec[k], **v) for k, v in spec.items()}
+    return Pipeline(study2_stages(fname, spec), cache_dir=cache_dir,
+                    verbose=verbose, name=os.path.basename(fname))
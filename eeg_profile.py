@@ -0,0 +1,338 @@
+"""
+Per-stage timing, memory and I/O records, one JSON line per stage.
+
+A subject that takes 20 minutes instead of 2 usually has one slow step. Each
+step wrapped in ``stage`` writes a record with its wall and CPU time, the
+peak RSS above the RSS at its start (sampled every 10 ms), the bytes it read
+(from storage and through read calls) and the type/shape/dtype of its inputs
+and outputs:
+
+    profiler = eeg_profile.install(eeg_profile.Profiler('timings.jsonl',
+                                                        subject='sub-01'))
+    with eeg_profile.stage('ica.fit', raw) as st:
+        ica.fit(raw)
+        st.output(ica)
+
+Without an installed profiler ``stage`` does nothing, so the hooks stay in
+the code (eeg_pipeline stages, eeg_runner steps). With ``sample=True`` the
+stage's thread is also sampled every ``sample_interval`` s and the stacks of
+the ``keep_slowest`` slowest stages are written in the folded format
+(``a;b;c count``) of flamegraph.pl / speedscope when the profiler is closed.
+
+    python eeg_profile.py timings.jsonl      # slowest stages per subject
+
+The CPU, RSS and I/O counters are process-wide: stages running at the same
+time (eeg_pipeline's thread pool) show up in each other's numbers.
+"""
+
+import os
+import sys
+import json
+import time
+import heapq
+import argparse
+import threading
+from collections import Counter, defaultdict
+
+import numpy as np
+import mne
+
+import eeg_cache
+
+try:
+    import psutil
+except ImportError:  # /proc on Linux, nothing elsewhere
+    psutil = None
+
+rss_interval = 0.01  # s between RSS samples
+
+_active = None
+
+
+def install(profiler):
+    """Make ``profiler`` (or None) the one ``stage`` records to; returns it."""
+    global _active
+    _active = profiler
+    return profiler
+
+
+def active():
+    return _active
+
+
+# #### counters ####
+
+_page = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def rss():
+    """Resident set size of this process in bytes (None if unknown)."""
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * _page
+    except (OSError, ValueError):
+        return None
+
+
+def io_counters():
+    """dict(read_bytes=from storage, read_chars=through read calls)."""
+    if psutil is not None:
+        try:
+            c = psutil.Process().io_counters()
+            return dict(read_bytes=c.read_bytes,
+                        read_chars=getattr(c, 'read_chars', None))
+        except (AttributeError, psutil.Error):  # not on macOS
+            return dict(read_bytes=None, read_chars=None)
+    try:
+        with open('/proc/self/io') as f:
+            fields = dict(line.split(': ') for line in f.read().splitlines())
+        return dict(read_bytes=int(fields['read_bytes']),
+                    read_chars=int(fields['rchar']))
+    except (OSError, KeyError, ValueError):
+        return dict(read_bytes=None, read_chars=None)
+
+
+def _cpu():
+    t = os.times()
+    return dict(cpu=time.process_time(), children_cpu=t[2] + t[3],
+                thread_cpu=time.thread_time())
+
+
+def describe(value, depth=0):
+    """Type, shape and dtype of a stage's input/output, JSON-able."""
+    kind = type(value).__name__
+    if isinstance(value, np.ndarray):
+        return dict(type=kind, shape=list(value.shape), dtype=str(value.dtype))
+    if isinstance(value, mne.io.BaseRaw):
+        out = dict(type=kind, shape=[len(value.ch_names), int(value.n_times)],
+                   sfreq=value.info['sfreq'], preload=bool(value.preload))
+        if value.preload:
+            out['dtype'] = str(value._data.dtype)
+        return out
+    if isinstance(value, mne.BaseEpochs):
+        out = dict(type=kind, shape=[len(value.events), len(value.ch_names),
+                                     len(value.times)],
+                   preload=bool(value.preload))
+        if value.preload:
+            out['dtype'] = str(value._data.dtype)
+        return out
+    if isinstance(value, mne.Evoked):
+        return dict(type=kind, shape=list(value.data.shape),
+                    dtype=str(value.data.dtype), nave=value.nave)
+    if isinstance(value, mne.preprocessing.ICA):
+        return dict(type=kind, n_components=getattr(value, 'n_components_', None),
+                    exclude=[int(i) for i in value.exclude])
+    if isinstance(value, eeg_cache.CachedRaw):
+        return dict(type=kind, shape=list(value.data.shape),
+                    dtype=str(value.data.dtype), sfreq=value.sfreq)
+    if depth < 2 and isinstance(value, dict):
+        return {str(k): describe(v, depth + 1) for k, v in list(value.items())[:20]}
+    if depth < 2 and isinstance(value, (list, tuple)):
+        return [describe(v, depth + 1) for v in value[:20]]
+    return dict(type=kind)
+
+
+# #### sampling ####
+
+def _fold(frame):
+    # root-first 'file:function' stack of a frame, ';'-separated
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('{}:{}'.format(os.path.basename(code.co_filename),
+                                    code.co_name))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class _Sampler(threading.Thread):
+    """Peak RSS of the process, and optionally the stacks of one thread."""
+
+    def __init__(self, thread_id, stacks, interval):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.stacks = Counter() if stacks else None
+        self.interval = interval
+        self.peak = rss()
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            now = rss()
+            if now is not None and (self.peak is None or now > self.peak):
+                self.peak = now
+            if self.stacks is not None:
+                frame = sys._current_frames().get(self.thread_id)
+                if frame is not None:
+                    self.stacks[_fold(frame)] += 1
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+
+# #### records ####
+
+class _Null(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def output(self, *values):
+        pass
+
+
+_null = _Null()
+
+
+class Stage(object):
+    """Context of one recorded stage; ``output(...)`` describes the result."""
+
+    def __init__(self, profiler, name, inputs, fields):
+        self.profiler = profiler
+        self.record = dict(fields, stage=name, pid=os.getpid(),
+                           thread=threading.current_thread().name,
+                           inputs=[describe(v) for v in inputs], outputs=[])
+        if self.record.get('subject') is None:
+            self.record['subject'] = profiler.subject
+
+    def output(self, *values):
+        self.record['outputs'] = [describe(v) for v in values]
+
+    def __enter__(self):
+        p = self.profiler
+        self._sampler = _Sampler(threading.get_ident(), p.sample,
+                                 p.sample_interval if p.sample else rss_interval)
+        self._rss = self._sampler.peak
+        self._io = io_counters()
+        self._cpu = _cpu()
+        self.record['start'] = time.time()
+        self._t0 = time.perf_counter()
+        self._sampler.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        wall = time.perf_counter() - self._t0
+        self._sampler.stop()
+        cpu, io = _cpu(), io_counters()
+        rec = self.record
+        rec['wall'] = wall
+        rec.update({k: v - self._cpu[k] for k, v in cpu.items()})
+        rec.update({k: None if v is None or self._io[k] is None
+                    else v - self._io[k] for k, v in io.items()})
+        rec['rss_start_mb'] = None if self._rss is None else self._rss / 2. ** 20
+        rec['rss_peak_delta_mb'] = (None if self._rss is None else
+                                    (self._sampler.peak - self._rss) / 2. ** 20)
+        if exc_type is not None:
+            rec['error'] = repr(exc)
+        self.profiler.write(rec, self._sampler.stacks)
+        return False
+
+
+class Profiler(object):
+    """Writes a JSON line per stage to ``log`` (appending; None: memory only)."""
+
+    def __init__(self, log=None, subject=None, sample=False,
+                 sample_interval=0.005, keep_slowest=5, stacks_dir=None):
+        self.log = log
+        self.subject = subject
+        self.sample = sample
+        self.sample_interval = sample_interval
+        self.keep_slowest = keep_slowest
+        if stacks_dir is None and log is not None:
+            stacks_dir = os.path.splitext(log)[0] + '-stacks'
+        self.stacks_dir = stacks_dir
+        self.records = []
+        self._slowest = []  # heap of (wall, n, record, stacks)
+        self._lock = threading.Lock()
+
+    def stage(self, name, *inputs, **fields):
+        return Stage(self, name, inputs, fields)
+
+    def write(self, record, stacks=None):
+        with self._lock:
+            self.records.append(record)
+            if stacks:
+                item = (record['wall'], len(self.records), record, stacks)
+                if len(self._slowest) < self.keep_slowest:
+                    heapq.heappush(self._slowest, item)
+                else:
+                    heapq.heappushpop(self._slowest, item)
+            if self.log is not None:
+                # one write per line in append mode: lines from several
+                # worker processes do not interleave
+                with open(self.log, 'a') as f:
+                    f.write(json.dumps(record, default=str) + '\n')
+
+    def dump_stacks(self):
+        """Folded stacks of the slowest stages; returns the file names."""
+        if not self._slowest or self.stacks_dir is None:
+            return []
+        os.makedirs(self.stacks_dir, exist_ok=True)
+        fnames = []
+        for wall, n, record, stacks in sorted(self._slowest, reverse=True):
+            fname = os.path.join(self.stacks_dir, '{}-{}-{}-{}.folded'.format(
+                record['subject'] or 'all', record['stage'], record['pid'], n))
+            with open(fname, 'w') as f:
+                for stack, count in stacks.most_common():
+                    f.write('{} {}\n'.format(stack, count))
+            fnames.append(fname)
+        self._slowest = []
+        return fnames
+
+    def close(self):
+        return self.dump_stacks()
+
+
+def stage(name, *inputs, **fields):
+    """Record ``name`` with the installed profiler (no-op without one)."""
+    if _active is None:
+        return _null
+    return _active.stage(name, *inputs, **fields)
+
+
+# #### reading logs ####
+
+def read_log(fname):
+    with open(fname) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def summary(records, top=3, slow=3.):
+    """Per subject: total wall time and the ``top`` slowest stages; stages
+    taking more than ``slow`` x their median over subjects are marked."""
+    walls = defaultdict(list)
+    for rec in records:
+        walls[rec['stage']].append(rec['wall'])
+    median = {name: float(np.median(w)) for name, w in walls.items()}
+    by_subject = defaultdict(list)
+    for rec in records:
+        by_subject[rec.get('subject')].append(rec)
+    lines = []
+    for subject, recs in sorted(by_subject.items(), key=lambda x: str(x[0])):
+        lines.append('{}: {:.1f} s in {} stages'.format(
+            subject, sum(r['wall'] for r in recs), len(recs)))
+        for rec in sorted(recs, key=lambda r: r['wall'], reverse=True)[:top]:
+            flag = ''
+            if len(walls[rec['stage']]) > 1 and \
+                    rec['wall'] > slow * median[rec['stage']]:
+                flag = '  <- {:.1f}x median'.format(rec['wall'] /
+                                                    median[rec['stage']])
+            peak = rec.get('rss_peak_delta_mb')
+            lines.append('  {:<24} {:8.1f} s  cpu {:8.1f} s  +{} MB{}{}'.format(
+                rec['stage'], rec['wall'], rec.get('cpu') or 0.,
+                '?' if peak is None else '{:.0f}'.format(peak),
+                '  ERROR' if 'error' in rec else '', flag))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('log', help='JSON lines written by a Profiler')
+    parser.add_argument('--top', type=int, default=3)
+    args = parser.parse_args()
+    print(summary(read_log(args.log), top=args.top))
@@ -0,0 +1,405 @@
+"""
+Power spectra computed once and served from a cache.
+
+``raw.plot_psd(fmax=...)`` / ``epochs.plot_psd_topomap(bands=...)`` run Welch
+or multitaper from scratch on every call. ``compute_psd(inst)`` computes the
+full spectrum once per (data hash, method, n_fft, overlap, bandwidth), keeps it
+as float32 in memory and in ``cache_dir``, and the returned ``PSD`` serves
+every fmin/fmax, channel pick, band average and topomap from that array:
+
+    psd = eeg_psd.compute_psd(raw)          # welch, n_fft=2048 (mne's default)
+    psd.plot(fmax=250, average=True)
+    psd = eeg_psd.compute_psd(epochs)       # multitaper, per epoch
+    psd.subset(epochs['visual/right']).plot_topomap(bands=bands)
+
+``compute_psd_batch(insts)`` does many recordings at once: the Welch segments
+of all of them go through the same batched rFFT calls (one FFT plan).
+"""
+
+import os
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+from scipy.fft import rfft
+from scipy.signal import get_window
+from numpy.lib.stride_tricks import sliding_window_view
+import mne
+
+import eeg_ica
+
+# set to None to keep the cache in memory only
+cache_dir = os.environ.get('EEG_PSD_CACHE', os.path.join(
+    os.path.expanduser('~'), '.cache', 'eeg_psd'))
+max_cached = 16  # spectra kept in memory (LRU)
+batch_rows = 8192  # Welch segments per rFFT call
+
+_cache = OrderedDict()
+_stats = dict(hits=0, disk_hits=0, misses=0)
+
+# plot units, as in mne
+scalings = dict(eeg=1e6, eog=1e6, ecg=1e6, emg=1e6, seeg=1e3, ecog=1e6,
+                mag=1e15, grad=1e13)
+units = dict(eeg='µV', eog='µV', ecg='µV', emg='µV', seeg='mV', ecog='µV',
+             mag='fT', grad='fT/cm')
+default_bands = [(0, 4, 'Delta (0-4 Hz)'), (4, 8, 'Theta (4-8 Hz)'),
+                 (8, 12, 'Alpha (8-12 Hz)'), (12, 30, 'Beta (12-30 Hz)'),
+                 (30, 45, 'Gamma (30-45 Hz)')]
+
+
+def cache_info():
+    return dict(_stats, size=len(_cache), max_size=max_cached)
+
+
+def clear_cache(disk=False):
+    _cache.clear()
+    for k in _stats:
+        _stats[k] = 0
+    if disk and cache_dir and os.path.isdir(cache_dir):
+        for fname in os.listdir(cache_dir):
+            if fname.endswith('-psd.npz'):
+                os.remove(os.path.join(cache_dir, fname))
+
+
+def _lookup(key):
+    if key in _cache:
+        _cache.move_to_end(key)
+        _stats['hits'] += 1
+        return _cache[key]
+    fname = cache_dir and os.path.join(cache_dir, key + '-psd.npz')
+    if fname and os.path.exists(fname):
+        with np.load(fname) as f:
+            state = {k: f[k] for k in f.files}
+        _stats['disk_hits'] += 1
+        _remember(key, state)
+        return state
+    return None
+
+
+def _remember(key, state, save=False):
+    _cache[key] = state
+    while len(_cache) > max_cached:
+        _cache.popitem(last=False)
+    if save and cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        fname = os.path.join(cache_dir, key + '-psd.npz')
+        tmp = '{}.{}.tmp.npz'.format(fname[:-4], os.getpid())
+        np.savez(tmp, **state)
+        os.replace(tmp, fname)
+
+
+# #### estimators ####
+
+def _power(segs, sfreq, window):
+    """One-sided density of detrended, windowed (rows, n_fft) segments."""
+    segs = segs - segs.mean(axis=-1, keepdims=True)
+    spec = rfft(segs * window, axis=-1, workers=-1)
+    power = spec.real ** 2 + spec.imag ** 2
+    power /= sfreq * (window ** 2).sum()
+    if len(window) % 2:
+        power[:, 1:] *= 2
+    else:
+        power[:, 1:-1] *= 2
+    return power
+
+
+def welch_many(arrays, sfreq, n_fft=2048, n_overlap=0, window='hamming'):
+    """Welch PSD (like mne.time_frequency.psd_array_welch) of several
+    (n_rows, n_times) arrays, with the segments of all of them batched into
+    shared rFFT calls. Float32 arrays are transformed in float32; the
+    averages over segments are float64.
+    """
+    step = max(n_fft - n_overlap, 1)
+    w = get_window(window, n_fft).astype(np.result_type(*arrays))
+    out = [np.empty((len(x), n_fft // 2 + 1)) for x in arrays]
+    pending = []
+
+    def flush():
+        power = _power(np.concatenate([block for _, _, block, _ in pending]),
+                       sfreq, w)
+        pos = 0
+        for i, rows, block, n_segs in pending:
+            this = power[pos:pos + len(block)]
+            pos += len(block)
+            out[i][rows] = this.reshape(-1, n_segs, this.shape[-1]).mean(
+                axis=1, dtype=np.float64)
+        del pending[:]
+
+    for i, x in enumerate(arrays):
+        if x.shape[-1] < n_fft:
+            raise ValueError('n_fft={} is longer than the data ({} samples)'
+                             .format(n_fft, x.shape[-1]))
+        # (n_rows, n_segments, n_fft) view
+        segs = sliding_window_view(x, n_fft, axis=-1)[:, ::step]
+        per_block = max(batch_rows // segs.shape[1], 1)
+        for start in range(0, len(x), per_block):
+            block = segs[start:start + per_block]
+            pending.append((i, slice(start, start + len(block)),
+                            block.reshape(-1, n_fft), segs.shape[1]))
+            if sum(len(b) for _, _, b, _ in pending) >= batch_rows:
+                flush()
+    if pending:
+        flush()
+    freqs = np.arange(n_fft // 2 + 1) * (sfreq / n_fft)
+    return out, freqs
+
+
+def _spans(inst, n_fft, n_overlap):
+    """(arrays, weights): the (n_rows, n_times) pieces Welch runs on.
+
+    A Raw with bad annotations is split into its good spans and the span
+    spectra are averaged with mne's weights (samples used per span); spans
+    shorter than n_fft are left out.
+    """
+    if not isinstance(inst, mne.io.BaseRaw):
+        data = inst.get_data()
+        return [data.reshape(-1, data.shape[-1])], [1.]
+    data = inst.get_data(reject_by_annotation='NaN')
+    good = ~np.isnan(data[0])
+    if good.all():
+        return [data], [1.]
+    edges = np.flatnonzero(np.diff(np.r_[0, good.astype(np.int8), 0]))
+    step = max(n_fft - n_overlap, 1)
+    spans = [data[:, a:b] for a, b in zip(edges[::2], edges[1::2])
+             if b - a >= n_fft]
+    weights = [x.shape[1] - (x.shape[1] - n_overlap) % step for x in spans]
+    return spans, weights
+
+
+def _params(inst, method, n_fft, n_overlap, bandwidth, window):
+    is_epochs = not isinstance(inst, mne.io.BaseRaw)
+    if method is None:  # mne's defaults for plot_psd
+        method = 'multitaper' if is_epochs else 'welch'
+    if method == 'welch':
+        if is_epochs:
+            n_fft = min(n_fft, len(inst.times))
+        return dict(method=method, n_fft=int(n_fft), n_overlap=int(n_overlap),
+                    window=window)
+    return dict(method=method, bandwidth=bandwidth)
+
+
+def _key(inst, params):
+    return hashlib.sha1((eeg_ica.data_hash(inst) + repr(sorted(params.items())))
+                        .encode()).hexdigest()
+
+
+def _shape(inst):
+    if isinstance(inst, mne.io.BaseRaw):
+        return (len(inst.ch_names),)
+    return (len(inst), len(inst.ch_names))
+
+
+def _compute(inst, params):
+    sfreq = inst.info['sfreq']
+    if params['method'] != 'welch':
+        return mne.time_frequency.psd_array_multitaper(
+            inst.get_data(), sfreq, bandwidth=params['bandwidth'], verbose=False)
+    spans, weights = _spans(inst, params['n_fft'], params['n_overlap'])
+    psds, freqs = welch_many(spans, sfreq, params['n_fft'], params['n_overlap'],
+                             params['window'])
+    psds = np.average(psds, axis=0, weights=weights)
+    return psds.reshape(_shape(inst) + (-1,)), freqs
+
+
+def _state(inst, psds, freqs, params):
+    state = dict(psds=psds.astype(np.float32), freqs=freqs,
+                 method=np.array(params['method']))
+    if not isinstance(inst, mne.io.BaseRaw):
+        state['selection'] = np.asarray(inst.selection)
+    return state
+
+
+def compute_psd(inst, method=None, n_fft=2048, n_overlap=0, bandwidth=None,
+                window='hamming'):
+    """Spectrum of a Raw (welch) or Epochs (multitaper, per epoch), cached."""
+    params = _params(inst, method, n_fft, n_overlap, bandwidth, window)
+    key = _key(inst, params)
+    state = _lookup(key)
+    if state is None:
+        _stats['misses'] += 1
+        psds, freqs = _compute(inst, params)
+        state = _state(inst, psds, freqs, params)
+        _remember(key, state, save=True)
+    return PSD(state, inst.info)
+
+
+def compute_psd_batch(insts, method='welch', n_fft=2048, n_overlap=0,
+                      window='hamming'):
+    """compute_psd for many recordings; the uncached ones share rFFT calls."""
+    params = [_params(inst, method, n_fft, n_overlap, None, window)
+              for inst in insts]
+    keys = [_key(inst, p) for inst, p in zip(insts, params)]
+    states = [_lookup(key) for key in keys]
+    todo = [i for i, s in enumerate(states) if s is None]
+    # one batched Welch per (sfreq, n_fft); everything else one at a time
+    groups = OrderedDict()
+    for i in todo:
+        p = params[i]
+        if p['method'] == 'welch':
+            groups.setdefault((insts[i].info['sfreq'], p['n_fft'],
+                               p['n_overlap'], p['window']), []).append(i)
+        else:
+            psds, freqs = _compute(insts[i], p)
+            states[i] = _state(insts[i], psds, freqs, p)
+    for (sfreq, this_n_fft, this_overlap, this_window), idx in groups.items():
+        pieces = [_spans(insts[i], this_n_fft, this_overlap) for i in idx]
+        psds, freqs = welch_many([x for spans, _ in pieces for x in spans],
+                                 sfreq, this_n_fft, this_overlap, this_window)
+        pos = 0
+        for i, (spans, weights) in zip(idx, pieces):
+            p = np.average(psds[pos:pos + len(spans)], axis=0, weights=weights)
+            pos += len(spans)
+            states[i] = _state(insts[i], p.reshape(_shape(insts[i]) + (-1,)),
+                               freqs, params[i])
+    for i in todo:
+        _stats['misses'] += 1
+        _remember(keys[i], states[i], save=True)
+    return [PSD(state, inst.info) for state, inst in zip(states, insts)]
+
+
+# #### serving ####
+
+def _picks(info, picks):
+    if picks is None:
+        return mne.pick_types(info, meg=True, eeg=True, seeg=True, ecog=True,
+                              exclude='bads')
+    picks = [picks] if isinstance(picks, str) else list(picks)
+    if all(isinstance(p, str) for p in picks):
+        if all(p in info['ch_names'] for p in picks):
+            return mne.pick_channels(info['ch_names'], picks, ordered=True)
+        kinds = dict(meg=False)
+        for p in picks:
+            if p in ('mag', 'grad'):
+                kinds['meg'] = p if kinds['meg'] in (False, p) else True
+            else:
+                kinds[p] = True
+        return mne.pick_types(info, exclude='bads', **kinds)
+    return np.asarray(picks)
+
+
+def _band_list(bands):
+    """mne's band formats: (fmin, fmax, title) or (freq, title)."""
+    out = []
+    for band in bands or default_bands:
+        if len(band) == 2:
+            out.append((band[0], band[0], band[1]))
+        else:
+            out.append(tuple(band))
+    return out
+
+
+class PSD(object):
+    """A cached spectrum: ``psds`` (float32) is (n_channels, n_freqs) for a
+    Raw and (n_epochs, n_channels, n_freqs) for Epochs."""
+
+    def __init__(self, state, info):
+        self.psds = state['psds']
+        self.freqs = state['freqs']
+        self.method = str(state['method'])
+        self.selection = state.get('selection')
+        self.info = info
+
+    def __repr__(self):
+        return '<PSD {} | {} x {} freqs, {:.1f}-{:.1f} Hz>'.format(
+            self.method, 'x'.join(str(n) for n in self.psds.shape[:-1]),
+            len(self.freqs), self.freqs[0], self.freqs[-1])
+
+    def subset(self, epochs):
+        """Rows of the epochs in ``epochs`` (e.g. ``epochs['auditory']``)."""
+        rows = np.searchsorted(self.selection, epochs.selection)
+        if not np.array_equal(self.selection[rows], epochs.selection):
+            raise ValueError('epochs are not a subset of this spectrum')
+        state = dict(psds=self.psds[rows], freqs=self.freqs,
+                     method=self.method, selection=self.selection[rows])
+        return PSD(state, self.info)
+
+    def get_data(self, fmin=0., fmax=np.inf, picks=None, average=False):
+        """(psds, freqs) for fmin <= f <= fmax; ``average`` over epochs."""
+        mask = (self.freqs >= fmin) & (self.freqs <= fmax)
+        psds = self.psds[..., _picks(self.info, picks), :][..., mask]
+        if average and psds.ndim == 3:
+            psds = psds.mean(axis=0)
+        return psds.astype(np.float64), self.freqs[mask]
+
+    def band_power(self, bands=None, picks=None):
+        """(n_bands, n_channels) mean power per band, averaged over epochs."""
+        psds, freqs = self.get_data(picks=picks, average=True)
+        power = []
+        for fmin, fmax, _ in _band_list(bands):
+            if fmin == fmax:  # single frequency: the closest bin
+                power.append(psds[:, np.argmin(np.abs(freqs - fmin))])
+            else:
+                power.append(psds[:, (freqs >= fmin) & (freqs <= fmax)].mean(axis=1))
+        return np.array(power)
+
+    # #### plots ####
+
+    def plot(self, fmin=0., fmax=np.inf, picks=None, average=False, dB=True,
+             show=True):
+        """plot_psd: one axis per channel type, mean over channels last."""
+        import matplotlib.pyplot as plt
+        picks = _picks(self.info, picks)
+        psds, freqs = self.get_data(fmin, fmax, picks, average=True)
+        types = [mne.channel_type(self.info, p) for p in picks]
+        kinds = [t for t in ('mag', 'grad', 'eeg', 'seeg', 'ecog', 'eog', 'ecg', 'emg')
+                 if t in types]
+        fig, axes = plt.subplots(len(kinds), 1, squeeze=False,
+                                 figsize=(8, 2.5 * len(kinds)))
+        for ax, kind in zip(axes[:, 0], kinds):
+            these = psds[np.array(types) == kind] * scalings.get(kind, 1.) ** 2
+            if dB:
+                these = 10 * np.log10(np.maximum(these, np.finfo(float).tiny))
+            if average:
+                mean, std = these.mean(axis=0), these.std(axis=0)
+                ax.fill_between(freqs, mean - std, mean + std, color='k', alpha=0.2)
+                ax.plot(freqs, mean, color='k', lw=1)
+            else:
+                ax.plot(freqs, these.T, color='k', lw=0.3, alpha=0.5)
+            unit = units.get(kind, 'AU')
+            ax.set(title=kind.upper(), xlim=(freqs[0], freqs[-1]),
+                   ylabel='{}²/Hz{}'.format(unit, ' (dB)' if dB else ''))
+        axes[-1, 0].set_xlabel('Frequency (Hz)')
+        fig.tight_layout()
+        if show:
+            plt.show()
+        return fig
+
+    def plot_topomap(self, bands=None, ch_type=None, normalize=False, dB=False,
+                     vlim=(None, None), show=True):
+        """plot_psd_topomap from the cached spectrum (grad pairs averaged)."""
+        import matplotlib.pyplot as plt
+        if ch_type is None:
+            types = [mne.channel_type(self.info, i)
+                     for i in range(len(self.info['ch_names']))]
+            ch_type = next(t for t in ('mag', 'grad', 'eeg') if t in types)
+        picks = _picks(self.info, ch_type)
+        info = mne.pick_info(self.info, picks)
+        power = self.band_power(bands, picks=picks)  # (n_bands, n_ch)
+        if ch_type == 'grad':
+            from mne.channels.layout import _pair_grad_sensors
+            pairs = _pair_grad_sensors(info, topomap_coords=False)
+            power = (power[:, pairs[::2]] + power[:, pairs[1::2]]) / 2.
+            info = mne.pick_info(info, pairs[::2])
+        if normalize:
+            power = power / power.sum(axis=0, keepdims=True)
+        power = power * (1. if normalize else scalings.get(ch_type, 1.) ** 2)
+        if dB:
+            power = 10 * np.log10(power)
+        if vlim == 'joint':
+            vlim = (power.min(), power.max())
+        bands = _band_list(bands)
+        fig, axes = plt.subplots(1, len(bands), figsize=(2.5 * len(bands), 2.8),
+                                 squeeze=False)
+        for ax, data, (_, _, title) in zip(axes[0], power, bands):
+            kwargs = dict(vlim=vlim) if 'vlim' in _topomap_args() else \
+                dict(vmin=vlim[0], vmax=vlim[1])
+            mne.viz.plot_topomap(data, info, axes=ax, show=False, **kwargs)
+            ax.set_title(title)
+        if show:
+            plt.show()
+        return fig
+
+
+def _topomap_args():
+    import inspect
+    return inspect.signature(mne.viz.plot_topomap).parameters
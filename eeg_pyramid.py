@@ -0,0 +1,243 @@
+"""
+Min/max pyramid of a cached raw, for browsing long recordings.
+
+Drawing a window of a recording only needs one min and one max per pixel
+column. Next to ``<name>.dat`` (see eeg_cache.py) the pyramid keeps levels
+of (min, max) per bin of 16, 64, 256, ... samples (``<name>-minmax<bin>.dat``,
+float32, shape (2, n_channels, n_bins)); a window is read from the coarsest
+level that still has at least one bin per column, so a redraw touches about
+``factor * n_columns`` values per channel whether the recording is 10 minutes
+or 10 hours long.
+
+    cached = eeg_cache.cache_raw(fname, cache_dir)
+    times, data = eeg_pyramid.open_pyramid(cached).read(0, 3600 * 1000, 1200)
+    eeg_pyramid.browse(cached, duration=60)     # <- / -> scroll, + / - zoom
+
+The pyramid is built by ``eeg_cache.write_cache`` and, for older entries, on
+first use; it is rebuilt when the data file changes.
+"""
+
+import os
+import json
+
+import numpy as np
+
+import eeg_cache
+
+base_bin = 16  # samples per bin of the finest level
+factor = 4  # bins merged per level
+min_bins = 4096  # the coarsest level has at most this many bins
+
+
+def pyramid_paths(cache_dir, name, bins=()):
+    base = os.path.join(cache_dir, name)
+    return dict(meta=base + '-minmax.json',
+                levels=['{}-minmax{}.dat'.format(base, b) for b in bins])
+
+
+def level_bins(n_times):
+    """Bin sizes of the levels for a recording of ``n_times`` samples."""
+    bins, size, n = [], base_bin, n_times
+    while n > min_bins:  # the previous level (or the data) is still too long
+        bins.append(size)
+        n = -(-n_times // size)
+        size *= factor
+    return bins
+
+
+def _source_meta(cached):
+    return dict(shape=list(cached.data.shape),
+                data_mtime=os.path.getmtime(cached.data.filename))
+
+
+def _read_meta(cached):
+    paths = pyramid_paths(cached.cache_dir, cached.name)
+    if not os.path.exists(paths['meta']):
+        return None
+    with open(paths['meta']) as f:
+        meta = json.load(f)
+    source = _source_meta(cached)
+    if any(meta.get(k) != v for k, v in source.items()):
+        return None  # the data changed since
+    levels = pyramid_paths(cached.cache_dir, cached.name, meta['bins'])['levels']
+    if not all(os.path.exists(p) for p in levels):
+        return None
+    return meta
+
+
+def _reduce(lo, hi, n):
+    # min/max over groups of n along the last axis (the last group may be short)
+    starts = np.arange(0, lo.shape[-1], n)
+    return (np.minimum.reduceat(lo, starts, axis=-1),
+            np.maximum.reduceat(hi, starts, axis=-1))
+
+
+def build_pyramid(cached, force=False):
+    """Write the levels of ``cached`` (an eeg_cache.CachedRaw); returns meta."""
+    meta = None if force else _read_meta(cached)
+    if meta is not None:
+        return meta
+    n_chan, n_times = cached.data.shape
+    bins = level_bins(n_times)
+    paths = pyramid_paths(cached.cache_dir, cached.name, bins)
+    src_lo = src_hi = cached.data
+    src_size = 1
+    for size, fname in zip(bins, paths['levels']):
+        n = size // src_size  # source samples/bins per bin of this level
+        n_bins = -(-n_times // size)
+        tmp = '{}.{}.tmp'.format(fname, os.getpid())
+        out = np.memmap(tmp, dtype=eeg_cache.dtype, mode='w+',
+                        shape=(2, n_chan, n_bins))
+        block = max(eeg_cache.block_size // n, 1) * n
+        for start in range(0, src_lo.shape[-1], block):
+            lo, hi = _reduce(src_lo[:, start:start + block],
+                             src_hi[:, start:start + block], n)
+            out[0, :, start // n:start // n + lo.shape[-1]] = lo
+            out[1, :, start // n:start // n + hi.shape[-1]] = hi
+        out.flush()
+        del out
+        os.replace(tmp, fname)
+        level = np.memmap(fname, dtype=eeg_cache.dtype, mode='r',
+                          shape=(2, n_chan, n_bins))
+        src_lo, src_hi, src_size = level[0], level[1], size
+    meta = dict(_source_meta(cached), bins=bins)
+    eeg_cache._write_meta(paths['meta'], meta)
+    return meta
+
+
+class Pyramid(object):
+    """The levels of one cached raw, as read-only memmaps."""
+
+    def __init__(self, cached):
+        self.cached = cached
+        self.sfreq = cached.sfreq
+        self.n_times = cached.n_times
+        meta = build_pyramid(cached)
+        n_chan = cached.data.shape[0]
+        self.bins = meta['bins']
+        self.levels = [
+            np.memmap(fname, dtype=eeg_cache.dtype, mode='r',
+                      shape=(2, n_chan, -(-self.n_times // size)))
+            for size, fname in zip(self.bins, pyramid_paths(
+                cached.cache_dir, cached.name, self.bins)['levels'])]
+
+    def level_for(self, samples_per_column):
+        """Index of the coarsest level with >= 1 bin per column (None: raw)."""
+        usable = [i for i, size in enumerate(self.bins)
+                  if size <= samples_per_column]
+        return usable[-1] if usable else None
+
+    def read(self, start=0, stop=None, n_columns=1000, picks=None):
+        """(times, data) of samples [start, stop), at most 2 * n_columns points.
+
+        Same layout as ``eeg_report.minmax_decimate``: per column the min
+        followed by the max, times in s from the first sample.
+        """
+        stop = self.n_times if stop is None else min(stop, self.n_times)
+        start = max(start, 0)
+        picks = slice(None) if picks is None else np.asarray(picks)
+        idx = self.level_for((stop - start) / float(n_columns))
+        if idx is None:  # zoomed in far enough to read the data itself
+            import eeg_report  # matplotlib: not for building the pyramid
+
+            data = self.cached.data[picks, start:stop]
+            return eeg_report.minmax_decimate(
+                data, np.arange(start, stop) / self.sfreq, n_columns)
+        size, level = self.bins[idx], self.levels[idx]
+        first, last = start // size, -(-stop // size)
+        n = -(-(last - first) // n_columns)
+        lo, hi = _reduce(level[0, picks, first:last], level[1, picks, first:last], n)
+        data = np.empty(lo.shape[:-1] + (2 * lo.shape[-1],), lo.dtype)
+        data[..., 0::2], data[..., 1::2] = lo, hi
+        times = (first + np.arange(lo.shape[-1]) * n) * size / self.sfreq
+        return np.repeat(times, 2), data
+
+
+def open_pyramid(cached):
+    """Pyramid of an eeg_cache.CachedRaw, built first if missing or stale."""
+    return Pyramid(cached)
+
+
+# #### browser ####
+
+class Browser(object):
+    """Scrollable traces of a cached raw, redrawn from the pyramid.
+
+    Keys: left/right scroll by one window, +/- zoom in/out, home/end.
+    """
+
+    def __init__(self, cached, tmin=0., duration=10., picks=None,
+                 n_channels=None, remove_dc=True):
+        import matplotlib.pyplot as plt
+        from matplotlib.collections import LineCollection
+        import eeg_report
+
+        self.pyramid = open_pyramid(cached)
+        self.sfreq = cached.sfreq
+        if picks is None:
+            picks = np.arange(len(cached.ch_names))
+        self.picks = np.asarray(picks)[:n_channels]
+        self.remove_dc = remove_dc
+        self.start = int(round(tmin * self.sfreq))
+        self.length = int(round(duration * self.sfreq))
+        self.scale = None
+
+        self.fig = plt.figure(figsize=(12., 8.))
+        self.ax = self.fig.add_axes(eeg_report.trace_axes)
+        self.lines = LineCollection([], linewidths=0.5, colors='k')
+        self.ax.add_collection(self.lines)
+        offsets = np.arange(len(self.picks))[::-1]
+        self.ax.set(ylim=(-1, len(self.picks)), yticks=offsets,
+                    xlabel='Time (s)')
+        self.ax.set_yticklabels([cached.ch_names[p] for p in self.picks],
+                                fontsize=6)
+        self.fig.canvas.mpl_connect('key_press_event', self._on_key)
+        self.fig.canvas.mpl_connect('resize_event', lambda event: self.draw())
+        self.draw()
+
+    def draw(self):
+        n_columns = max(int(self.ax.get_window_extent().width), 1)
+        stop = self.start + self.length
+        t, y = self.pyramid.read(self.start, stop, n_columns, self.picks)
+        y = np.asarray(y, np.float64)
+        dc = np.median(y, axis=-1, keepdims=True)
+        if self.scale is None:  # fixed after the first window, like mne
+            scale = np.percentile(np.abs(y - dc), 99, axis=-1, keepdims=True)
+            self.scale = 2.2 * np.where(scale > 0, scale, 1.)
+        if self.remove_dc:
+            y = y - dc
+        y = y / self.scale + np.arange(len(y))[::-1, None]
+        self.lines.set_segments(np.stack([np.broadcast_to(t, y.shape), y],
+                                         axis=-1))
+        self.ax.set_xlim(self.start / self.sfreq, stop / self.sfreq)
+        self.fig.canvas.draw_idle()
+
+    def _on_key(self, event):
+        n_times = self.pyramid.n_times
+        if event.key == 'right':
+            self.start = min(self.start + self.length, max(n_times - self.length, 0))
+        elif event.key == 'left':
+            self.start = max(self.start - self.length, 0)
+        elif event.key in ('+', '='):
+            self.length = max(self.length // 2, 10)
+        elif event.key == '-':
+            self.length = min(self.length * 2, n_times)
+            self.start = min(self.start, max(n_times - self.length, 0))
+        elif event.key == 'home':
+            self.start = 0
+        elif event.key == 'end':
+            self.start = max(n_times - self.length, 0)
+        else:
+            return
+        self.draw()
+
+
+def browse(cached, tmin=0., duration=10., picks=None, n_channels=None,
+           remove_dc=True, show=True):
+    """Open a Browser on ``cached``; like ``raw.plot(duration=...)``."""
+    browser = Browser(cached, tmin=tmin, duration=duration, picks=picks,
+                      n_channels=n_channels, remove_dc=remove_dc)
+    if show:
+        import matplotlib.pyplot as plt
+        plt.show(block=False)
+    return browser
@@ -0,0 +1,283 @@
+"""
+Headless QC reports: diagnostic figures rendered to PNG in worker processes.
+
+The study scripts plot interactively (Qt), which blocks a batch job or needs a
+display. Here every figure is a job (a picklable function + arguments) that a
+process pool renders with the Agg backend and saves as PNG; ``build`` writes
+an ``index.html`` linking them, one section per subject/stage:
+
+    report = eeg_report.Report('qc', title='study1 preprocessing')
+    eeg_report.add_raw_qc(report, 'sub-01', cached)   # traces + PSD
+    report.add('sub-01', 'ICA components', ica.plot_components)
+    report.build(n_jobs=8)                             # qc/index.html
+
+Long recordings are drawn from a min/max decimation (one min and one max per
+pixel column), which looks the same as the full trace at a fraction of the
+points. ``select_backend()`` picks Agg when there is no display, so the
+interactive scripts also run on compute nodes.
+"""
+
+import os
+import re
+import sys
+import time
+import html
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import matplotlib
+import mne
+
+# MPLBACKEND values that never open a window
+noninteractive_backends = ('agg', 'cairo', 'pdf', 'pgf', 'ps', 'svg', 'template')
+trace_axes = [0.12, 0.07, 0.86, 0.87]  # traces figure layout (figure fraction)
+
+
+def is_headless():
+    """True if no window can be opened (MPLBACKEND or no X11/Wayland display)."""
+    backend = os.environ.get('MPLBACKEND')
+    if backend:
+        return backend.lower() in noninteractive_backends
+    if sys.platform.startswith('win') or sys.platform == 'darwin':
+        return False
+    return not (os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY'))
+
+
+def select_backend(interactive='Qt5Agg'):
+    """``matplotlib.use(interactive)``, or Agg when headless; MPLBACKEND wins."""
+    if not os.environ.get('MPLBACKEND'):
+        matplotlib.use('Agg' if is_headless() else interactive)
+    return matplotlib.get_backend()
+
+
+# #### decimation ####
+
+def minmax_decimate(data, times, n_columns):
+    """(times, data) with one min and one max per column, for plotting.
+
+    ``data`` is (..., n_times); the result has 2 * n_columns points, every
+    column's min followed by its max, so the drawn envelope matches the full
+    trace. Returned as is when it is already that short.
+    """
+    n_times = data.shape[-1]
+    if n_times <= 2 * n_columns:
+        return times, data
+    starts = np.arange(0, n_times, int(np.ceil(n_times / float(n_columns))))
+    out = np.empty(data.shape[:-1] + (2 * len(starts),), data.dtype)
+    out[..., 0::2] = np.minimum.reduceat(data, starts, axis=-1)
+    out[..., 1::2] = np.maximum.reduceat(data, starts, axis=-1)
+    return np.repeat(times[starts], 2), out
+
+
+# #### figures (run in the workers) ####
+
+def _n_columns(size, dpi):
+    return int(size[0] * dpi * trace_axes[2])  # axes width in pixels
+
+
+def plot_traces(data, times, ch_names, title=None, size=(12., 8.), dpi=100):
+    """Stacked channel traces, min/max decimated to the axes width in pixels."""
+    import matplotlib.pyplot as plt
+    from matplotlib.collections import LineCollection
+
+    fig = plt.figure(figsize=size, dpi=dpi)
+    ax = fig.add_axes(trace_axes)
+    t, y = minmax_decimate(np.asarray(data), np.asarray(times),
+                           _n_columns(size, dpi))
+    # robust per-channel scale, like scalings='auto'
+    y = y - np.median(y, axis=-1, keepdims=True)
+    scale = np.percentile(np.abs(y), 99, axis=-1, keepdims=True)
+    y = y / (2.2 * np.where(scale > 0, scale, 1.))
+    offsets = np.arange(len(y))[::-1]
+    segments = np.stack([np.broadcast_to(t, y.shape), y + offsets[:, None]],
+                        axis=-1)
+    ax.add_collection(LineCollection(segments, linewidths=0.5, colors='k'))
+    ax.set(xlim=(times[0], times[-1]), ylim=(-1, len(y)), yticks=offsets,
+           xlabel='Time (s)')
+    ax.set_yticklabels(ch_names, fontsize=6)
+    if title:
+        ax.set_title(title)
+    return fig
+
+
+def _open_raw(source, preload=False):
+    # a file name, an eeg_cache.CachedRaw or an mne Raw
+    if isinstance(source, str):
+        return mne.io.read_raw(source, preload=preload, verbose=False)
+    if preload and not isinstance(source, mne.io.BaseRaw):
+        return source.to_raw()
+    return source
+
+
+def plot_raw(source, tmin=0., duration=None, picks=None, n_channels=None,
+             title=None, size=(12., 8.), dpi=100):
+    """Headless ``raw.plot(...)``: data channels of one window, decimated.
+
+    A CachedRaw is read from its min/max pyramid (see eeg_pyramid.py).
+    """
+    import eeg_pyramid
+
+    raw = _open_raw(source)
+    info = raw.info
+    if picks is None:
+        picks = mne.pick_types(info, meg=True, eeg=True, eog=True, ecg=True,
+                               exclude=[])
+    picks = list(picks)[:n_channels]
+    sfreq = info['sfreq']
+    start = int(round(tmin * sfreq))
+    stop = None if duration is None else start + int(round(duration * sfreq))
+    if isinstance(raw, mne.io.BaseRaw):
+        data = raw.get_data(picks=picks, start=start, stop=stop)
+        times = (start + np.arange(data.shape[-1])) / sfreq
+    else:
+        times, data = eeg_pyramid.open_pyramid(raw).read(
+            start, stop, _n_columns(size, dpi), picks)
+    return plot_traces(data, times, [raw.ch_names[p] for p in picks],
+                       title=title, size=size, dpi=dpi)
+
+
+def plot_psd(source, fmax=np.inf, average=True):
+    """Cached Welch spectrum (see eeg_psd.py) of a raw."""
+    import eeg_psd
+
+    return eeg_psd.compute_psd(_open_raw(source, preload=True)).plot(
+        fmax=fmax, average=average, show=False)
+
+
+def add_raw_qc(report, section, source, duration=60., fmax=np.inf):
+    """Standard raw checks of one subject: first ``duration`` s + the PSD."""
+    report.add(section, 'raw', plot_raw, source, duration=duration)
+    report.add(section, 'psd', plot_psd, source, fmax=fmax)
+
+
+# #### rendering ####
+
+def _init_worker():
+    matplotlib.use('Agg')
+    mne.viz.set_browser_backend('matplotlib', verbose=False)
+
+
+def _slug(name):
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', name).strip('_') or 'figure'
+
+
+def _save(figs, out_dir, section, name, dpi):
+    import matplotlib.pyplot as plt
+
+    if not isinstance(figs, (list, tuple)):
+        figs = [figs]
+    os.makedirs(os.path.join(out_dir, _slug(section)), exist_ok=True)
+    paths = []
+    for i, fig in enumerate(figs):
+        suffix = '' if len(figs) == 1 else '-{}'.format(i)
+        path = '{}/{}{}.png'.format(_slug(section), _slug(name), suffix)
+        fig.savefig(os.path.join(out_dir, path), dpi=dpi)
+        plt.close(fig)
+        paths.append(path)
+    return paths
+
+
+def _render(out_dir, section, name, func, args, kwargs, dpi):
+    import matplotlib.pyplot as plt
+
+    t0 = time.perf_counter()
+    plt.close('all')
+    figs = func(*args, **kwargs)
+    if figs is None:  # drew into pyplot's current figure(s)
+        figs = [plt.figure(n) for n in plt.get_fignums()]
+    return _save(figs, out_dir, section, name, dpi), time.perf_counter() - t0
+
+
+class Report(object):
+    """Figures grouped in sections, rendered into ``out_dir`` by ``build``."""
+
+    def __init__(self, out_dir, title='QC report', dpi=100):
+        self.out_dir = out_dir
+        self.title = title
+        self.dpi = dpi
+        self.items = []  # dict(section, name, job, paths, error, seconds)
+
+    def add(self, section, name, func, *args, **kwargs):
+        """Render ``func(*args, **kwargs)`` (figure, list of figures or None)."""
+        self.items.append(dict(section=section, name=name,
+                               job=(func, args, kwargs), paths=[], error=None,
+                               seconds=0.))
+
+    def show(self, section, name, func, *args, **kwargs):
+        """Draw now when there is a display, else queue it like ``add``.
+
+        Queued arguments are pickled at ``build`` time, so pass copies of
+        objects that are modified in between.
+        """
+        if not is_headless():
+            return func(*args, **kwargs)
+        self.add(section, name, func, *args, **kwargs)
+
+    def add_figure(self, section, name, fig):
+        """Save a figure that is already drawn (in this process)."""
+        os.makedirs(self.out_dir, exist_ok=True)
+        self.items.append(dict(section=section, name=name, job=None,
+                               paths=_save(fig, self.out_dir, section, name,
+                                           self.dpi),
+                               error=None, seconds=0.))
+
+    def build(self, n_jobs=None):
+        """Render the pending figures in ``n_jobs`` processes, write the HTML."""
+        n_jobs = os.cpu_count() if n_jobs in (None, -1) else n_jobs
+        os.makedirs(self.out_dir, exist_ok=True)
+        todo = [item for item in self.items if item['job'] is not None]
+        t0 = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=n_jobs,
+                                 initializer=_init_worker) as pool:
+            futures = {}
+            for item in todo:
+                func, args, kwargs = item['job']
+                futures[pool.submit(_render, self.out_dir, item['section'],
+                                    item['name'], func, args, kwargs,
+                                    self.dpi)] = item
+            for future in as_completed(futures):
+                item = futures[future]
+                item['job'] = None
+                try:
+                    item['paths'], item['seconds'] = future.result()
+                except Exception as exc:
+                    item['error'] = repr(exc)
+                    print('{} / {}: FAILED ({!r})'.format(item['section'],
+                                                          item['name'], exc))
+        wall = time.perf_counter() - t0
+        index = self.write_html()
+        n_failed = sum(item['error'] is not None for item in todo)
+        print('{} figures in {:.1f} s with {} workers, {} failed -> {}'.format(
+            len(todo) - n_failed, wall, n_jobs, n_failed, index))
+        return dict(n_figures=len(todo) - n_failed, n_failed=n_failed,
+                    wall_time=wall, index=index)
+
+    def write_html(self):
+        sections = []
+        for item in self.items:
+            if item['section'] not in sections:
+                sections.append(item['section'])
+        lines = ['<!DOCTYPE html>', '<html><head><meta charset="utf-8">',
+                 '<title>{}</title>'.format(html.escape(self.title)),
+                 '<style>img {max-width: 100%} pre {color: #b00}</style>',
+                 '</head><body>', '<h1>{}</h1>'.format(html.escape(self.title)),
+                 '<ul>']
+        lines += ['<li><a href="#{}">{}</a></li>'.format(_slug(s), html.escape(s))
+                  for s in sections]
+        lines.append('</ul>')
+        for section in sections:
+            lines.append('<h2 id="{}">{}</h2>'.format(_slug(section),
+                                                     html.escape(section)))
+            for item in self.items:
+                if item['section'] != section:
+                    continue
+                lines.append('<h3>{}</h3>'.format(html.escape(item['name'])))
+                if item['error'] is not None:
+                    lines.append('<pre>{}</pre>'.format(html.escape(item['error'])))
+                lines += ['<img src="{}" loading="lazy">'.format(path)
+                          for path in item['paths']]
+        lines.append('</body></html>')
+        index = os.path.join(self.out_dir, 'index.html')
+        with open(index, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        return index
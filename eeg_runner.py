@@ -0,0 +1,266 @@
+"""
+Run the study1 filter/notch/resample chain over many recordings at once.
+
+The chain is described by a plain dict (see ``study1_spec``) and every
+recording is processed by its own worker process, in place (no raw.copy()).
+
+    python eeg_runner.py out_dir sub-01_raw.fif sub-02_raw.fif --workers 4 --max-mem 4G
+
+``--profile timings.jsonl`` records every step of every subject (see
+eeg_profile.py); add ``--profile-stacks`` for the sampled stacks of the
+slowest steps.
+"""
+
+import os
+import sys
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import mne
+
+import eeg_cache
+import eeg_filter
+import eeg_linenoise
+import eeg_profile
+
+# same steps as study1_0310.py: high-pass, notch at 60 Hz + harmonics, downsample
+study1_spec = dict(
+    crop=None,                       # (tmin, tmax) in s, or None for everything
+    pick_types=None,                 # e.g. dict(meg='mag', stim=True)
+    l_freq=0.2,                      # high-pass cutoff, None to skip
+    notch_freqs=(60, 120, 180, 240),  # None/() to skip
+    notch_method='fir',              # or 'spectrum_fit'
+    notch_filter_length='auto',      # spectrum_fit only, e.g. '10s'
+    notch_track=False,               # spectrum_fit: follow a drifting mains
+    sfreq=200.,                      # target sfreq, None to skip resampling
+    stream=False,                    # filter chunk by chunk without loading
+)
+
+
+def parse_size(size):
+    """'4G', '512M', '1024' (bytes) -> int bytes; None stays None."""
+    if size is None or isinstance(size, int):
+        return size
+    units = dict(K=1 << 10, M=1 << 20, G=1 << 30)
+    size = size.strip().upper().rstrip('B')
+    if size[-1:] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def _limit_memory(max_mem):
+    # address-space cap per worker; a subject that needs more fails with
+    # MemoryError instead of taking the node down
+    if max_mem is None:
+        return
+    try:
+        import resource
+    except ImportError:  # Windows
+        print('--max-mem is not supported on this platform, ignoring')
+        return
+    resource.setrlimit(resource.RLIMIT_AS, (max_mem, max_mem))
+
+
+def out_fname(fname, out_dir):
+    base = os.path.basename(fname)
+    for ext in ('_raw.fif', '.fif', '.bdf', '.edf', '.gdf', '.set'):
+        if base.endswith(ext):
+            base = base[:-len(ext)]
+            break
+    return os.path.join(out_dir, base + '_preproc_raw.fif')
+
+
+def preprocess(raw, spec):
+    """Apply ``spec`` to a loaded raw, in place."""
+    if spec.get('crop'):
+        raw.crop(*spec['crop'])
+    if spec.get('pick_types'):
+        raw.pick_types(**spec['pick_types'])
+    with eeg_profile.stage('load_data', raw) as st:
+        raw.load_data()
+        st.output(raw)
+    picks = mne.pick_types(raw.info, meg=True, eeg=True, exclude=[])
+    fir_notch = spec.get('notch_method', 'fir') == 'fir'
+    notch_freqs = spec.get('notch_freqs') or None
+    if spec.get('l_freq') is not None or (notch_freqs and fir_notch):
+        # high-pass + FIR notch in one in-place pass, kernels come from the
+        # filter-design cache so they are only designed once per batch
+        with eeg_profile.stage('filter', raw) as st:
+            eeg_filter.filter_raw(raw, l_freq=spec.get('l_freq'),
+                                  notch_freqs=notch_freqs if fir_notch else None,
+                                  picks=picks, copy=False)
+            st.output(raw)
+    if notch_freqs and not fir_notch:
+        with eeg_profile.stage('notch_filter', raw) as st:
+            filter_length = spec.get('notch_filter_length', 'auto')
+            if spec['notch_method'] == 'spectrum_fit':
+                # all harmonics and channels per window in one solve
+                eeg_linenoise.remove_line_noise_raw(
+                    raw, notch_freqs, picks=picks,
+                    window=eeg_linenoise.window_seconds(filter_length,
+                                                        raw.info['sfreq']),
+                    track=spec.get('notch_track', False))
+            else:
+                raw.notch_filter(freqs=notch_freqs, picks=picks,
+                                 method=spec['notch_method'],
+                                 filter_length=filter_length, verbose=False)
+            st.output(raw)
+    if spec.get('sfreq') is not None:
+        with eeg_profile.stage('resample', raw) as st:
+            raw.resample(sfreq=spec['sfreq'], verbose=False)
+            st.output(raw)
+    return raw
+
+
+def preprocess_stream(raw, spec, out_dir, name):
+    """Same chain without loading the data, written to an eeg_cache entry.
+
+    Only FIR notch filtering and integer decimation are possible this way.
+    """
+    if spec.get('notch_freqs') and spec.get('notch_method', 'fir') != 'fir':
+        raise ValueError('stream=True only supports notch_method="fir"')
+    if spec.get('crop'):
+        raw.crop(*spec['crop'])
+    if spec.get('pick_types'):
+        raw.pick_types(**spec['pick_types'])
+    decim = 1
+    if spec.get('sfreq') is not None:
+        decim = max(int(round(raw.info['sfreq'] / spec['sfreq'])), 1)
+    picks = mne.pick_types(raw.info, meg=True, eeg=True, exclude=[])
+    with eeg_profile.stage('filter_stream', raw) as st:
+        cached = eeg_filter.filter_stream(raw, out_dir, name,
+                                          l_freq=spec.get('l_freq'),
+                                          notch_freqs=spec.get('notch_freqs'),
+                                          decim=decim, picks=picks)
+        st.output(cached)
+    return cached
+
+
+def run_one(fname, spec, out_dir, profile=None):
+    """Preprocess one file; ``profile`` = dict(log=..., sample=...) records
+    its steps (eeg_profile.Profiler arguments)."""
+    t0 = time.perf_counter()
+    profiler = None
+    if profile:
+        profiler = eeg_profile.install(eeg_profile.Profiler(
+            subject=os.path.basename(fname), **profile))
+    try:
+        with eeg_profile.stage('read') as st:
+            raw = mne.io.read_raw(fname, verbose=False)
+            st.output(raw)
+        if spec.get('stream'):
+            out = out_fname(fname, out_dir)[:-len('_raw.fif')]
+            preprocess_stream(raw, spec, out_dir, os.path.basename(out))
+            out += '.dat'
+        else:
+            preprocess(raw, spec)
+            out = out_fname(fname, out_dir)
+            with eeg_profile.stage('save', raw):
+                raw.save(out, overwrite=True, verbose=False)
+    finally:
+        if profiler is not None:
+            profiler.close()
+            eeg_profile.install(None)
+    return dict(fname=fname, out=out, seconds=time.perf_counter() - t0,
+                pid=os.getpid(), filter_cache=eeg_filter.cache_info())
+
+
+def _filter_cache_totals(results):
+    # counters are cumulative per worker, so take the last value of each
+    last = {}
+    for res in results:
+        last[res['pid']] = res['filter_cache']
+    return {k: sum(c[k] for c in last.values())
+            for k in ('hits', 'disk_hits', 'misses')}
+
+
+def qc_report(results, report_dir, n_workers=None):
+    """Headless raw traces + PSD of every output, see eeg_report.py."""
+    import eeg_report  # matplotlib, only when a report is asked for
+
+    qc = eeg_report.Report(report_dir, title='Preprocessing QC')
+    for res in sorted(results, key=lambda r: r['fname']):
+        out = res['out']
+        if out.endswith('.dat'):  # stream=True wrote an eeg_cache entry
+            out = eeg_cache.CachedRaw(os.path.dirname(out),
+                                      os.path.basename(out)[:-len('.dat')])
+        eeg_report.add_raw_qc(qc, os.path.basename(res['fname']), out)
+    return qc.build(n_jobs=n_workers)
+
+
+def run(fnames, spec=None, out_dir='.', n_workers=None, max_mem=None,
+        report_dir=None, profile=None):
+    """Preprocess ``fnames`` in a process pool; returns a report dict.
+
+    With ``report_dir``, a headless QC report of the outputs is built there.
+    ``profile`` (dict(log=..., sample=...)) records every step, see run_one.
+    """
+    spec = dict(study1_spec, **(spec or {}))
+    n_workers = n_workers or os.cpu_count()
+    os.makedirs(out_dir, exist_ok=True)
+
+    t0 = time.perf_counter()
+    results, failed = [], []
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=_limit_memory,
+                             initargs=(parse_size(max_mem),)) as pool:
+        futures = {pool.submit(run_one, fname, spec, out_dir, profile): fname
+                   for fname in fnames}
+        for future in as_completed(futures):
+            fname = futures[future]
+            try:
+                res = future.result()
+            except Exception as exc:  # MemoryError from the cap ends up here too
+                failed.append(dict(fname=fname, error=repr(exc)))
+                print('{}: FAILED ({!r})'.format(fname, exc))
+                continue
+            results.append(res)
+            print('{}: {:.1f} s'.format(fname, res['seconds']))
+    wall = time.perf_counter() - t0
+
+    report = dict(n_subjects=len(results), n_failed=len(failed),
+                  n_workers=n_workers, wall_time=wall,
+                  subjects_per_min=60. * len(results) / wall if wall else 0.,
+                  cpu_time=sum(r['seconds'] for r in results),
+                  filter_cache=_filter_cache_totals(results),
+                  results=results, failed=failed)
+    print('{} subjects in {:.1f} s with {} workers ({:.2f} subjects/min)'.format(
+        report['n_subjects'], wall, n_workers, report['subjects_per_min']))
+    print('filter cache: {hits} hits, {disk_hits} disk hits, {misses} misses'
+          .format(**report['filter_cache']))
+    if report_dir:
+        report['qc'] = qc_report(results, report_dir, n_workers)
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('out_dir')
+    parser.add_argument('fnames', nargs='+')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--max-mem', default=None, help="per worker, e.g. '4G'")
+    parser.add_argument('--l-freq', type=float, default=study1_spec['l_freq'])
+    parser.add_argument('--notch', type=float, nargs='*',
+                        default=study1_spec['notch_freqs'])
+    parser.add_argument('--notch-method', default=study1_spec['notch_method'])
+    parser.add_argument('--notch-track', action='store_true',
+                        help='spectrum_fit: follow a drifting mains frequency')
+    parser.add_argument('--sfreq', type=float, default=study1_spec['sfreq'])
+    parser.add_argument('--stream', action='store_true',
+                        help='chunked filtering for recordings larger than RAM')
+    parser.add_argument('--report', default=None,
+                        help='directory for a headless QC report (PNG/HTML)')
+    parser.add_argument('--profile', default=None,
+                        help='JSON lines file for per-step timings')
+    parser.add_argument('--profile-stacks', action='store_true',
+                        help='also sample the stacks of the slowest steps')
+    args = parser.parse_args()
+    spec = dict(l_freq=args.l_freq, notch_freqs=args.notch,
+                notch_method=args.notch_method, notch_track=args.notch_track,
+                sfreq=args.sfreq, stream=args.stream)
+    profile = None
+    if args.profile:
+        profile = dict(log=args.profile, sample=args.profile_stacks)
+    report = run(args.fnames, spec, args.out_dir, n_workers=args.workers,
+                 max_mem=args.max_mem, report_dir=args.report, profile=profile)
+    sys.exit(1 if report['n_failed'] else 0)
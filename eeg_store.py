@@ -0,0 +1,359 @@
+"""
+Chunked, compressed epochs of a whole cohort in one HDF5 file (needs h5py).
+
+Group analyses need the epochs of every subject (e.g. the equalized
+auditory/visual epochs of study2_0324_epoching.py), far more than fits in
+memory. ``EpochsStore`` keeps each subject in a group of one file:
+
+    /<subject>/data        (epochs, channels, times) in chunks of
+                           ``chunk_epochs`` x ``chunk_channels`` x all times,
+                           gzip + shuffle compressed
+    /<subject>/events      the events table: the index condition reads go
+                           through (event_id, tmin, baseline as attributes)
+    /<subject>/selection   epochs.selection
+    /<subject>/drop_log    epochs.drop_log (JSON)
+    /<subject>/info        the measurement info (fif bytes)
+    /<subject>/reject_log  autoreject's bad_epochs and labels, if given
+
+Reads are lazy: ``store.read('sub-01', 'auditory', picks=['MEG 1332'])``
+decompresses only the chunks holding those epochs and channels. Group
+statistics stream the chunks of one subject at a time through running means
+(eeg_epochs.Averages), so memory is O(channels x times x conditions):
+
+    store = eeg_store.EpochsStore('study2-epo.h5')
+    store.write('sub-01', epochs, reject_log=reject_log)  # once per subject
+    eeg_store.grand_average(store, 'auditory').plot()
+    eeg_store.contrast(store, 'auditory', 'visual').plot_joint()
+
+    python eeg_store.py study2-epo.h5     # subjects, epochs per condition
+"""
+
+import os
+import json
+import argparse
+import tempfile
+
+import numpy as np
+import h5py
+import mne
+
+import eeg_epochs
+import eeg_float32
+
+chunk_epochs = 32  # epochs per chunk (and written at a time)
+chunk_channels = 16  # channels per chunk
+compression = dict(compression='gzip', compression_opts=4, shuffle=True)
+
+
+def _info_bytes(info):
+    # mne only writes/reads info through files
+    with tempfile.TemporaryDirectory() as tmp:
+        fname = os.path.join(tmp, 'store-info.fif')
+        mne.io.write_info(fname, info)
+        with open(fname, 'rb') as f:
+            return f.read()
+
+
+def _read_info(raw_bytes):
+    with tempfile.TemporaryDirectory() as tmp:
+        fname = os.path.join(tmp, 'store-info.fif')
+        with open(fname, 'wb') as f:
+            f.write(raw_bytes)
+        return mne.io.read_info(fname, verbose=False)
+
+
+def _data_picks(info):
+    return mne.pick_types(info, meg=True, eeg=True, seeg=True, ecog=True,
+                          fnirs=True, exclude=[])
+
+
+def _channels(info, picks):
+    """Channel indices of ``picks`` (names or indices); None for all."""
+    if picks is None:
+        return None
+    names = info['ch_names']
+    idx = []
+    for p in picks:
+        if isinstance(p, str):
+            if p not in names:
+                raise ValueError('channel {} is not in the store'.format(p))
+            p = names.index(p)
+        idx.append(int(p))
+    return np.array(idx, int)
+
+
+def _rows(events, event_id, conditions):
+    """Epoch rows of ``conditions`` (names or '/' tags, pooled like
+    epochs[...]); all rows for None."""
+    if conditions is None:
+        return np.arange(len(events))
+    if isinstance(conditions, str):
+        conditions = [conditions]
+    codes = set()
+    for condition in conditions:
+        these = {code for name, code in event_id.items()
+                 if eeg_epochs._matches(name, condition)}
+        if not these:
+            raise KeyError('Event "{}" is not in {}'.format(
+                condition, sorted(event_id)))
+        codes |= these
+    return np.flatnonzero(np.isin(events[:, 2], sorted(codes)))
+
+
+def _read(data, rows, channels):
+    # (rows, data) per chunk of epochs holding any of ``rows``; h5py wants
+    # increasing channel indices, so read sorted and reorder
+    if channels is not None and np.array_equal(channels,
+                                               np.arange(data.shape[1])):
+        channels = None
+    if channels is not None:
+        channels, inverse = np.unique(channels, return_inverse=True)
+        channels = list(channels)
+    blocks = rows // data.chunks[0]
+    for block in np.unique(blocks):
+        these = rows[blocks == block]
+        a, b = these[0], these[-1] + 1
+        X = data[a:b] if channels is None else data[a:b, channels]
+        X = X[these - a]
+        if channels is not None:
+            X = X[:, inverse]
+        yield these, X
+
+
+class EpochsStore(object):
+    """Epochs of many subjects in the HDF5 file ``fname``.
+
+    The file is opened per call (nothing is held open), so a store can be
+    handed to worker processes; writes must come from one process at a time.
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+
+    def _open(self, mode='r'):
+        return h5py.File(self.fname, mode)
+
+    @property
+    def subjects(self):
+        if not os.path.exists(self.fname):
+            return []
+        with self._open() as f:
+            return list(f)
+
+    def write(self, subject, epochs, reject_log=None, dtype=None,
+              overwrite=False):
+        """Add the epochs of ``subject``, ``chunk_epochs`` at a time (they
+        need not be preloaded). ``dtype`` is that of the epochs by default
+        (np.float32 halves the file); ``reject_log`` is autoreject's
+        RejectLog of the epochs these were cleaned from."""
+        os.makedirs(os.path.dirname(os.path.abspath(self.fname)), exist_ok=True)
+        epochs.drop_bad()
+        if dtype is None:
+            dtype = eeg_float32.dtype_of(epochs)
+        shape = (len(epochs.events), epochs.info['nchan'], len(epochs.times))
+        chunks = (max(min(chunk_epochs, shape[0]), 1),
+                  min(chunk_channels, shape[1]), shape[2])
+        with self._open('a') as f:
+            if subject in f:
+                if not overwrite:
+                    raise ValueError('{} is in {} already (overwrite=True '
+                                     'replaces it)'.format(subject, self.fname))
+                del f[subject]
+            group = f.create_group(subject)
+            data = group.create_dataset('data', shape, dtype=dtype,
+                                        chunks=chunks, **compression)
+            for start in range(0, shape[0], chunk_epochs):
+                stop = start + chunk_epochs
+                data[start:stop] = (epochs._data[start:stop] if epochs.preload
+                                    else epochs[start:stop].get_data())
+            events = group.create_dataset('events', data=epochs.events)
+            events.attrs['event_id'] = json.dumps(epochs.event_id)
+            events.attrs['tmin'] = float(epochs.tmin)
+            events.attrs['baseline'] = json.dumps(
+                None if epochs.baseline is None
+                else [float(t) for t in epochs.baseline])
+            group.create_dataset('selection', data=epochs.selection)
+            # a dataset: attributes are limited to 64 kB
+            group.create_dataset('drop_log', data=json.dumps(epochs.drop_log))
+            group.create_dataset('info', data=np.void(_info_bytes(epochs.info)))
+            if reject_log is not None:
+                log = group.create_group('reject_log')
+                log.create_dataset('bad_epochs',
+                                   data=np.asarray(reject_log.bad_epochs))
+                log.create_dataset('labels', data=np.asarray(reject_log.labels,
+                                                             float),
+                                   **compression)
+                log.attrs['ch_names'] = json.dumps(list(reject_log.ch_names))
+
+    def header(self, subject):
+        """dict(info, times, events, event_id, baseline, selection, drop_log,
+        dtype) of ``subject``, everything but the data."""
+        with self._open() as f:
+            group = f[subject]
+            events = group['events']
+            info = _read_info(group['info'][()].tobytes())
+            baseline = json.loads(events.attrs['baseline'])
+            n_times = group['data'].shape[2]
+            return dict(
+                info=info, events=events[()],
+                times=events.attrs['tmin'] + np.arange(n_times) / info['sfreq'],
+                event_id=json.loads(events.attrs['event_id']),
+                baseline=None if baseline is None else tuple(baseline),
+                selection=group['selection'][()],
+                drop_log=tuple(tuple(r) for r in
+                               json.loads(group['drop_log'][()])),
+                dtype=group['data'].dtype)
+
+    def reject_log(self, subject):
+        """dict(bad_epochs, labels, ch_names) as written, or None."""
+        with self._open() as f:
+            if 'reject_log' not in f[subject]:
+                return None
+            log = f[subject]['reject_log']
+            return dict(bad_epochs=log['bad_epochs'][()],
+                        labels=log['labels'][()],
+                        ch_names=json.loads(log.attrs['ch_names']))
+
+    def counts(self, subject):
+        """{event name: number of epochs} of ``subject``."""
+        header = self.header(subject)
+        codes = header['events'][:, 2]
+        return {name: int((codes == code).sum())
+                for name, code in header['event_id'].items()}
+
+    def iter_chunks(self, subject, conditions=None, picks=None, header=None):
+        """(rows, data) of the epochs of ``conditions`` (all by default),
+        chunk by chunk, ``picks`` channels (names or indices) only."""
+        header = header or self.header(subject)
+        rows = _rows(header['events'], header['event_id'], conditions)
+        channels = _channels(header['info'], picks)
+        with self._open() as f:
+            for item in _read(f[subject]['data'], rows, channels):
+                yield item
+
+    def read(self, subject, conditions=None, picks=None):
+        """mne Epochs of ``conditions`` and ``picks`` of ``subject`` (in the
+        stored dtype, see eeg_float32)."""
+        header = self.header(subject)
+        info = header['info']
+        rows = _rows(header['events'], header['event_id'], conditions)
+        channels = _channels(info, picks)
+        if channels is not None:
+            info = mne.pick_info(info, channels)
+        X = np.empty((len(rows), info['nchan'], len(header['times'])),
+                     dtype=header['dtype'])
+        n = 0
+        for these, chunk in self.iter_chunks(subject, conditions, picks, header):
+            X[n:n + len(these)] = chunk
+            n += len(these)
+        events = header['events'][rows]
+        event_id = {name: code for name, code in header['event_id'].items()
+                    if code in events[:, 2]}
+        # epochs not read are IGNORED in the drop log, as in epochs[...]
+        selection = header['selection'][rows]
+        drop_log = list(header['drop_log'])
+        for i in np.setdiff1d(header['selection'], selection):
+            drop_log[i] = ('IGNORED',)
+        epochs = eeg_float32.epochs_array(
+            X, info, events=events, tmin=header['times'][0], event_id=event_id,
+            selection=selection, drop_log=tuple(drop_log))
+        epochs.baseline = header['baseline']  # corrected before writing
+        return epochs
+
+    def averages(self, subject, conditions=None, picks=None):
+        """eeg_epochs.Averages (per-code running means and variances) of the
+        epochs of ``conditions``, streamed chunk by chunk; data channels by
+        default."""
+        header = self.header(subject)
+        info = header['info']
+        if picks is None:
+            picks = _data_picks(info)
+        channels = _channels(info, picks)
+        averages = eeg_epochs.Averages(mne.pick_info(info, channels),
+                                       header['times'], header['event_id'],
+                                       header['baseline'])
+        codes = header['events'][:, 2]
+        for rows, X in self.iter_chunks(subject, conditions, channels, header):
+            these = codes[rows]
+            for code in np.unique(these):
+                averages.states[code].update(X[these == code])
+        averages.drop_log = header['drop_log']
+        return averages
+
+    def __repr__(self):
+        return '<EpochsStore | {}, {} subjects>'.format(self.fname,
+                                                       len(self.subjects))
+
+
+# #### group statistics ####
+
+def _group(store, weights, subjects=None, picks=None):
+    """Welford over subjects of sum(weight x subject average) per condition
+    of ``weights``, and the Averages of the first subject. Subjects without
+    epochs of one of the conditions are skipped (with a warning), so the
+    count is that of the contributing subjects."""
+    subjects = store.subjects if subjects is None else subjects
+    if not subjects:
+        raise ValueError('no subjects in {}'.format(store.fname))
+    group, first, first_subject = None, None, None
+    for subject in subjects:
+        averages = store.averages(subject, list(weights), picks)
+        missing = [c for c in weights if averages.state(c).n == 0]
+        if missing:
+            mne.utils.warn('{} has no epochs of {}, skipped'.format(
+                subject, ', '.join(missing)))
+            continue
+        X = sum(w * averages.state(c).mean for c, w in weights.items())
+        if first is None:
+            group, first = eeg_epochs.Welford(X.shape), averages
+            first_subject = subject
+        elif averages.info['ch_names'] != first.info['ch_names'] or \
+                not np.allclose(averages.times, first.times):
+            raise ValueError('{} has other channels or times than {}; pick '
+                             'common channels'.format(subject, first_subject))
+        group.update(X[np.newaxis])
+    if first is None:
+        raise ValueError('no subject has epochs of {}'.format(
+            ', '.join(weights)))
+    return group, first
+
+
+def grand_average(store, condition, subjects=None, picks=None):
+    """Evoked of the mean over subjects of each subject's average of
+    ``condition`` (like mne.grand_average; nave is the number of subjects),
+    read out of core."""
+    group, first = _group(store, {condition: 1.}, subjects, picks)
+    return first._evoked(group.mean, condition, group.n, 'average')
+
+
+def contrast(store, condition, other, subjects=None, picks=None):
+    """Grand average of the per-subject differences ``condition`` - ``other``
+    (mne.combine_evoked(..., weights=[1, -1]) per subject)."""
+    group, first = _group(store, {condition: 1., other: -1.}, subjects, picks)
+    return first._evoked(group.mean, '{} - {}'.format(condition, other),
+                         group.n, 'average')
+
+
+def summary(store):
+    """Subjects, epochs per condition and compression of ``store``."""
+    lines = []
+    for subject in store.subjects:
+        with store._open() as f:
+            data = f[subject]['data']
+            shape, dtype = data.shape, data.dtype
+            size = data.id.get_storage_size()
+        lines.append('{}: {} epochs x {} channels x {} times, {}, {:.0f} MB '
+                     '({:.1f}x compressed)'.format(
+                         subject, shape[0], shape[1], shape[2], dtype,
+                         size / 2. ** 20,
+                         np.prod(shape) * dtype.itemsize / max(size, 1)))
+        lines.append('  ' + ', '.join('{}: {}'.format(name, n) for name, n in
+                                      store.counts(subject).items()))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('fname', help='HDF5 epochs store')
+    args = parser.parse_args()
+    print(summary(EpochsStore(args.fname)))
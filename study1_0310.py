@@ -3,6 +3,15 @@ import numpy as np
 import matplotlib.pyplot as plt
 import mne
 
+import eeg_artifacts
+import eeg_cache
+import eeg_epochs
+import eeg_filter
+import eeg_interp
+import eeg_linenoise
+import eeg_psd
+import eeg_pyramid
+
 # #### 1) Loading data ####
 # EEG and MEG data from one subject performing an audiovisual experiment + structural MRI scans
 sample_data_folder = mne.datasets.sample.data_path()
@@ -11,6 +20,9 @@ sample_data_folder = mne.datasets.sample.data_path()
 sample_data_raw_file = os.path.join(sample_data_folder, 'MEG', 'sample',
                                     'sample_audvis_raw.fif')
 raw = mne.io.read_raw_fif(sample_data_raw_file)
+# memory-mapped copy + min/max pyramid for browsing (see eeg_pyramid.py)
+cached = eeg_cache.cache_raw(sample_data_raw_file,
+                             os.path.join(sample_data_folder, 'cache'))
 
 print(raw)
 print(raw.info)
@@ -21,8 +33,8 @@ print(raw.info['sfreq'], 'Hz')            # sampling frequency
 print(raw.info['description'], '\n')      # miscellaneous acquisition info
 
 # raw 객체의 built-in plotting 메서드
-raw.plot_psd(fmax=50)
-raw.plot(duration=5, n_channels=30)
+eeg_psd.compute_psd(raw).plot(fmax=50)
+eeg_pyramid.browse(cached, duration=5, n_channels=30)
 
 # #### 2) Preprocessing ####
 
@@ -31,12 +43,14 @@ raw.plot(duration=5, n_channels=30)
 raw.crop(0, 60).pick_types(meg='mag', stim=True).load_data()
 
 # looking for slow drift in the data
-raw.plot(duration=60, proj=False, n_channels=len(raw.ch_names),
-         remove_dc=False)
+# (first 60 s of the same channels, read from the pyramid of the cache)
+eeg_pyramid.browse(cached, duration=60, remove_dc=False,
+                   picks=mne.pick_types(cached.info, meg='mag', stim=True))
 
 # for cutoff frequency
 for cutoff in (0.1, 0.2):
-    raw_highpass = raw.copy().filter(l_freq=cutoff, h_freq=None)
+    # one output buffer per variant, no raw.copy() + filter (see eeg_filter.py)
+    raw_highpass = eeg_filter.filter_raw(raw, l_freq=cutoff)
     fig = raw_highpass.plot(duration=60, proj=False,
                             n_channels=len(raw.ch_names), remove_dc=False)
     fig.subplots_adjust(top=0.9)
@@ -44,8 +58,8 @@ for cutoff in (0.1, 0.2):
                  weight='bold')
 
 # filter visualization
-filter_params = mne.filter.create_filter(raw.get_data(), raw.info['sfreq'],
-                                         l_freq=0.2, h_freq=None)
+# (same kernel as mne.filter.create_filter, from the filter-design cache)
+filter_params = eeg_filter.design_chain(raw.info['sfreq'], l_freq=0.2)
 mne.viz.plot_filter(filter_params, raw.info['sfreq'], flim=(0.01, 5))
 
 # finding power line noise
@@ -65,29 +79,33 @@ def add_arrows(axes):
 # applying notch filter to raw object
 meg_picks = mne.pick_types(raw.info, meg=True)
 freqs = (60, 120, 180, 240)
-raw_notch = raw.copy().notch_filter(freqs=freqs, picks=meg_picks)
+raw_notch = eeg_filter.filter_raw(raw, notch_freqs=freqs, picks=meg_picks)
 
-for title, data in zip(['Un', 'Notch '], [raw, raw_notch]):
-    fig = data.plot_psd(fmax=250, average=True)
+# both spectra in one batched pass, each plot is served from the cache
+psds = eeg_psd.compute_psd_batch([raw, raw_notch])
+for title, psd in zip(['Un', 'Notch '], psds):
+    fig = psd.plot(fmax=250, average=True)
     fig.subplots_adjust(top=0.85)
     fig.suptitle('{}filtered'.format(title), size='xx-large', weight='bold')
     add_arrows(fig.axes[:2])
 
-# notch filtering with spectrum fitting
-raw_notch_fit = raw.copy().notch_filter(
-    freqs=freqs, picks=meg_picks, method='spectrum_fit', filter_length='10s')
+# notch filtering with spectrum fitting: notch_filter(method='spectrum_fit',
+# filter_length='10s') as batched sinusoid fits (see eeg_linenoise.py)
+raw_notch_fit = eeg_linenoise.remove_line_noise_raw(
+    raw, freqs, picks=meg_picks, window=10., copy=True)
 
 for title, data in zip(['Un', 'spectrum_fit '], [raw, raw_notch_fit]):
-    fig = data.plot_psd(fmax=250, average=True)
+    fig = eeg_psd.compute_psd(data).plot(fmax=250, average=True)
     fig.subplots_adjust(top=0.85)
     fig.suptitle('{}filtered'.format(title), size='xx-large', weight='bold')
     add_arrows(fig.axes[:2])
 
 # resampling
-raw_downsampled = raw.copy().resample(sfreq=200)
+# anti-alias low-pass + decimation by 3 in one pass (600.6 Hz -> 200.2 Hz)
+raw_downsampled = eeg_filter.filter_raw(raw, decim=3)
 
 for data, title in zip([raw, raw_downsampled], ['Original', 'Downsampled']):
-    fig = data.plot_psd(average=True)
+    fig = eeg_psd.compute_psd(data).plot(average=True)
     fig.subplots_adjust(top=0.9)
     fig.suptitle(title)
     plt.setp(fig.axes, xlim=(0, 300))
@@ -100,7 +118,9 @@ raw = mne.io.read_raw_fif(sample_data_raw_file)
 raw.crop(0, 60).load_data()
 
 #  extract epochs centered around the detected heartbeat artifacts
-ecg_epochs = mne.preprocessing.create_ecg_epochs(raw)
+# (EOG and ECG epochs + averages built once, see eeg_artifacts.py)
+artifacts = eeg_artifacts.artifact_epochs(raw, baseline=(-0.5, -0.2))
+ecg_epochs = artifacts['ecg_epochs']
 ecg_epochs.plot_image(combine='mean')
 
 # image plot without drift
@@ -108,7 +128,7 @@ ecg_epochs.plot_image(combine='mean')
 # ecg_epochs.plot_image(combine='mean')
 
 # baseline correction
-avg_ecg_epochs = ecg_epochs.average().apply_baseline((-0.5, -0.2))
+avg_ecg_epochs = artifacts['ecg_evoked']
 
 # visualization of spatial pattern of the associated field
 avg_ecg_epochs.plot_topomap(times=np.linspace(-0.05, 0.05, 11))
@@ -118,11 +138,11 @@ avg_ecg_epochs.plot_joint(times=[-0.25, -0.025, 0, 0.025, 0.25])
 
 # EOG detection
 # find artifacts & extract epochs
-eog_epochs = mne.preprocessing.create_eog_epochs(raw, baseline=(-0.5, -0.2))
+eog_epochs = artifacts['eog_epochs'].apply_baseline((-0.5, -0.2))
 
 # visualization
 eog_epochs.plot_image(combine='mean')
-eog_epochs.average().plot_joint()
+artifacts['eog_evoked'].plot_joint()
 
 # Bad channel marking
 from copy import deepcopy
@@ -153,12 +173,15 @@ raw.info['bads'] = original_bads     # change the whole list at once
 raw2 = raw.copy()
 raw2.info['bads'] = []
 events = mne.find_events(raw2, stim_channel='STI 014')
-epochs = mne.Epochs(raw2, events=events)['2'].average().plot()
+# averaged straight from the file, the epochs are never all in memory
+# (see eeg_epochs.stream_average)
+epochs = eeg_epochs.stream_average(raw2, events).average('2').plot()
 
 raw.crop(tmin=0, tmax=3).load_data()
 
 eeg_data = raw.copy().pick_types(meg=False, eeg=True, exclude=[])
-eeg_data_interp = eeg_data.copy().interpolate_bads(reset_bads=False)
+# interpolation matrices are cached per (geometry, bads), see eeg_interp.py
+eeg_data_interp = eeg_interp.interpolate_bads(eeg_data.copy(), reset_bads=False)
 
 for title, data in zip(['orig.', 'interp.'], [eeg_data, eeg_data_interp]):
     fig = data.plot(butterfly=True, color='#00000022', bad_color='r')
@@ -166,7 +189,7 @@ for title, data in zip(['orig.', 'interp.'], [eeg_data, eeg_data_interp]):
     fig.suptitle(title, size='xx-large', weight='bold')
 
 grad_data = raw.copy().pick_types(meg='grad', exclude=[])
-grad_data_interp = grad_data.copy().interpolate_bads(reset_bads=False)
+grad_data_interp = eeg_interp.interpolate_bads(grad_data.copy(), reset_bads=False)
 
 for data in (grad_data, grad_data_interp):
     data.plot(butterfly=True, color='#00000009', bad_color='r')
\ No newline at end of file
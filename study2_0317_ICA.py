@@ -5,6 +5,9 @@ import mne
 from mne.preprocessing import (ICA, create_eog_epochs, create_ecg_epochs,
                                corrmap)
 
+import eeg_artifacts
+import eeg_ica
+
 # #### 2-2) ICA ####
 sample_data_folder = mne.datasets.sample.data_path()
 
@@ -26,14 +29,16 @@ artifact_picks = mne.pick_channels_regexp(raw.ch_names, regexp=regexp)
 raw.plot(order=artifact_picks, n_channels=len(artifact_picks),
          show_scrollbars=False)
 
+# EOG/ECG epochs and baseline-corrected averages, built once and reused by
+# the component scoring below
+artifacts = eeg_artifacts.artifact_epochs(raw, baseline=(None, -0.2))
+
 # visualize EOG artifacts
-eog_evoked = create_eog_epochs(raw).average()
-eog_evoked.apply_baseline(baseline=(None, -0.2))
+eog_evoked = artifacts['eog_evoked']
 eog_evoked.plot_joint()
 
 # visualize ECG artifacts
-ecg_evoked = create_ecg_epochs(raw).average()
-ecg_evoked.apply_baseline(baseline=(None, -0.2))
+ecg_evoked = artifacts['ecg_evoked']
 ecg_evoked.plot_joint()
 
 
@@ -42,8 +47,11 @@ filt_raw = raw.copy().filter(l_freq=1., h_freq=None)
 
 
 # fitting and plotting the ICA solution
-ica = ICA(n_components=15, max_iter='auto', random_state=97)
-ica.fit(filt_raw)
+# (cached on disk; the PCA step is shared with the 30-component fit below)
+# FastICA iterations run on all cores and print their time/convergence
+ica = eeg_ica.fit_ica(filt_raw, n_components=15, max_iter='auto',
+                      random_state=97, n_jobs=-1,
+                      callback=eeg_ica.ConvergenceLog(verbose=True))
 ica
 
 # plot the time series of ICS
@@ -54,10 +62,9 @@ ica.plot_sources(raw, show_scrollbars=False)
 ica.plot_components()
 
 # plot original signal against reconstructed signal with artifacts
-# blinks
-ica.plot_overlay(raw, exclude=[0], picks='eeg')
-# heartbeats
-ica.plot_overlay(raw, exclude=[1], picks='mag')
+# blinks ([0], see the EEG row) and heartbeats ([1], MAG row), both from
+# one source decomposition (see eeg_ica.preview)
+eeg_ica.plot_overlay(raw, ica, [[0], [1]])
 
 # plot diagnostics
 ica.plot_properties(raw, picks=[0, 1])
@@ -65,9 +72,10 @@ ica.plot_properties(raw, picks=[0, 1])
 # #### 2-1) Selecting ICA components manually ####
 ica.exclude = [0, 1]  # indices chosen based on various plots above
 
-# ica.apply() changes the Raw object in-place, so let's make a copy first:
+# apply_ica() (like ica.apply()) changes the Raw object in-place, so let's
+# make a copy first; only the excluded components are subtracted
 reconst_raw = raw.copy()
-ica.apply(reconst_raw)
+eeg_ica.apply_ica(reconst_raw, ica)
 
 # plot the reconstructed data & original data
 raw.plot(order=artifact_picks, n_channels=len(artifact_picks),
@@ -80,8 +88,11 @@ del reconst_raw
 # #### 2-2) Using an EOG channel to select ICA components ####
 ica.exclude = []
 
-# find which ICs match the EOG pattern
-eog_indices, eog_scores = ica.find_bads_eog(raw)
+# find which ICs match the EOG and the ECG pattern: one get_sources and one
+# filtering pass for both (same scores as find_bads_eog / find_bads_ecg)
+found = eeg_artifacts.classify(raw, ica, ecg_method='correlation',
+                               epochs=artifacts, exclude=False, verbose=True)
+eog_indices, eog_scores = found['eog'], found['eog_scores']
 ica.exclude = eog_indices
 
 # barplot of ICA component "EOG match" scores
@@ -100,9 +111,8 @@ ica.plot_sources(eog_evoked)
 # #### 2-3) Using a simulated channel to select ICA components ####
 ica.exclude = []
 
-# find which ICs match the ECG pattern
-ecg_indices, ecg_scores = ica.find_bads_ecg(raw, method='correlation',
-                                            threshold='auto')
+# ICs matching the ECG pattern (scored above)
+ecg_indices, ecg_scores = found['ecg'], found['ecg_scores']
 ica.exclude = ecg_indices
 
 # barplot of ICA component "ECG match" scores
@@ -118,13 +128,14 @@ ica.plot_sources(raw, show_scrollbars=False)
 ica.plot_sources(ecg_evoked)
 
 # refit the ICA with 30 components this time
-new_ica = ICA(n_components=30, max_iter='auto', random_state=97)
-new_ica.fit(filt_raw)
-
-# find which ICs match the ECG pattern
-ecg_indices, ecg_scores = new_ica.find_bads_ecg(raw, method='correlation',
-                                                threshold='auto')
-new_ica.exclude = ecg_indices
+new_ica = eeg_ica.fit_ica(filt_raw, n_components=30, max_iter='auto',
+                          random_state=97, n_jobs=-1,
+                          callback=eeg_ica.ConvergenceLog(verbose=True))
+
+# find which ICs match the ECG pattern (sets new_ica.exclude)
+found = eeg_artifacts.classify(raw, new_ica, eog=False, ecg_method='correlation',
+                               epochs=artifacts, verbose=True)
+ecg_indices, ecg_scores = found['ecg'], found['ecg_scores']
 
 # barplot of ICA component "ECG match" scores
 new_ica.plot_scores(ecg_scores)
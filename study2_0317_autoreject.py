@@ -11,14 +11,19 @@ autoreject (local) again.
 
 import os.path as op
 import numpy as np
-import matplotlib
 import matplotlib.pyplot as plt
-matplotlib.use('Qt5Agg')
 
 import mne
 import autoreject
 import openneuro
 
+import eeg_autoreject
+import eeg_ica
+import eeg_report
+
+# Qt5Agg on a desktop, Agg on compute nodes without a display (or MPLBACKEND)
+eeg_report.select_backend('Qt5Agg')
+
 dataset = 'ds002778'  # The id code on OpenNeuro for this example dataset
 subject_id = 'pd14'
 
@@ -41,46 +46,60 @@ raw.drop_channels([ch for ch in raw.ch_names
                    if ch not in dig_montage.ch_names])
 raw.set_montage(dig_montage)
 
+# without a display the figures below go to target_dir/qc (PNG + index.html),
+# rendered in parallel at the end
+report = eeg_report.Report(op.join(target_dir, 'qc'),
+                           title='autoreject + ICA, {}'.format(subject_id))
+
 
 # high-pass filter for removing slow drift
 raw.filter(l_freq=1, h_freq=None)
 epochs = mne.make_fixed_length_epochs(raw, duration=3, preload=True)
 
 # autoreject for high-pass filtered data
-ar = autoreject.AutoReject(n_interpolate=[1, 2, 3, 4], random_state=11,
-                           n_jobs=1, verbose=True)
-ar.fit(epochs[:20])  # fit on a few epochs to save time
+# CV folds run in a process pool over shared-memory epochs (see
+# eeg_autoreject.py), so fit on all epochs instead of a subset
+ar = eeg_autoreject.fit_autoreject(epochs, n_interpolate=[1, 2, 3, 4],
+                                   random_state=11, n_jobs=-1, verbose=True)
 epochs_ar, reject_log = ar.transform(epochs, return_log=True)
 
-# compute ICA
-ica = mne.preprocessing.ICA(random_state=99)
-ica.fit(epochs[~reject_log.bad_epochs])
+# compute ICA (on all cores, printing time & convergence per iteration)
+ica = eeg_ica.fit_ica(epochs[~reject_log.bad_epochs], random_state=99,
+                      n_jobs=-1, callback=eeg_ica.ConvergenceLog(verbose=True))
 
 # plot source components to see blink artifacts
 exclude = [0,   # blinks
            2]    # saccades
-ica.plot_components(exclude)
+report.show('ICA', 'components', ica.plot_components, exclude)
 ica.exclude = exclude
 
 # plot with and without eyeblink component
-ica.plot_overlay(epochs.average(), exclude=ica.exclude)
-ica.apply(epochs, exclude=ica.exclude)
+report.show('ICA', 'overlay', eeg_ica.plot_overlay, epochs.average(), ica,
+            [list(ica.exclude)])
+eeg_ica.apply_ica(epochs, ica)  # rank-k update, in place
 
 # compute channel-level rejections
-ar = autoreject.AutoReject(n_interpolate=[1, 2, 3, 4], random_state=11,
-                           n_jobs=1, verbose=True)
-ar.fit(epochs[:20])  # fit on the first 20 epochs to save time
+ar = eeg_autoreject.fit_autoreject(epochs, n_interpolate=[1, 2, 3, 4],
+                                   random_state=11, n_jobs=-1, verbose=True)
 epochs_ar, reject_log = ar.transform(epochs, return_log=True)
-epochs[reject_log.bad_epochs].plot(scalings=dict(eeg=100e-6))
 
 # visualize dropped epochs
-epochs[reject_log.bad_epochs].plot(scalings=dict(eeg=100e-6))
+report.show('autoreject', 'dropped epochs', epochs[reject_log.bad_epochs].plot,
+            scalings=dict(eeg=100e-6))
 
 # visualize reject log
-reject_log.plot('horizontal')
+report.show('autoreject', 'reject log', reject_log.plot, 'horizontal')
+
 
 # visualize the cleaned average data & compare it against bad segments
-evoked_bad = epochs[reject_log.bad_epochs].average()
-plt.figure()
-plt.plot(evoked_bad.times, evoked_bad.data.T * 1e6, 'r', zorder=-1)
-epochs_ar.average().plot(axes=plt.gca())
\ No newline at end of file
+def plot_cleaned(evoked_bad, evoked_clean):
+    fig = plt.figure()
+    plt.plot(evoked_bad.times, evoked_bad.data.T * 1e6, 'r', zorder=-1)
+    evoked_clean.plot(axes=plt.gca())
+    return fig
+
+
+report.show('autoreject', 'cleaned vs bad', plot_cleaned,
+            epochs[reject_log.bad_epochs].average(), epochs_ar.average())
+if eeg_report.is_headless():
+    report.build(n_jobs=-1)
\ No newline at end of file
@@ -3,29 +3,29 @@ import numpy as np
 import matplotlib.pyplot as plt
 import mne
 
+import eeg_cache
+import eeg_epochs
+import eeg_events
+import eeg_pipeline
+import eeg_psd
+import eeg_store
+
 # #### 3-2) Epoching ####
 
 # load (filtered & downsampled) data
 sample_data_folder = mne.datasets.sample.data_path()
 sample_data_raw_file = os.path.join(sample_data_folder, 'MEG', 'sample',
                                     'sample_audvis_filt-0-40_raw.fif')
-raw = mne.io.read_raw_fif(sample_data_raw_file)
-
-# preprocessing
-from mne.preprocessing import (ICA, create_eog_epochs, create_ecg_epochs,
-                               corrmap)
-
-ica = mne.preprocessing.ICA(n_components=20, random_state=97, max_iter=800)
-ica.fit(raw)
-ica.exclude = [1, 2]  # ICs with EOG, ECG artifacts
-ica.plot_properties(raw, picks=ica.exclude)
+# float32 memmaps of the unfiltered recording further down, its Epochs are
+# gathered from them (see eeg_epochs.py) instead of re-reading the fif
+cache_folder = os.path.join(sample_data_folder, 'cache')
 
-# detecting experimental events (using STIM channels)
-events = mne.find_events(raw, stim_channel='STI 014')
+# preprocessing, events and epochs as the cached study2 stages (see
+# eeg_pipeline.py): the ICA fitted by study2_0324_events.py is read back, and
+# changing only the epoch window below re-runs only the epoching
 event_dict = {'auditory/left': 1, 'auditory/right': 2, 'visual/left': 3,
               'visual/right': 4, 'smiley': 5, 'buttonpress': 32}
 
-
 # epoching
 # define reject criteria
 reject_criteria = dict(mag=4000e-15,     # 4000 fT
@@ -33,9 +33,16 @@ reject_criteria = dict(mag=4000e-15,     # 4000 fT
                        eeg=150e-6,       # 150 µV
                        eog=250e-6)       # 250 µV
 
-# make Epochs object
-epochs = mne.Epochs(raw, events, event_id=event_dict, tmin=-0.2, tmax=0.5,
-                    reject=reject_criteria, preload=True)
+# make Epochs object (of the raw as it is: the ICA is only looked at here,
+# source='clean' would epoch the ICA-cleaned raw instead)
+pipe = eeg_pipeline.study2_pipeline(
+    sample_data_raw_file, epochs=dict(source='raw', event_id=event_dict,
+                                      tmin=-0.2, tmax=0.5,
+                                      reject=reject_criteria))
+out = pipe.run(['raw', 'ica', 'epochs'])
+raw, ica = out['raw'], out['ica']
+ica.plot_properties(raw, picks=ica.exclude)
+epochs = out['epochs'].copy()  # equalize_event_counts works in place
 
 # pool across left/right stimulus presentations so we can compare auditory versus visual responses
 conds_we_care_about = ['auditory/left', 'auditory/right',
@@ -45,6 +52,13 @@ conds_we_care_about = ['auditory/left', 'auditory/right',
 epochs.equalize_event_counts(conds_we_care_about)
 aud_epochs = epochs['auditory']
 vis_epochs = epochs['visual']
+
+# cohort store: every subject's equalized epochs go into one chunked,
+# compressed HDF5 file (see eeg_store.py); group averages and contrasts
+# stream through it one subject at a time
+store = eeg_store.EpochsStore(os.path.join(cache_folder, 'study2-epo.h5'))
+store.write('sample', epochs, overwrite=True)
+eeg_store.contrast(store, 'auditory', 'visual').plot_joint()
 del raw, epochs  # free up memory
 
 aud_epochs.plot_image(picks=['MEG 1332', 'EEG 021'])
@@ -54,41 +68,42 @@ aud_epochs.plot_image(picks=['MEG 1332', 'EEG 021'])
 sample_data_folder = mne.datasets.sample.data_path()
 sample_data_raw_file = os.path.join(sample_data_folder, 'MEG', 'sample',
                                     'sample_audvis_raw.fif')
-raw = mne.io.read_raw_fif(sample_data_raw_file, verbose=False).crop(tmax=60)
+cached = eeg_cache.cache_raw(sample_data_raw_file, cache_folder)
 
-# find events
-events = mne.find_events(raw, stim_channel='STI 014')
+# find events (the first 60 s of the cached table, a view); the cache is not
+# cropped, so stop 0.7 s early to keep the epochs that fit in the first 60 s
+events = eeg_events.find_events(cached, stim_channel='STI 014').between(
+    tmax=60 - 0.7).events
 
-# epoching
-epochs = mne.Epochs(raw, events, tmin=-0.3, tmax=0.7)
+# epoching (not preloaded: every epoch is a view into the cache)
+epochs = eeg_epochs.LazyEpochs(cached, events, tmin=-0.3, tmax=0.7)
 print(epochs)
 print(epochs.event_id)
 
 # provide event dictionary
 event_dict = {'auditory/left': 1, 'auditory/right': 2, 'visual/left': 3,
               'visual/right': 4, 'face': 5, 'buttonpress': 32}
-epochs = mne.Epochs(raw, events, tmin=-0.3, tmax=0.7, event_id=event_dict,
-                    preload=True)
+epochs = eeg_epochs.make_epochs(cached, events, event_dict, tmin=-0.3,
+                                tmax=0.7)
 print(epochs.event_id)
-del raw     # free up memory
 
 
 # visualization of Epochs object
 sample_data_folder = mne.datasets.sample.data_path()
 sample_data_raw_file = os.path.join(sample_data_folder, 'MEG', 'sample',
                                     'sample_audvis_raw.fif')
-raw = mne.io.read_raw_fif(sample_data_raw_file, verbose=False).crop(tmax=120)
+cached = eeg_cache.cache_raw(sample_data_raw_file, cache_folder)  # up to date
 
-events = mne.find_events(raw, stim_channel='STI 014')
+table = eeg_events.find_events(cached, stim_channel='STI 014').between(tmax=120)
+events = table.between(tmax=120 - 0.5).events  # epochs within the first 120 s
 event_dict = {'auditory/left': 1, 'auditory/right': 2, 'visual/left': 3,
               'visual/right': 4, 'face': 5, 'button': 32}
 
-epochs = mne.Epochs(raw, events, tmin=-0.2, tmax=0.5, event_id=event_dict,
-                    preload=True)
-del raw
+epochs = eeg_epochs.make_epochs(cached, events, event_dict, tmin=-0.2,
+                                tmax=0.5)
 
 # plotting Epochs as time series
-catch_trials_and_buttonpresses = mne.pick_events(events, include=[5, 32])
+catch_trials_and_buttonpresses = table.select(code=[5, 32]).events
 epochs['face'].plot(events=catch_trials_and_buttonpresses, event_id=event_dict,
                     event_color=dict(button='red', face='blue'))
 
@@ -102,13 +117,15 @@ epochs.plot_sensors(kind='3d', ch_type='all')
 epochs.plot_sensors(kind='topomap', ch_type='all')
 
 # plotting the power spectrum
-epochs['auditory'].plot_psd(picks='eeg')
+# (multitaper of all epochs once; conditions and bands are served from it)
+psd = eeg_psd.compute_psd(epochs)
+psd.subset(epochs['auditory']).plot(picks='eeg')
 
 # plotting spectral estimates as scalp topography
 # default parameters plot five freq bands
-epochs['visual/right'].plot_psd_topomap()
+psd.subset(epochs['visual/right']).plot_topomap()
 
 # specify bands parameter for custom viewing
 bands = [(10, '10 Hz'), (15, '15 Hz'), (20, '20 Hz'), (10, 20, '10-20 Hz')]
-epochs['visual/right'].plot_psd_topomap(bands=bands, vlim='joint',
-                                        ch_type='grad')
\ No newline at end of file
+psd.subset(epochs['visual/right']).plot_topomap(bands=bands, vlim='joint',
+                                                ch_type='grad')
\ No newline at end of file
@@ -3,6 +3,9 @@ import numpy as np
 import matplotlib.pyplot as plt
 import mne
 
+import eeg_events
+import eeg_pipeline
+
 
 # #### 3-1) Detecting events ####
 
@@ -10,20 +13,15 @@ import mne
 sample_data_folder = mne.datasets.sample.data_path()
 sample_data_raw_file = os.path.join(sample_data_folder, 'MEG', 'sample',
                                     'sample_audvis_filt-0-40_raw.fif')
-raw = mne.io.read_raw_fif(sample_data_raw_file)
-
-# preprocessing
-from mne.preprocessing import (ICA, create_eog_epochs, create_ecg_epochs,
-                               corrmap)
-
-ica = mne.preprocessing.ICA(n_components=20, random_state=97, max_iter=800)
-ica.fit(raw)
-ica.exclude = [1, 2]  # ICs with EOG, ECG artifacts
-ica.plot_properties(raw, picks=ica.exclude)
 
-orig_raw = raw.copy()
-raw.load_data()
-ica.apply(raw)
+# preprocessing: the study2 stages (see eeg_pipeline.py) read -> 1 Hz
+# high-pass -> ICA + EOG/ECG labels (see eeg_artifacts.py) -> cleaned raw.
+# Every output is cached on disk, so study2_0324_epoching.py (same file,
+# same stages) reads the ICA back instead of fitting it again
+pipe = eeg_pipeline.study2_pipeline(sample_data_raw_file)
+out = pipe.run(['raw', 'ica', 'clean'])
+orig_raw, ica, raw = out['raw'], out['ica'], out['clean']
+ica.plot_properties(orig_raw, picks=ica.exclude)
 
 # show some frontal channels to clearly illustrate the artifact removal
 chs = ['MEG 0111', 'MEG 0121', 'MEG 0131', 'MEG 0211', 'MEG 0221', 'MEG 0231',
@@ -35,13 +33,17 @@ orig_raw.plot(order=chan_idxs, start=12, duration=4)
 raw.plot(order=chan_idxs, start=12, duration=4)
 
 # detecting experimental events (using STIM channels)
-events = mne.find_events(raw, stim_channel='STI 014')
+# detected once per recording and cached, queries are indexed (see eeg_events.py)
+table = eeg_events.find_events(raw, stim_channel='STI 014')
+events = table.events
 print(events[:5])
 
 # make an event dictionary
 # 'event(or condition)': integer event ID
 event_dict = {'auditory/left': 1, 'auditory/right': 2, 'visual/left': 3,
               'visual/right': 4, 'smiley': 5, 'buttonpress': 32}
+table.event_id = event_dict
+print(table.select(tag='auditory').count())  # auditory/left + auditory/right
 
 # visualizing the distribution of events
 fig = mne.viz.plot_events(events, event_id=event_dict, sfreq=raw.info['sfreq'],
@@ -64,13 +66,14 @@ raw.crop(tmax=60).load_data()
 raw.copy().pick_types(meg=False, stim=True).plot(start=3, duration=6)
 
 # convert STIM channel signals to Events array
-events = mne.find_events(raw, stim_channel='STI 014')
+table = eeg_events.find_events(raw, stim_channel='STI 014')
+events = table.events
 print(events[:5])
 
 # subselecting and combining events
-events_no_button = mne.pick_events(events, exclude=32)
+events_no_button = table.select(exclude=32).events
 
-merged_events = mne.merge_events(events, [1, 2, 3], 1)
+merged_events = table.merge([1, 2, 3], 1).events
 print(np.unique(merged_events[:, -1]))
 
 # plotting events & raw data together
@@ -90,23 +93,23 @@ print(set(eeglab_raw.annotations.description))
 print(eeglab_raw.annotations.onset[0])
 
 # converting Annotations object to Events array
-events_from_annot, event_dict = mne.events_from_annotations(eeglab_raw)
+annot_table = eeg_events.from_annotations(eeglab_raw)
+events_from_annot, event_dict = annot_table.events, annot_table.event_id
 print(event_dict)
 print(events_from_annot[:5])
 
 # specify the integers mapped to each description
 custom_mapping = {'rt': 77, 'square': 42}
-(events_from_annot,
- event_dict) = mne.events_from_annotations(eeglab_raw, event_id=custom_mapping)
+annot_table = eeg_events.from_annotations(eeglab_raw, event_id=custom_mapping)
+events_from_annot, event_dict = annot_table.events, annot_table.event_id
 print(event_dict)
 print(events_from_annot[:5])
 
 # converting Events array to Annotations object
 mapping = {1: 'auditory/left', 2: 'auditory/right', 3: 'visual/left',
            4: 'visual/right', 5: 'smiley', 32: 'buttonpress'}
-annot_from_events = mne.annotations_from_events(
-    events=events, event_desc=mapping, sfreq=raw.info['sfreq'],
-    orig_time=raw.info['meas_date'])
+annot_from_events = table.to_annotations(event_desc=mapping,
+                                         orig_time=raw.info['meas_date'])
 raw.set_annotations(annot_from_events)
 
 raw.plot(start=5, duration=5)